@@ -0,0 +1,197 @@
+# db/activity_catalog.py
+import asyncio
+import hashlib
+import json
+import threading
+import time
+
+from db.supabase_client import supabase
+from db.catalog_index import CatalogIndex
+from db.async_repo import run_db, is_missing_object_error
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+# ============================================================
+#   НАСТРОЙКИ КЭША КАТАЛОГА
+# ============================================================
+# Как часто дёргаем дешёвую проверку watermark (count + max(updated_at))
+WATERMARK_CHECK_SECONDS = 60
+# Полная перезагрузка не реже, чем раз в TTL (на случай, если watermark не поймал правку)
+CATALOG_TTL_SECONDS = 600
+
+
+class ActivityCatalog:
+    """
+    Общий in-memory каталог активностей.
+
+    Загружается один раз (лениво, при первом обращении) и дальше обновляется
+    в фоне через run_refresher(): сначала дешёвый запрос watermark
+    (кол-во строк + свежайший updated_at), и полная перезагрузка — только если
+    watermark изменился или истёк TTL.
+
+    version — отпечаток содержимого каталога. Меняется только когда реально
+    поменялись данные, поэтому на него можно завязывать производные кэши.
+    """
+
+    def __init__(self):
+        self._load_lock = threading.Lock()
+        self._activities: list[dict] = []
+        self._by_id: dict[int, dict] = {}
+        self._index: CatalogIndex | None = None
+        self._candidates = None
+        self._version: str | None = None
+        self._watermark = None
+        self._loaded_at = 0.0
+        self._watermark_supported = True
+
+    # ---------- загрузка ----------
+
+    def _fetch_watermark(self):
+        """
+        (кол-во строк, max(updated_at)) или None, если колонки updated_at нет
+        или запрос сейчас не прошёл (тогда проверим на следующем тике).
+        """
+        if not self._watermark_supported:
+            return None
+        try:
+            resp = (
+                supabase.table("activities")
+                .select("id, updated_at", count="exact")
+                .order("updated_at", desc=True)
+                .limit(1)
+                .execute()
+            )
+        except Exception as e:
+            if not is_missing_object_error(e):
+                logger.warning(f"[catalog] ❌ watermark check failed, retry next tick: {e}")
+                return None
+            logger.warning(f"[catalog] ⚠️ колонки updated_at нет, работаем только по TTL: {e}")
+            self._watermark_supported = False
+            return None
+        latest = (resp.data or [{}])[0].get("updated_at")
+        return int(resp.count or 0), latest
+
+    def reload(self) -> bool:
+        """
+        Полная загрузка каталога из Supabase.
+        Возвращает True, если содержимое поменялось.
+        """
+        with self._load_lock:
+            return self._reload_locked()
+
+    def _reload_locked(self) -> bool:
+        watermark = self._fetch_watermark()
+        rows = supabase.table("activities").select("*").order("id").execute().data or []
+
+        digest = hashlib.sha1(
+            json.dumps(rows, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        ).hexdigest()[:12]
+
+        changed = digest != self._version
+        if changed:
+            # version ставим последним: читатели без лока видят либо старый, либо новый каталог целиком
+            self._activities = rows
+            self._by_id = {a["id"]: a for a in rows}
+            self._index = CatalogIndex(rows, digest)
+            self._version = digest
+        self._watermark = watermark
+        self._loaded_at = time.time()
+
+        if changed:
+            logger.info(f"[catalog] 📚 Каталог загружен: {len(rows)} активностей, version={digest}")
+        return changed
+
+    def _ensure_loaded(self):
+        if self._version is not None:
+            return
+        with self._load_lock:
+            if self._version is None:
+                self._reload_locked()
+
+    def refresh_if_stale(self) -> bool:
+        """
+        Одна итерация фонового обновления.
+        Перезагружаем каталог, если изменился watermark или истёк TTL.
+        """
+        if self._version is None:
+            return self.reload()
+
+        if time.time() - self._loaded_at > CATALOG_TTL_SECONDS:
+            return self.reload()
+
+        watermark = self._fetch_watermark()
+        if watermark is not None and watermark != self._watermark:
+            return self.reload()
+        return False
+
+    async def run_refresher(self):
+        """Фоновая задача: держит каталог свежим, не блокируя event loop."""
+        while True:
+            try:
+                if await run_db(self.refresh_if_stale):
+                    # таблицу кандидатов строим сразу, а не на первом тапе юзера
+                    await run_db(lambda: self.candidates)
+            except Exception as e:
+                logger.warning(f"[catalog] ❌ Refresh error: {e}")
+            await asyncio.sleep(WATERMARK_CHECK_SECONDS)
+
+    # ---------- чтение ----------
+
+    @property
+    def version(self) -> str | None:
+        self._ensure_loaded()
+        return self._version
+
+    @property
+    def index(self) -> CatalogIndex:
+        """Фасетный индекс текущей версии каталога (перестраивается вместе с каталогом)."""
+        self._ensure_loaded()
+        return self._index
+
+    @property
+    def candidates(self):
+        """Таблица кандидатов под комбинации фильтров (db/candidate_table) для текущей версии."""
+        self._ensure_loaded()
+        table = self._candidates
+        if table is not None and table.version == self._version:
+            return table
+        from db.candidate_table import CandidateTable  # candidate_table -> db.seen -> каталог
+        with self._load_lock:
+            if self._candidates is None or self._candidates.version != self._version:
+                self._candidates = CandidateTable(self._activities, self._index)
+            return self._candidates
+
+    def all(self) -> list[dict]:
+        """Все активности (в порядке id). Список не мутировать."""
+        self._ensure_loaded()
+        return self._activities
+
+    def get(self, activity_id: int) -> dict | None:
+        """
+        Активность по id. Если её нет в кэше (добавили только что) —
+        добираем одной строкой из БД, не дожидаясь фонового обновления.
+        """
+        self._ensure_loaded()
+        activity = self._by_id.get(activity_id)
+        if activity is not None:
+            return activity
+
+        resp = supabase.table("activities").select("*").eq("id", activity_id).execute()
+        if not resp.data:
+            return None
+        logger.info(f"[catalog] 🔎 activity_id={activity_id} нет в кэше, ставим перезагрузку")
+        self._loaded_at = 0.0  # следующий тик refresher'а перечитает каталог целиком
+        return resp.data[0]
+
+    def get_many(self, activity_ids: list[int]) -> list[dict]:
+        """Активности по списку id, в том же порядке; неизвестные id пропускаются."""
+        out = []
+        for aid in activity_ids:
+            activity = self.get(aid)
+            if activity is not None:
+                out.append(activity)
+        return out
+
+
+activity_catalog = ActivityCatalog()
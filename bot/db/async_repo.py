@@ -0,0 +1,296 @@
+# db/async_repo.py
+"""
+Асинхронный доступ к Supabase для aiogram-хэндлеров и фоновых задач.
+
+Клиент supabase синхронный: каждый .execute() внутри async def блокирует
+event loop, и один медленный ответ PostgREST тормозит всех юзеров.
+Здесь все вызовы уходят в ограниченный пул потоков (DB_MAX_WORKERS),
+поэтому апдейты разных юзеров обрабатываются параллельно в одном процессе.
+
+    rows = await aexecute(supabase.table("x").select("*").eq("id", 1))
+    blocked = await run_db(should_block_l0, user_id)
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from db.supabase_client import supabase
+
+DB_MAX_WORKERS = int(os.getenv("DB_MAX_WORKERS", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="supabase")
+
+
+async def run_db(fn, *args, **kwargs):
+    """Выполняет синхронную функцию, ходящую в БД, в пуле потоков."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def aexecute(query):
+    """await-версия query.execute() для любого запроса supabase."""
+    return await run_db(query.execute)
+
+
+# Postgres / PostgREST: таблицы, колонки или функции нет (миграция не применена)
+_MISSING_OBJECT_CODES = {"42P01", "42703", "42883", "PGRST202", "PGRST204", "PGRST205"}
+
+
+def is_missing_object_error(e: Exception) -> bool:
+    """
+    True, если запрос упал потому, что объекта в схеме нет, — а не из-за сети,
+    таймаута или перегрузки. Только по таким ошибкам можно откатываться на
+    «старую» схему; остальные — повод повторить позже.
+    """
+    if getattr(e, "code", None) in _MISSING_OBJECT_CODES:
+        return True
+    text = str(e).lower()
+    return "does not exist" in text or "could not find the" in text
+
+
+# ============================================================
+#   activities / seen_activities
+# ============================================================
+
+async def get_activity(activity_id: int) -> dict | None:
+    from db.activity_catalog import activity_catalog
+    return await run_db(activity_catalog.get, activity_id)
+
+
+async def get_seen_state(user_id: int):
+    from db.seen_state import get_seen_state as _get_seen_state
+    return await run_db(_get_seen_state, user_id)
+
+
+# ============================================================
+#   favorites
+# ============================================================
+
+async def is_favorite(user_id: int, activity_id: int) -> bool:
+    resp = await aexecute(
+        supabase.table("favorites").select("id")
+        .eq("user_id", user_id).eq("activity_id", activity_id)
+    )
+    return bool(resp.data)
+
+
+async def add_favorite(user_id: int, activity_id: int) -> bool:
+    from db.supabase_client import add_favorite as _add_favorite
+    return await run_db(_add_favorite, user_id, activity_id)
+
+
+async def remove_favorite(user_id: int, activity_id: int):
+    await aexecute(
+        supabase.table("favorites").delete()
+        .eq("user_id", user_id).eq("activity_id", activity_id)
+    )
+
+
+async def get_favorite_ids(user_id: int) -> list[int]:
+    """activity_id избранного, свежие сверху."""
+    resp = await aexecute(
+        supabase.table("favorites").select("activity_id")
+        .eq("user_id", user_id).order("created_at", desc=True)
+    )
+    return [row["activity_id"] for row in (resp.data or [])]
+
+
+async def has_favorites(user_id: int) -> bool:
+    resp = await aexecute(
+        supabase.table("favorites").select("id").eq("user_id", user_id).limit(1)
+    )
+    return bool(resp.data)
+
+
+async def count_favorites(user_ids: list[int], chunk: int = 200) -> dict[int, int]:
+    """Сколько уникальных активностей в избранном у каждого из user_ids — один запрос на chunk юзеров."""
+    counts: dict[int, set] = {uid: set() for uid in user_ids}
+    page = 1000  # PostgREST по умолчанию отдаёт не больше 1000 строк
+    for i in range(0, len(user_ids), chunk):
+        offset = 0
+        while True:
+            resp = await aexecute(
+                supabase.table("favorites").select("user_id, activity_id")
+                .in_("user_id", user_ids[i:i + chunk])
+                .order("id")
+                .range(offset, offset + page - 1)
+            )
+            rows = resp.data or []
+            for row in rows:
+                if row.get("activity_id"):
+                    counts.setdefault(row["user_id"], set()).add(row["activity_id"])
+            if len(rows) < page:
+                break
+            offset += page
+    return {uid: len(ids) for uid, ids in counts.items()}
+
+
+# ============================================================
+#   user_filters
+# ============================================================
+
+async def get_user_filters(user_id: int) -> dict | None:
+    resp = await aexecute(supabase.table("user_filters").select("*").eq("user_id", user_id))
+    return resp.data[0] if resp.data else None
+
+
+async def upsert_user_filters(row: dict):
+    await aexecute(supabase.table("user_filters").upsert(row))
+
+
+async def update_user_filters(user_id: int, fields: dict):
+    await aexecute(supabase.table("user_filters").update(fields).eq("user_id", user_id))
+
+
+# ============================================================
+#   user_subscriptions / user_sessions
+# ============================================================
+
+async def get_subscription(user_id: int, columns: str = "*") -> dict | None:
+    resp = await aexecute(
+        supabase.table("user_subscriptions").select(columns).eq("user_id", user_id).maybe_single()
+    )
+    # maybe_single() может вернуть None вместо ответа
+    return getattr(resp, "data", None) if resp else None
+
+
+async def get_active_subscriber_ids() -> list[int]:
+    resp = await aexecute(
+        supabase.table("user_subscriptions").select("user_id, is_active").eq("is_active", True)
+    )
+    return [row["user_id"] for row in (resp.data or [])]
+
+
+async def upsert_sessions(rows: list[dict], chunk: int = 500):
+    for i in range(0, len(rows), chunk):
+        await aexecute(supabase.table("user_sessions").upsert(rows[i:i + chunk]))
+
+
+# ============================================================
+#   media_file_ids (см. db/sql/media_file_ids.sql)
+# ============================================================
+
+async def load_media_file_ids(bot_key: str, env: str) -> list[dict]:
+    resp = await aexecute(
+        supabase.table("media_file_ids").select("url, kind, file_id")
+        .eq("bot_key", bot_key).eq("env", env)
+    )
+    return resp.data or []
+
+
+async def save_media_file_id(row: dict):
+    await aexecute(
+        supabase.table("media_file_ids").upsert(row, on_conflict="bot_key,env,url")
+    )
+
+
+async def delete_media_file_id(bot_key: str, env: str, url: str):
+    await aexecute(
+        supabase.table("media_file_ids").delete()
+        .eq("bot_key", bot_key).eq("env", env).eq("url", url)
+    )
+
+
+# ============================================================
+#   push_queue
+# ============================================================
+
+async def fetch_due_pushes(now_iso: str, limit: int, types: list[str] | None = None) -> list[dict]:
+    query = (
+        supabase.table("push_queue").select("*")
+        .eq("status", "pending")
+        .lte("scheduled_at", now_iso)
+    )
+    if types:
+        query = query.in_("type", types)
+    resp = await aexecute(query.order("scheduled_at", desc=False).limit(limit))
+    return resp.data or []
+
+
+async def update_push(push_id: int, fields: dict):
+    await aexecute(supabase.table("push_queue").update(fields).eq("id", push_id))
+
+
+async def claim_pushes(owner: str, limit: int, lease_seconds: int,
+                       types: list[str] | None = None) -> list[dict]:
+    """
+    Атомарно забирает пачку пушей в аренду (RPC claim_push_batch, см. db/sql/push_queue_lease.sql).
+    Строки приходят уже в status='processing' с lease_owner=owner.
+    """
+    resp = await aexecute(supabase.rpc("claim_push_batch", {
+        "p_owner": owner,
+        "p_limit": limit,
+        "p_lease_seconds": lease_seconds,
+        "p_types": types,
+    }))
+    return resp.data or []
+
+
+async def mark_push_sending(row: dict, now_iso: str) -> bool:
+    """
+    Отметка «отправляю» перед вызовом Telegram (compare-and-set по sending_at).
+    True — отметку поставили мы и пуш можно слать. False — её уже кто-то ставил
+    (воркер упал посреди отправки) или аренда ушла к другому воркеру.
+    """
+    query = (
+        supabase.table("push_queue")
+        .update({"sending_at": now_iso})
+        .eq("id", row["id"])
+        .is_("sending_at", "null")
+    )
+    owner = row.get("lease_owner")
+    if owner:
+        query = query.eq("lease_owner", owner).eq("status", "processing")
+    resp = await aexecute(query)
+    return bool(resp.data)
+
+
+async def reschedule_quiet_pushes(until_iso: str, ramp_seconds: int,
+                                  skip_types: list[str]) -> int:
+    """
+    Переносит все наступившие pending-пуши (кроме skip_types) на until + случайный
+    сдвиг в пределах ramp_seconds. Один запрос (RPC, см. db/sql/push_queue_quiet_hours.sql).
+    """
+    resp = await aexecute(supabase.rpc("reschedule_quiet_pushes", {
+        "p_until": until_iso,
+        "p_ramp_seconds": ramp_seconds,
+        "p_skip_types": skip_types,
+    }))
+    return int(resp.data or 0)
+
+
+async def finish_push(row: dict, fields: dict) -> bool:
+    """
+    Финальный апдейт пуша (sent / failed / перенос в pending).
+    Для арендованной строки срабатывает, только пока аренда наша —
+    если её уже перехватил другой воркер, ничего не меняем и возвращаем False.
+    """
+    owner = row.get("lease_owner")
+    if not owner:
+        await update_push(row["id"], fields)
+        return True
+
+    resp = await aexecute(
+        supabase.table("push_queue")
+        .update({**fields, "lease_owner": None, "lease_expires_at": None})
+        .eq("id", row["id"])
+        .eq("lease_owner", owner)
+        .eq("status", "processing")
+    )
+    return bool(resp.data)
+
+
+async def insert_pushes(rows: dict | list[dict]):
+    await aexecute(supabase.table("push_queue").insert(rows))
+
+
+async def count_sent_pushes(start_iso: str, end_iso: str) -> int:
+    resp = await aexecute(
+        supabase.table("push_queue").select("id", count="exact")
+        .eq("status", "sent")
+        .gte("sent_at", start_iso)
+        .lt("sent_at", end_iso)
+    )
+    return int(resp.count or 0)
+
@@ -0,0 +1,101 @@
+# db/candidate_table.py
+"""
+Материализованные списки кандидатов под комбинации фильтров.
+
+Для каждой комбинации (возраст, время, энергия, место) заранее разложены id
+активностей по уровням STRATEGIES (активность — на самом строгом подходящем
+уровне), внутри уровня — отдельно видео и текст, в порядке каталога.
+Подбор в db/seen.py тогда сводится к «список минус просмотренное», без прохода
+по всему каталогу на каждый тап.
+
+Онбординговые комбинации (4 возраста × 4 времени × 3 энергии × 2 места, см.
+keyboards/onboarding.py) считаются сразу при построении таблицы, остальные —
+по первому запросу и запоминаются. Таблица живёт одну версию каталога
+(activity_catalog.candidates). Её же использует tools/test_filters_V2.py
+для отчёта о покрытии.
+"""
+import threading
+from collections import OrderedDict
+
+from db.catalog_index import CatalogIndex, norm_value
+from db.seen import STRATEGIES, _has_video
+from db.supabase_client import TIME_MAP, ENERGY_MAP, location_MAP
+
+# Возрастные кнопки онбординга (handlers/onboarding.py)
+ONBOARDING_AGES = ((3, 4), (5, 6), (7, 8), (9, 10))
+
+# Сколько не-онбординговых комбинаций держим в памяти
+CANDIDATE_MEMO_SIZE = 1024
+
+
+def onboarding_combos():
+    """Все комбинации фильтров, которые можно набрать кнопками онбординга."""
+    for age_min, age_max in ONBOARDING_AGES:
+        for time_required in TIME_MAP.values():
+            for energy in ENERGY_MAP.values():
+                for location in location_MAP.values():
+                    yield age_min, age_max, time_required, energy, location
+
+
+def combo_key(age_min, age_max, time_required, energy, location) -> tuple:
+    """Ключ таблицы. Значения фасетов — уже человекочитаемые (после TIME_MAP и т.п.)."""
+    return (
+        None if age_min is None else int(age_min),
+        None if age_max is None else int(age_max),
+        norm_value(time_required),
+        norm_value(energy),
+        norm_value(location),
+    )
+
+
+class CandidateTable:
+    """
+    get(combo) -> кортеж по уровням STRATEGIES: (video_ids, text_ids),
+    id в порядке каталога.
+    """
+
+    def __init__(self, activities: list[dict], index: CatalogIndex):
+        self.version = index.version
+        self.activities = activities
+        self._index = index
+        self._position = {a["id"]: pos for pos, a in enumerate(activities)}
+        self._video = frozenset(a["id"] for a in activities if _has_video(a))
+
+        self._lock = threading.Lock()
+        self._onboarding = {combo_key(*c): self._build(*c) for c in onboarding_combos()}
+        self._memo: OrderedDict = OrderedDict()
+
+    def _build(self, age_min, age_max, time_required, energy, location) -> tuple:
+        levels = []
+        taken: set[int] = set()
+        for _, *uses in STRATEGIES:
+            matched = self._index.match(age_min, age_max, time_required, energy, location, *uses)
+            bucket = sorted(matched - taken, key=self._position.__getitem__)
+            taken |= matched
+            levels.append((
+                tuple(aid for aid in bucket if aid in self._video),
+                tuple(aid for aid in bucket if aid not in self._video),
+            ))
+        return tuple(levels)
+
+    def get(self, age_min, age_max, time_required, energy, location) -> tuple:
+        key = combo_key(age_min, age_max, time_required, energy, location)
+        levels = self._onboarding.get(key)
+        if levels is not None:
+            return levels
+
+        with self._lock:
+            levels = self._memo.get(key)
+            if levels is not None:
+                self._memo.move_to_end(key)
+                return levels
+
+        levels = self._build(age_min, age_max, time_required, energy, location)
+        with self._lock:
+            self._memo[key] = levels
+            while len(self._memo) > CANDIDATE_MEMO_SIZE:
+                self._memo.popitem(last=False)
+        return levels
+
+    def activity(self, activity_id: int) -> dict:
+        return self.activities[self._position[activity_id]]
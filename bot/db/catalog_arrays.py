@@ -0,0 +1,160 @@
+# db/catalog_arrays.py
+"""
+Колоночное представление каталога для векторного подбора (numpy — опционально).
+
+Каталог раскладывается в массивы одной длины (порядок = activity_catalog.all()):
+id, age_min / age_max (+ маска «возраст заполнен»), has_video и по битовой
+маске на каждый фасет (бит = токен значения, см. catalog_index.split_multivalue).
+Все пять стратегий подбора считаются булевыми масками за один проход, без
+цикла по словарям, — подбор остаётся в пределах миллисекунды и на десятках
+тысяч идей.
+
+Результат совпадает с питоновским путём в db/seen.py при том же состоянии
+random: корзины видео/текст те же и в том же порядке, а выбор из них делает
+тот же _soft_priority_pick.
+
+Включается SELECTION_ENGINE=numpy (или флагом selection_engine: {"engine": "numpy"},
+см. db/seen.selection_engine).
+Если numpy не установлен или фасет не влезает в 64 бита — тихо работаем
+по-старому.
+"""
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # опциональная зависимость
+    np = None
+
+from db.catalog_index import FACETS, norm_value, split_multivalue, _parse_age
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+# фасет с большим числом разных значений в uint64 не влезет
+MAX_FACET_TOKENS = 64
+
+
+class CatalogArrays:
+    """Массивы каталога одной версии. Строятся один раз, дальше только читаются."""
+
+    __slots__ = ("activities", "ids", "age_min", "age_max", "has_age",
+                 "has_video", "facet_bits", "facet_tokens")
+
+    def __init__(self, activities: list[dict], has_video):
+        n = len(activities)
+        self.activities = activities
+        self.ids = np.fromiter((a["id"] for a in activities), dtype=np.int64, count=n)
+
+        self.age_min = np.zeros(n, dtype=np.int64)
+        self.age_max = np.zeros(n, dtype=np.int64)
+        self.has_age = np.zeros(n, dtype=bool)
+        self.has_video = np.fromiter((has_video(a) for a in activities), dtype=bool, count=n)
+
+        for pos, a in enumerate(activities):
+            parsed = _parse_age(a.get("age_min"), a.get("age_max"))
+            if parsed:
+                self.age_min[pos], self.age_max[pos] = parsed
+                self.has_age[pos] = True
+
+        self.facet_tokens: dict[str, dict[str, int]] = {}
+        self.facet_bits: dict[str, "np.ndarray"] = {}
+        for facet in FACETS:
+            tokens: dict[str, int] = {}
+            bits = np.zeros(n, dtype=np.uint64)
+            for pos, a in enumerate(activities):
+                mask = 0
+                for token in split_multivalue(a.get(facet)):
+                    bit = tokens.setdefault(token, len(tokens))
+                    if bit >= MAX_FACET_TOKENS:
+                        raise ValueError(f"facet {facet} has more than {MAX_FACET_TOKENS} values")
+                    mask |= 1 << bit
+                bits[pos] = mask
+            self.facet_tokens[facet] = tokens
+            self.facet_bits[facet] = bits
+
+    # ---------- маски ----------
+
+    def age_mask(self, age_min, age_max):
+        """Как CatalogIndex.age_ids: диапазон активности пересекается с [age_min, age_max]."""
+        if age_min is None or age_max is None:
+            return self.has_age
+        return self.has_age & (self.age_min <= int(age_max)) & (self.age_max >= int(age_min))
+
+    def facet_mask(self, facet: str, user_value):
+        """Как CatalogIndex.facet_ids: пустое значение = любой заполненный фасет."""
+        bits = self.facet_bits[facet]
+        if not user_value:
+            return bits != 0
+        bit = self.facet_tokens[facet].get(norm_value(user_value))
+        if bit is None:
+            return np.zeros(len(bits), dtype=bool)
+        return (bits & np.uint64(1 << bit)) != 0
+
+    def seen_mask(self, seen_ids):
+        if not seen_ids:
+            return np.zeros(len(self.ids), dtype=bool)
+        seen = np.fromiter(seen_ids, dtype=np.int64, count=len(seen_ids))
+        return np.isin(self.ids, seen)
+
+
+_lock = threading.Lock()
+_current: CatalogArrays | None = None
+
+
+def get_catalog_arrays(activities: list[dict], has_video) -> CatalogArrays | None:
+    """
+    Массивы для данного списка активностей (кэш на один список — т.е. на версию
+    каталога). None — numpy недоступен или каталог в массивы не укладывается.
+    """
+    global _current
+    if np is None:
+        return None
+    current = _current
+    if current is not None and current.activities is activities:
+        return current
+    with _lock:
+        if _current is not None and _current.activities is activities:
+            return _current
+        try:
+            _current = CatalogArrays(activities, has_video)
+        except ValueError as e:
+            logger.warning(f"[catalog_arrays] ⚠️ numpy engine disabled for this catalog: {e}")
+            return None
+        return _current
+
+
+def bucket_first_level(arrays: CatalogArrays, strategies, seen_ids, force_video: bool,
+                       age_min, age_max, time_required, energy, location):
+    """
+    Векторный аналог пула + _bucket_by_level из db/seen.py.
+    (level, video_positions, text_positions) для первой непустой стратегии или None.
+    Позиции — индексы в arrays.activities, в порядке каталога.
+    """
+    pool = ~arrays.seen_mask(seen_ids)
+    if force_video:
+        video_pool = pool & arrays.has_video
+        # онбординг: если с видео пусто — снимаем ограничение (как в питоновском пути)
+        if video_pool.any():
+            pool = video_pool
+
+    facets = (
+        arrays.age_mask(age_min, age_max),
+        arrays.facet_mask("time_required", time_required),
+        arrays.facet_mask("energy", energy),
+        arrays.facet_mask("location", location),
+    )
+
+    taken = np.zeros(len(pool), dtype=bool)
+    for level, (_, *uses) in enumerate(strategies):
+        mask = pool.copy()
+        for use, facet_mask in zip(uses, facets):
+            if use:
+                mask &= facet_mask
+        # активность относится к самой строгой подходящей стратегии
+        bucket = mask & ~taken
+        taken |= mask
+        if bucket.any():
+            video = np.flatnonzero(bucket & arrays.has_video)
+            text = np.flatnonzero(bucket & ~arrays.has_video)
+            return level, video.tolist(), text.tolist()
+    return None
@@ -0,0 +1,127 @@
+# db/catalog_index.py
+from bisect import bisect_right
+
+EMPTY: frozenset = frozenset()
+
+# Фасеты, по которым фильтруем (значения в activities — через запятую)
+FACETS = ("time_required", "energy", "location")
+
+
+def norm_value(s) -> str:
+    return s.lower().strip() if isinstance(s, str) else ""
+
+
+def split_multivalue(value) -> frozenset[str]:
+    """'Дома, На улице' -> {'дома', 'на улице'}"""
+    if not isinstance(value, str):
+        return EMPTY
+    return frozenset(t for t in (norm_value(p) for p in value.split(",")) if t)
+
+
+def _parse_age(act_min, act_max):
+    if act_min is None or act_max is None:
+        return None
+    try:
+        return int(act_min), int(act_max)
+    except (TypeError, ValueError):
+        return None
+
+
+class CatalogIndex:
+    """
+    Индекс каталога под фильтры. Строится один раз на версию каталога.
+
+    - по каждому фасету: значение -> множество id (значения разбиты по запятой,
+      поэтому '1 час' больше не матчится на 'Более часа'-подобные подстроки);
+    - возрастной интервальный индекс: отсортированные age_min + bisect,
+      результат запроса (age_min, age_max) кэшируется — комбинаций возрастов мало.
+
+    Любая стратегия подбора = пересечение нескольких множеств.
+    """
+
+    def __init__(self, activities: list[dict], version: str | None = None):
+        self.version = version
+        self.ids: tuple[int, ...] = tuple(a["id"] for a in activities)
+        self.all_ids: frozenset[int] = frozenset(self.ids)
+
+        self._facets: dict[str, dict[str, set[int]]] = {f: {} for f in FACETS}
+        self._has_facet: dict[str, set[int]] = {f: set() for f in FACETS}
+
+        ages = []
+        for a in activities:
+            aid = a["id"]
+            for facet in FACETS:
+                tokens = split_multivalue(a.get(facet))
+                if not tokens:
+                    continue
+                self._has_facet[facet].add(aid)
+                for token in tokens:
+                    self._facets[facet].setdefault(token, set()).add(aid)
+
+            parsed = _parse_age(a.get("age_min"), a.get("age_max"))
+            if parsed:
+                ages.append((parsed[0], parsed[1], aid))
+
+        ages.sort()
+        self._age_starts = [s for s, _, _ in ages]
+        self._age_entries = ages
+        self._has_age: frozenset[int] = frozenset(aid for _, _, aid in ages)
+        self._age_cache: dict[tuple[int, int], frozenset[int]] = {}
+
+        # замораживаем, чтобы никто случайно не мутировал индекс снаружи
+        self._facets = {
+            f: {token: frozenset(ids) for token, ids in values.items()}
+            for f, values in self._facets.items()
+        }
+        self._has_facet = {f: frozenset(ids) for f, ids in self._has_facet.items()}
+
+    def facet_ids(self, facet: str, user_value: str | None) -> frozenset[int]:
+        """
+        id активностей, подходящих по фасету.
+        Пустое значение у юзера = подходит любая активность, где фасет заполнен.
+        """
+        if not user_value:
+            return self._has_facet[facet]
+        return self._facets[facet].get(norm_value(user_value), EMPTY)
+
+    def age_ids(self, age_min: int | None, age_max: int | None) -> frozenset[int]:
+        """id активностей, чей возрастной диапазон пересекается с [age_min, age_max]."""
+        if age_min is None or age_max is None:
+            return self._has_age
+
+        key = (int(age_min), int(age_max))
+        cached = self._age_cache.get(key)
+        if cached is not None:
+            return cached
+
+        umin, umax = key
+        # кандидаты: age_min активности <= umax, из них оставляем age_max >= umin
+        upto = bisect_right(self._age_starts, umax)
+        result = frozenset(aid for _, a_max, aid in self._age_entries[:upto] if a_max >= umin)
+        self._age_cache[key] = result
+        return result
+
+    def match(self,
+              age_min, age_max, time_required, energy, location,
+              use_age=True, use_time=True, use_energy=True, use_loc=True) -> frozenset[int]:
+        """Все id, подходящие под стратегию (значения фасетов — уже человекочитаемые)."""
+        sets = []
+        if use_age:
+            sets.append(self.age_ids(age_min, age_max))
+        if use_time:
+            sets.append(self.facet_ids("time_required", time_required))
+        if use_energy:
+            sets.append(self.facet_ids("energy", energy))
+        if use_loc:
+            sets.append(self.facet_ids("location", location))
+
+        if not sets:
+            return self.all_ids
+
+        sets.sort(key=len)
+        result = sets[0]
+        for s in sets[1:]:
+            if not result:
+                break
+            result = result & s
+        return result
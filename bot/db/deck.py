@@ -0,0 +1,121 @@
+# db/deck.py
+"""
+Колода юзера: детерминированная перетасовка кандидатов под его фильтры.
+
+Вместо случайного выбора из пула на каждый тап у юзера есть «колода» —
+перестановка непросмотренных id из таблицы кандидатов (db/candidate_table):
+уровни STRATEGIES идут по порядку, внутри уровня видео и текст перемешаны
+с приоритетом 70/30. Колода целиком лежит в контексте юзера:
+
+    ctx["deck"] = {"combo": [...], "version": "...", "epoch": 0, "seed": 123,
+                   "order": array("i", [...]), "starts": [0, 40, ...],
+                   "left": [38, 12, ...], "cursor": 17}
+
+order — id подряд (4 байта на карту), starts — начала уровней, left — сколько
+на уровне ещё не просмотрено. Следующая карточка — первый непросмотренный id
+начиная с курсора: курсор сдвигается вперёд, а left уровня уменьшается на
+каждый пропущенный (уже просмотренный) id, так что и выбор, и размер пула для
+аналитики — O(1) в среднем. Карты, просмотренные в обход колоды (под другими
+фильтрами), вычитаются из left, когда до них дойдёт курсор, — до тех пор
+размер пула слегка завышен.
+
+Колода собирается (за один проход по кандидатам) только когда меняются
+фильтры, версия каталога или эпоха просмотров (глобальный сброс); seed при
+смене каталога сохраняется. Во время онбординга (меньше 5 просмотров)
+колода не используется — там подбор по таблице с жёстким приоритетом видео.
+"""
+import os
+import random
+from array import array
+from bisect import bisect_right
+
+from db.candidate_table import combo_key
+from db.feature_flags import get_flag
+from handlers.user_state import user_data
+
+SELECTION_DECK = os.getenv("SELECTION_DECK", "1") == "1"
+
+# Доля видео при перемешивании уровня (как в _soft_priority_pick)
+DECK_VIDEO_SHARE = 0.7
+
+
+def deck_enabled() -> bool:
+    flag = get_flag("selection_deck")
+    return bool(flag.get("enabled", SELECTION_DECK))
+
+
+def _interleave(video: list, text: list, rng: random.Random) -> list:
+    """Сливает два перемешанных списка: на каждом шаге видео с вероятностью 70%."""
+    out, vi, ti = [], 0, 0
+    while vi < len(video) or ti < len(text):
+        if ti >= len(text) or (vi < len(video) and rng.random() < DECK_VIDEO_SHARE):
+            out.append(video[vi])
+            vi += 1
+        else:
+            out.append(text[ti])
+            ti += 1
+    return out
+
+
+def build_order(levels: tuple, seed: int, epoch: int, seen_ids=()) -> tuple[array, list]:
+    """
+    Перестановка колоды без уже просмотренного: (ids, starts), starts[i] —
+    индекс начала уровня i. Детерминирована по (levels, seed, epoch, seen_ids).
+    """
+    ids, starts = array("i"), []
+    for level, (video_ids, text_ids) in enumerate(levels):
+        rng = random.Random(f"{seed}:{epoch}:{level}")
+        video = [aid for aid in video_ids if aid not in seen_ids]
+        text = [aid for aid in text_ids if aid not in seen_ids]
+        rng.shuffle(video)
+        rng.shuffle(text)
+        starts.append(len(ids))
+        ids.extend(_interleave(video, text, rng))
+    return ids, starts
+
+
+def _new_deck(table, combo: list, filters: tuple, seed: int, epoch: int, seen_ids) -> dict:
+    ids, starts = build_order(table.get(*filters), seed, epoch, seen_ids)
+    ends = starts[1:] + [len(ids)]
+    return {
+        "combo": combo, "version": table.version, "epoch": epoch, "seed": seed,
+        "order": ids, "starts": starts,
+        "left": [end - start for start, end in zip(starts, ends)],
+        "cursor": 0,
+    }
+
+
+def deck_pick(user_id: int, table, filters: tuple, seen_ids, epoch: int):
+    """
+    (активность, уровень, непросмотренных на уровне) — следующая карта колоды,
+    или None, если колода кончилась (тогда подбор идёт обычным путём, включая сброс).
+    Курсор ставится на выданную карту, а не за неё: повторный вызов до
+    record_seen (префетч) вернёт ту же активность.
+    """
+    ctx = user_data.get(user_id)
+    if ctx is None:
+        return None
+
+    combo = list(combo_key(*filters))
+    deck = ctx.get("deck")
+    if (not deck or "order" not in deck or deck.get("combo") != combo
+            or deck.get("version") != table.version or deck.get("epoch") != epoch):
+        seed = deck["seed"] if deck and deck.get("combo") == combo else random.getrandbits(32)
+        deck = _new_deck(table, combo, filters, seed, epoch, seen_ids)
+
+    ids, starts = deck["order"], deck["starts"]
+    left = list(deck["left"])  # копия: колоду может параллельно читать префетч
+    cursor = deck["cursor"]
+    while cursor < len(ids):
+        activity_id = ids[cursor]
+        level = bisect_right(starts, cursor) - 1
+        if activity_id not in seen_ids:
+            ctx["deck"] = {**deck, "left": left, "cursor": cursor}
+            return table.activity(activity_id), level, left[level]
+        left[level] -= 1
+        cursor += 1
+
+    # колода пройдена: дальше сброс истории, после него колода соберётся заново
+    # (без миграции seen_epochs эпоха при сбросе не меняется — поэтому без order)
+    ctx["deck"] = {"combo": combo, "version": table.version, "epoch": epoch, "seed": deck["seed"]}
+    return None
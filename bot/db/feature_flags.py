@@ -1,33 +1,94 @@
 import time
+import asyncio
+import threading
 from db.supabase_client import supabase
+from utils.logger import setup_logger
 
-# Простое кэширование фич-флагов в памяти
-_CACHE = {"data": {}, "ts": 0}
+logger = setup_logger()
+
+# ============================================================
+#   КЭШ ФИЧ-ФЛАГОВ
+#   Обновляется фоном (run_flag_refresher), запросы никогда не ждут БД.
+#   Если загрузка упала — продолжаем отдавать последние известные значения.
+#   Без фоновой задачи (скрипты из tools/) — синхронная перезагрузка по TTL.
+# ============================================================
+_CACHE = {"data": {}, "ts": 0, "version": 0, "loaded": False}
 CACHE_TTL_SECONDS = 30  # обновляем кэш не чаще, чем раз в 30 секунд
 
+_refresh_lock = threading.Lock()
+_refresher_running = False
+
 
 def _load_flags_from_db() -> dict:
-    """Загружает все фичи из Supabase одним запросом."""
-    try:
-        resp = supabase.table("feature_flags").select("*").execute()
-        data = {}
-        for row in resp.data or []:
-            key = row.get("key")
-            val = row.get("value_json") or {}
-            if key:
-                data[key] = val
-        return data
-    except Exception:
-        return {}
+    """Загружает все фичи из Supabase одним запросом. Ошибки пробрасывает наверх."""
+    resp = supabase.table("feature_flags").select("*").execute()
+    data = {}
+    for row in resp.data or []:
+        key = row.get("key")
+        val = row.get("value_json") or {}
+        if key:
+            data[key] = val
+    return data
+
+
+def refresh_flags() -> bool:
+    """
+    Перечитывает флаги. True — если что-то поменялось (тогда растёт flags_version()).
+    При ошибке кэш не трогаем (stale-while-revalidate).
+    """
+    with _refresh_lock:
+        try:
+            data = _load_flags_from_db()
+        except Exception as e:
+            logger.warning(f"[feature_flags] ⚠️ reload failed, serving stale: {e}")
+            # не долбим БД на каждом вызове — следующая попытка через TTL
+            _CACHE["ts"] = time.time()
+            return False
+
+        changed = data != _CACHE["data"]
+        if changed:
+            _CACHE["data"] = data
+            _CACHE["version"] += 1
+        _CACHE["ts"] = time.time()
+        _CACHE["loaded"] = True
+        return changed
 
 
 def _ensure_cache():
-    now = time.time()
-    if (now - _CACHE["ts"] > CACHE_TTL_SECONDS) or not _CACHE["data"]:
-        _CACHE["data"] = _load_flags_from_db()
-        _CACHE["ts"] = now
+    # с фоновой задачей синхронно грузим только самый первый раз
+    if _refresher_running and _CACHE["loaded"]:
+        return
+    if time.time() - _CACHE["ts"] > CACHE_TTL_SECONDS:
+        refresh_flags()
+
+
+async def run_flag_refresher():
+    """Фоновая задача: держит флаги свежими, не блокируя хэндлеры."""
+    global _refresher_running
+    from db.async_repo import run_db
+
+    _refresher_running = True
+    try:
+        while True:
+            try:
+                await run_db(refresh_flags)
+            except Exception as e:
+                logger.warning(f"[feature_flags] ❌ Refresh error: {e}")
+            await asyncio.sleep(CACHE_TTL_SECONDS)
+    finally:
+        _refresher_running = False
+
+
+def flags_version() -> int:
+    """Растёт при каждом изменении набора флагов — для производных кэшей."""
+    _ensure_cache()
+    return _CACHE["version"]
 
 
+# ============================================================
+#   ДОСТУП К ФЛАГАМ
+# ============================================================
+
 def get_flag(key: str, default: dict | None = None) -> dict:
     """Возвращает значение фичи по ключу (или default)."""
     _ensure_cache()
@@ -35,6 +96,50 @@ def get_flag(key: str, default: dict | None = None) -> dict:
     return val if isinstance(val, dict) else (default or {})
 
 
+def require_flag(key: str) -> dict:
+    """Как get_flag, но без флага работать нельзя (ключи оплаты, реквизиты)."""
+    _ensure_cache()
+    val = _CACHE["data"].get(key)
+    if not isinstance(val, dict) or not val:
+        raise RuntimeError(f"feature_flags: key '{key}' not found")
+    return val
+
+
+def _lookup(cfg, path: str):
+    for part in path.split("."):
+        if not isinstance(cfg, dict):
+            return None
+        cfg = cfg.get(part)
+    return cfg
+
+
+def int_value(cfg: dict | None, path: str, default: int) -> int:
+    """
+    Целое из уже полученного значения флага. path — поле или путь через точку
+    ("delivery.workers"). Нет поля / мусор в нём — default.
+    """
+    value = _lookup(cfg or {}, path)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def bool_value(cfg: dict | None, path: str, default: bool) -> bool:
+    value = _lookup(cfg or {}, path)
+    return default if value is None else bool(value)
+
+
+def get_int(key: str, field: str, default: int) -> int:
+    return int_value(get_flag(key), field, default)
+
+
+def get_bool(key: str, field: str, default: bool) -> bool:
+    return bool_value(get_flag(key), field, default)
+
+
 def is_enabled(key: str, default: bool = True) -> bool:
     """Быстрая проверка включённости фичи (через поле enabled)."""
     flag = get_flag(key)
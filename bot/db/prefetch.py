@@ -0,0 +1,117 @@
+# db/prefetch.py
+"""
+Префетч следующей идеи.
+
+Пока юзер читает карточку, следующую активность подбираем в фоне под текущие
+фильтры и кладём в слот юзера. Тап «Следующую» забирает её из слота без подбора,
+и на главном цикле остаётся один вызов Telegram (статус «в любимых» для
+карточки тоже подтягивается заранее).
+
+Слот действителен, только пока не изменилось ничего, от чего зависит подбор:
+фильтры, история просмотров (SeenState.version), доступ (Entitlement.is_gated)
+и версия каталога. Иначе он просто выбрасывается и подбор идёт как обычно.
+Префетч никогда не сбрасывает историю — сброс делает только живой подбор.
+"""
+import asyncio
+import threading
+from collections import OrderedDict
+
+from db.activity_catalog import activity_catalog
+from db.async_repo import run_db, is_favorite
+from db.seen import get_next_activity_with_filters, SelectionResult
+from db.seen_state import get_seen_state
+from utils.entitlements import get_entitlement
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+# Потолок числа слотов (старые вытесняются первыми)
+PREFETCH_MAX_SLOTS = 20000
+
+FILTER_KEYS = ("age_min", "age_max", "time_required", "energy", "location")
+
+_lock = threading.Lock()
+_SLOTS: OrderedDict = OrderedDict()
+_inflight: set[int] = set()
+
+
+def filters_key(ctx: dict) -> tuple:
+    return tuple(ctx.get(k) for k in FILTER_KEYS)
+
+
+def _fingerprint(user_id: int, filters: tuple) -> tuple:
+    """Всё, от чего зависит результат подбора."""
+    return (
+        filters,
+        get_seen_state(user_id).version,
+        get_entitlement(user_id).is_gated(),
+        activity_catalog.version,
+    )
+
+
+def prefetch_next(user_id: int, filters: tuple):
+    """Подбирает следующую активность (синхронно, через run_db). (fingerprint, SelectionResult) или None."""
+    fingerprint = _fingerprint(user_id, filters)
+    age_min, age_max, time_required, energy, location = filters
+
+    selection = get_next_activity_with_filters(
+        user_id=user_id,
+        age_min=int(age_min),
+        age_max=int(age_max),
+        time_required=time_required,
+        energy=energy,
+        location=location,
+        allow_reset=False,
+    )
+    if selection is None:
+        return None
+    return fingerprint, selection
+
+
+def _store(user_id: int, slot: tuple):
+    with _lock:
+        _SLOTS[user_id] = slot
+        _SLOTS.move_to_end(user_id)
+        while len(_SLOTS) > PREFETCH_MAX_SLOTS:
+            _SLOTS.popitem(last=False)
+
+
+def take_prefetched(user_id: int, filters: tuple) -> tuple[SelectionResult, bool] | None:
+    """
+    (SelectionResult, is_favorite) из слота, если подбор всё ещё актуален.
+    Слот при этом очищается.
+    """
+    with _lock:
+        slot = _SLOTS.pop(user_id, None)
+    if slot is None:
+        return None
+    fingerprint, selection, favorite = slot
+    if fingerprint != _fingerprint(user_id, filters):
+        return None
+    return selection, favorite
+
+
+def drop_prefetched(user_id: int):
+    with _lock:
+        _SLOTS.pop(user_id, None)
+
+
+async def _run_prefetch(user_id: int, filters: tuple):
+    try:
+        picked = await run_db(prefetch_next, user_id, filters)
+        if picked is not None:
+            fingerprint, selection = picked
+            favorite = await is_favorite(user_id, selection.activity_id)
+            _store(user_id, (fingerprint, selection, favorite))
+    except Exception as e:
+        logger.warning(f"[prefetch] ❌ user={user_id}: {e}")
+    finally:
+        _inflight.discard(user_id)
+
+
+def schedule_prefetch(user_id: int, ctx: dict):
+    """Запускает фоновый префетч после показа карточки (не чаще одного на юзера)."""
+    if user_id in _inflight:
+        return
+    _inflight.add(user_id)
+    asyncio.create_task(_run_prefetch(user_id, filters_key(ctx)))
@@ -1,29 +1,33 @@
+import os
 from datetime import datetime
-from db.supabase_client import supabase, TIME_MAP, ENERGY_MAP, location_MAP
+from db.supabase_client import TIME_MAP, ENERGY_MAP, location_MAP
+from db.activity_catalog import activity_catalog
+from db.catalog_index import norm_value, split_multivalue
+from db.seen_state import get_seen_state, reset_seen
+from db.catalog_arrays import get_catalog_arrays, bucket_first_level
+from db.feature_flags import get_flag
 import logging
 from random import choice, random
 
 
-def _norm(s):
-    return s.lower().strip() if isinstance(s, str) else ""
+# Движок подбора: "table" — материализованные списки (db/candidate_table),
+# "numpy" — маски над колонками (db/catalog_arrays), "python" — проход по пулу.
+# Все три дают одинаковый результат при одном состоянии random.
+# С "table" после онбординга карты идут из колоды юзера (db/deck, SELECTION_DECK).
+SELECTION_ENGINE = os.getenv("SELECTION_ENGINE", "table")
+
+
+def selection_engine() -> str:
+    return get_flag("selection_engine").get("engine") or SELECTION_ENGINE
 
 
 def _matches_multivalue(user_value: str, activity_value: str) -> bool:
+    """Точное совпадение с одним из значений активности (значения через запятую)."""
     if not activity_value:
         return False
     if not user_value:
         return True
-    return _norm(user_value) in _norm(activity_value)
-
-
-def _check_age_overlap(user_min, user_max, act_min, act_max):
-    if act_min is None or act_max is None: return False
-    if user_min is None or user_max is None: return True
-    try:
-        act_min, act_max = int(act_min), int(act_max)
-    except ValueError:
-        return False
-    return not (act_max < user_min or act_min > user_max)
+    return norm_value(user_value) in split_multivalue(activity_value)
 
 
 def _has_video(activity: dict) -> bool:
@@ -34,12 +38,196 @@ def _has_video(activity: dict) -> bool:
     return (len(vid_dev) > 5) or (len(vid_prod) > 5)
 
 
+# Стратегии смягчения фильтров: (название, возраст, время, энергия, место).
+# Каждая следующая — ослабление предыдущей, поэтому активность относится
+# к самой строгой стратегии, под которую подходит.
+STRATEGIES = [
+    ("1. Строгое совпадение", True, True, True, True),
+    ("2. Игнорируем время ⏳", True, False, True, True),
+    ("3. Игнорируем время+энергию ⚡️", True, False, False, True),
+    ("4. Игнорируем возраст (только место) 🌍", False, False, False, True),
+    ("5. Показать любую доступную 🎲", False, False, False, False)
+]
+
+
+def _strategy_level(activity_id: int, facet_sets) -> int:
+    """Индекс самой строгой стратегии, под которую подходит активность."""
+    age_ok, time_ok, energy_ok, loc_ok = facet_sets
+    for level, (_, use_age, use_time, use_energy, use_loc) in enumerate(STRATEGIES):
+        if use_age and activity_id not in age_ok: continue
+        if use_time and activity_id not in time_ok: continue
+        if use_energy and activity_id not in energy_ok: continue
+        if use_loc and activity_id not in loc_ok: continue
+        return level
+    return len(STRATEGIES) - 1
+
+
+def _bucket_by_level(candidates_pool: list[dict], facet_sets):
+    """
+    Один проход по пулу: раскладываем кандидатов по уровням стратегий,
+    внутри уровня — отдельно видео и текст (порядок пула сохраняется).
+    """
+    video_buckets = [[] for _ in STRATEGIES]
+    text_buckets = [[] for _ in STRATEGIES]
+    for a in candidates_pool:
+        level = _strategy_level(a["id"], facet_sets)
+        if _has_video(a):
+            video_buckets[level].append(a)
+        else:
+            text_buckets[level].append(a)
+    return video_buckets, text_buckets
+
+
+def _soft_priority_pick(video_matches: list, text_matches: list):
+    """=== SOFT PRIORITY LOGIC (70/30) ==="""
+    # 1. Если есть только один тип контента — выбора нет
+    if not video_matches:
+        logging.info(f"[⚖️ ВЫБОР] Только текст. (Видео нет в этой выборке)")
+        return choice(text_matches)
+    if not text_matches:
+        logging.info(f"[⚖️ ВЫБОР] Только видео. (Текста нет в этой выборке)")
+        return choice(video_matches)
+
+    # 2. Если есть и то и другое — кидаем кубик
+    # 0.7 = 70% вероятность выбрать видео
+    if random() < 0.7:
+        logging.info(f"[⚖️ ВЫБОР] 🎲 Выпало ВИДЕО (Вероятность 70%)")
+        return choice(video_matches)
+    logging.info(f"[⚖️ ВЫБОР] 🎲 Выпал ТЕКСТ (Вероятность 30%)")
+    return choice(text_matches)
+
+
+def _pick_python(all_activities: list[dict], seen_ids, force_video_onboarding: bool, filters):
+    """(активность, уровень стратегии, размер корзины) или None, если подбирать не из чего."""
+    age_min, age_max, mapped_time, mapped_energy, mapped_location = filters
+    candidates_pool = []
+
+    # Формируем пул кандидатов
+    for a in all_activities:
+        if a["id"] in seen_ids: continue
+
+        # Если это онбординг, мы жестко фильтруем без видео
+        if force_video_onboarding:
+            if not _has_video(a):
+                continue
+
+        candidates_pool.append(a)
+
+    # Лог размера пула
+    pool_ids = [a['id'] for a in candidates_pool]
+    # Ограничиваем вывод ID в лог, чтобы не спамить
+    preview = str(pool_ids[:10]) + ("..." if len(pool_ids) > 10 else "")
+    logging.info(f"[🎱 ПУЛ] Кандидатов: {len(pool_ids)}. Первые ID: {preview}")
+
+    # Fallback для онбординга: если с видео совсем пусто, снимаем блок
+    if force_video_onboarding and not candidates_pool:
+        logging.warning("[⚠️ ВНИМАНИЕ] Идеи с видео закончились! Снимаем ограничение новичка.")
+        candidates_pool = [a for a in all_activities if a["id"] not in seen_ids]
+
+    # 3. Smart Fallback + Soft Priority — один проход по пулу
+    index = activity_catalog.index
+    facet_sets = (
+        index.age_ids(age_min, age_max),
+        index.facet_ids("time_required", mapped_time),
+        index.facet_ids("energy", mapped_energy),
+        index.facet_ids("location", mapped_location),
+    )
+    video_buckets, text_buckets = _bucket_by_level(candidates_pool, facet_sets)
+
+    for level in range(len(STRATEGIES)):
+        video_matches = video_buckets[level]
+        text_matches = text_buckets[level]
+        if not video_matches and not text_matches:
+            continue
+        final_choice = _soft_priority_pick(video_matches, text_matches)
+        return final_choice, level, len(video_matches) + len(text_matches)
+    return None
+
+
+def _pick_table(table, seen_ids, force_video_onboarding: bool, filters):
+    """
+    То же, что _pick_python, но по готовым спискам кандидатов комбинации:
+    «список минус просмотренное», уровень за уровнем.
+    """
+    levels = table.get(*filters)
+
+    def scan(with_text: bool):
+        for level, (video_ids, text_ids) in enumerate(levels):
+            video = [aid for aid in video_ids if aid not in seen_ids]
+            text = [aid for aid in text_ids if aid not in seen_ids] if with_text else []
+            if video or text:
+                return level, video, text
+        return None
+
+    found = scan(with_text=not force_video_onboarding)
+    if found is None and force_video_onboarding:
+        # уровни покрывают весь каталог, значит непросмотренных видео нет вообще
+        logging.warning("[⚠️ ВНИМАНИЕ] Идеи с видео закончились! Снимаем ограничение новичка.")
+        found = scan(with_text=True)
+    if found is None:
+        return None
+
+    level, video, text = found
+    activity_id = _soft_priority_pick(video, text)
+    return table.activity(activity_id), level, len(video) + len(text)
+
+
+def _pick_numpy(arrays, seen_ids, force_video_onboarding: bool, filters):
+    """
+    То же, что _pick_python, но пул и корзины считаются масками (db/catalog_arrays).
+    Корзины — позиции в каталоге в том же порядке, поэтому _soft_priority_pick
+    делает те же вызовы random и выбирает ту же активность.
+    """
+    picked = bucket_first_level(arrays, STRATEGIES, seen_ids, force_video_onboarding, *filters)
+    if picked is None:
+        return None
+    level, video_positions, text_positions = picked
+    position = _soft_priority_pick(video_positions, text_positions)
+    return arrays.activities[position], level, len(video_positions) + len(text_positions)
+
+
+class SelectionResult:
+    """
+    Результат подбора: сама активность (dict из каталога) + метаданные для аналитики.
+    level — индекс стратегии в STRATEGIES, pool_size — сколько кандидатов было на этом уровне.
+    """
+
+    __slots__ = ("activity", "level", "level_name", "pool_size", "was_reset")
+
+    def __init__(self, activity: dict, level: int, pool_size: int, was_reset: bool = False):
+        self.activity = activity
+        self.level = level
+        self.level_name = STRATEGIES[level][0]
+        self.pool_size = pool_size
+        self.was_reset = was_reset
+
+    @property
+    def activity_id(self) -> int:
+        return self.activity["id"]
+
+    def analytics(self) -> dict:
+        """Свойства для событий show_activity_*."""
+        return {
+            "selection_level": self.level + 1,
+            "selection_pool_size": self.pool_size,
+            "selection_was_reset": self.was_reset,
+        }
+
+
 def get_next_activity_with_filters(user_id: int,
                                    age_min: int,
                                    age_max: int,
                                    time_required: str,
                                    energy: str,
-                                   location: str):
+                                   location: str,
+                                   allow_reset: bool = True,
+                                   _was_reset: bool = False) -> SelectionResult | None:
+    """
+    Следующая активность под фильтры или None, если подбирать не из чего.
+    Когда непросмотренное закончилось, история сбрасывается и подбор повторяется
+    один раз (was_reset=True). allow_reset=False — для фонового префетча:
+    тогда вместо сброса просто возвращаем None.
+    """
 
     # 0. Инфо
     logging.info(
@@ -52,11 +240,10 @@ def get_next_activity_with_filters(user_id: int,
     mapped_location = location_MAP.get(location, location)
 
     # 1. Загрузка данных
-    activities_resp = supabase.table("activities").select("*").execute()
-    all_activities = activities_resp.data or []
+    all_activities = activity_catalog.all()
 
-    seen_resp = supabase.table("seen_activities").select("activity_id").eq("user_id", user_id).execute()
-    seen_ids = set(row["activity_id"] for row in (seen_resp.data or []))
+    seen_state = get_seen_state(user_id)
+    seen_ids = seen_state.ids
 
     # 2. Логика Новичка (Onboarding: первые 5 идей)
     force_video_onboarding = len(seen_ids) < 5
@@ -64,86 +251,39 @@ def get_next_activity_with_filters(user_id: int,
     if force_video_onboarding:
         logging.info(f"[👶 НОВИЧОК] Просмотрено: {len(seen_ids)}. Режим: СТРОГО ВИДЕО 🎥")
 
-    candidates_pool = []
-
-    # Формируем пул кандидатов
-    for a in all_activities:
-        if a["id"] in seen_ids: continue
-
-        # Если это онбординг, мы жестко фильтруем без видео
-        if force_video_onboarding:
-            if not _has_video(a):
-                continue
-
-        candidates_pool.append(a)
-
-    # Лог размера пула
-    pool_ids = [a['id'] for a in candidates_pool]
-    # Ограничиваем вывод ID в лог, чтобы не спамить
-    preview = str(pool_ids[:10]) + ("..." if len(pool_ids) > 10 else "")
-    logging.info(f"[🎱 ПУЛ] Кандидатов: {len(pool_ids)}. Первые ID: {preview}")
-
-    # Fallback для онбординга: если с видео совсем пусто, снимаем блок
-    if force_video_onboarding and not candidates_pool:
-        logging.warning("[⚠️ ВНИМАНИЕ] Идеи с видео закончились! Снимаем ограничение новичка.")
-        candidates_pool = [a for a in all_activities if a["id"] not in seen_ids]
-
-    # 3. Smart Fallback Loop + Soft Priority
-    strategies = [
-        ("1. Строгое совпадение", True, True, True, True),
-        ("2. Игнорируем время ⏳", True, False, True, True),
-        ("3. Игнорируем время+энергию ⚡️", True, False, False, True),
-        ("4. Игнорируем возраст (только место) 🌍", False, False, False, True),
-        ("5. Показать любую доступную 🎲", False, False, False, False)
-    ]
-
-    selected_id = None
-
-    for name, use_age, use_time, use_energy, use_loc in strategies:
-        matches = []
-        for a in candidates_pool:
-            if use_age and not _check_age_overlap(age_min, age_max, a.get("age_min"), a.get("age_max")): continue
-            if use_time and not _matches_multivalue(mapped_time, a.get("time_required")): continue
-            if use_energy and not _matches_multivalue(mapped_energy, a.get("energy")): continue
-            if use_loc and not _matches_multivalue(mapped_location, a.get("location")): continue
-
-            # Сохраняем весь объект активности, чтобы потом проверить видео
-            matches.append(a)
-
-        if matches:
-            # === SOFT PRIORITY LOGIC (70/30) ===
-            video_matches = [m for m in matches if _has_video(m)]
-            text_matches = [m for m in matches if not _has_video(m)]
-
-            final_choice = None
-
-            # 1. Если есть только один тип контента — выбора нет
-            if not video_matches:
-                final_choice = choice(text_matches)
-                logging.info(f"[⚖️ ВЫБОР] Только текст. (Видео нет в этой выборке)")
-            elif not text_matches:
-                final_choice = choice(video_matches)
-                logging.info(f"[⚖️ ВЫБОР] Только видео. (Текста нет в этой выборке)")
-            else:
-                # 2. Если есть и то и другое — кидаем кубик
-                # 0.7 = 70% вероятность выбрать видео
-                if random() < 0.7:
-                    final_choice = choice(video_matches)
-                    logging.info(f"[⚖️ ВЫБОР] 🎲 Выпало ВИДЕО (Вероятность 70%)")
-                else:
-                    final_choice = choice(text_matches)
-                    logging.info(f"[⚖️ ВЫБОР] 🎲 Выпал ТЕКСТ (Вероятность 30%)")
-
-            selected_id = final_choice["id"]
-
-            logging.info(f"[✅ НАЙДЕНО] Стратегия: '{name}'. Кандидатов: {len(matches)}. Выбран ID: {selected_id}")
-            break
-
-    if selected_id:
-        return selected_id, False
+    filters = (age_min, age_max, mapped_time, mapped_energy, mapped_location)
+    engine = selection_engine()
+    arrays = get_catalog_arrays(all_activities, _has_video) if engine == "numpy" else None
+    # Колода юзера (db/deck): после онбординга — следующая карта по курсору
+    picked = None
+    if not force_video_onboarding and engine == "table":
+        from db.deck import deck_enabled, deck_pick  # deck -> candidate_table -> db.seen
+        if deck_enabled():
+            picked = deck_pick(user_id, activity_catalog.candidates, filters, seen_ids, seen_state.epoch)
+
+    if picked is None:
+        if arrays is not None:
+            picked = _pick_numpy(arrays, seen_ids, force_video_onboarding, filters)
+        elif engine == "table":
+            picked = _pick_table(activity_catalog.candidates, seen_ids, force_video_onboarding, filters)
+        else:
+            picked = _pick_python(all_activities, seen_ids, force_video_onboarding, filters)
+
+    if picked is not None:
+        final_choice, level, pool_size = picked
+        logging.info(
+            f"[✅ НАЙДЕНО] Стратегия: '{STRATEGIES[level][0]}'. "
+            f"Кандидатов: {pool_size}. Выбран ID: {final_choice['id']}"
+        )
+        return SelectionResult(final_choice, level, pool_size, _was_reset)
+
+    if not allow_reset or _was_reset or not all_activities:
+        # префетч не сбрасывает историю; после сброса (или на пустом каталоге) — сдаёмся
+        return None
 
     # 4. Глобальный сброс
-    logging.info("[♻️ ГЛОБАЛЬНЫЙ СБРОС] Просмотрено вообще всё. Очистка истории.")
-    supabase.table("seen_activities").delete().eq("user_id", user_id).execute()
+    logging.info("[♻️ ГЛОБАЛЬНЫЙ СБРОС] Просмотрено вообще всё. Начинаем новую эпоху истории.")
+    reset_seen(user_id)
     logging.info("[🔄 РЕСТАРТ] Поиск заново...")
-    return get_next_activity_with_filters(user_id, age_min, age_max, time_required, energy, location)
\ No newline at end of file
+    return get_next_activity_with_filters(user_id, age_min, age_max, time_required, energy, location,
+                                          _was_reset=True)
@@ -0,0 +1,309 @@
+# db/seen_state.py
+import asyncio
+import itertools
+import threading
+
+from db.supabase_client import supabase
+from db.async_repo import run_db, is_missing_object_error
+from handlers.user_state import user_data, USER_STATE_MAX_USERS
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+# Как часто сбрасываем накопленные просмотры в seen_activities
+SEEN_FLUSH_SECONDS = 2
+# Сколько строк максимум в одном bulk upsert
+SEEN_FLUSH_BATCH = 500
+# После стольких отказов БД на одну строку просмотра она выбрасывается
+SEEN_FLUSH_MAX_ATTEMPTS = 5
+# Сколько раз пробуем bump_seen_epoch, прежде чем отдать ошибку наверх
+SEEN_RESET_ATTEMPTS = 2
+
+
+class SeenState:
+    """
+    Что юзер уже видел: activity_id -> level ('l0' | 'l1') + счётчики по уровням.
+
+    Повторяет семантику upsert в seen_activities: одна строка на (user_id, activity_id, epoch),
+    последний просмотр перезаписывает уровень. Состояние — только текущей эпохи
+    юзера (см. reset_seen и db/sql/seen_epochs.sql).
+
+    version — глобально уникальный номер: меняется при каждом новом id в истории,
+    а сброс / перезагрузка создают новое состояние с новым номером. По нему
+    производные кэши (префетч следующей идеи) понимают, что история поменялась.
+    """
+
+    __slots__ = ("user_id", "session_id", "epoch", "levels", "l0_count", "l1_count", "version")
+
+    def __init__(self, user_id: int, session_id: str | None, levels: dict[int, str], epoch: int = 0):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.epoch = epoch
+        self.levels = levels
+        self.l0_count = sum(1 for lvl in levels.values() if lvl == "l0")
+        self.l1_count = sum(1 for lvl in levels.values() if lvl == "l1")
+        self.version = next(_versions)
+
+    @property
+    def ids(self):
+        return self.levels.keys()
+
+    def record(self, activity_id: int, level: str):
+        prev = self.levels.get(activity_id)
+        if prev == level:
+            return
+        if prev is None:
+            self.version = next(_versions)
+        if prev == "l0":
+            self.l0_count -= 1
+        elif prev == "l1":
+            self.l1_count -= 1
+        self.levels[activity_id] = level
+        if level == "l0":
+            self.l0_count += 1
+        elif level == "l1":
+            self.l1_count += 1
+
+
+_versions = itertools.count(1)
+_lock = threading.Lock()
+# Состояние держим, пока в памяти контекст юзера: выселение user_data сбрасывает
+# и его (_forget_states). Потолок — на процессы без user_data (воркеры): там
+# вытесняются загруженные раньше всех. Недописанное в _PENDING не теряется.
+_STATES: dict[int, SeenState] = {}
+# (user_id, activity_id, epoch) -> строка для upsert; последняя запись побеждает
+_PENDING: dict[tuple[int, int, int], dict] = {}
+# ключ _PENDING -> сколько раз БД уже отвергла эту строку (только пишущий поток)
+_ATTEMPTS: dict[tuple[int, int, int], int] = {}
+
+# Пока миграция seen_epochs.sql не применена — работаем по-старому:
+# без колонки epoch, а сброс удаляет историю. Выключается только ошибкой
+# «таблицы / функции нет», сетевые сбои флаг не трогают.
+_epochs_supported = True
+
+
+def _load_epoch(user_id: int) -> int:
+    global _epochs_supported
+    if not _epochs_supported:
+        return 0
+    try:
+        resp = (
+            supabase.table("seen_epochs")
+            .select("epoch")
+            .eq("user_id", user_id)
+            .limit(1)
+            .execute()
+        )
+    except Exception as e:
+        if not is_missing_object_error(e):
+            # сбой сети / таймаут: эпохи не выключаем, эта загрузка просто не удалась
+            raise
+        logger.warning(f"[seen_state] ⚠️ seen_epochs не найдена, работаем без эпох: {e}")
+        _epochs_supported = False
+        return 0
+    return int(resp.data[0]["epoch"]) if resp.data else 0
+
+
+def _load_state(user_id: int, session_id: str | None) -> SeenState:
+    epoch = _load_epoch(user_id)
+    query = (
+        supabase.table("seen_activities")
+        .select("activity_id, level")
+        .eq("user_id", user_id)
+    )
+    if _epochs_supported:
+        query = query.eq("epoch", epoch)
+    resp = query.execute()
+    levels = {row["activity_id"]: row.get("level") for row in (resp.data or [])}
+
+    with _lock:
+        # то, что ещё не долетело до БД, накладываем поверх
+        for (uid, aid, row_epoch), row in _PENDING.items():
+            if uid == user_id and row_epoch == epoch:
+                levels[aid] = row.get("level")
+        state = SeenState(user_id, session_id, levels, epoch)
+        _STATES.pop(user_id, None)
+        _STATES[user_id] = state
+        while len(_STATES) > USER_STATE_MAX_USERS:
+            del _STATES[next(iter(_STATES))]
+    return state
+
+
+def _forget_states(user_ids):
+    """Слушатель выселения user_data: следующий get_seen_state перечитает из БД."""
+    with _lock:
+        for user_id in user_ids:
+            _STATES.pop(user_id, None)
+
+
+user_data.add_evict_listener(_forget_states)
+
+
+def get_seen_state(user_id: int) -> SeenState:
+    """
+    Состояние просмотров юзера. Грузится из БД один раз на сессию,
+    дальше обновляется локально через record_seen().
+    """
+    session_id = (user_data.get(user_id) or {}).get("session_id")
+    state = _STATES.get(user_id)
+    if state is None or (session_id and state.session_id != session_id):
+        state = _load_state(user_id, session_id)
+    return state
+
+
+def record_seen(row: dict):
+    """
+    Фиксирует просмотр: сразу в памяти, в seen_activities — фоном (write-behind).
+    row — та же строка, что раньше уходила в upsert (user_id, activity_id, level, ...).
+    """
+    user_id = row["user_id"]
+    activity_id = row["activity_id"]
+    state = get_seen_state(user_id)
+    if _epochs_supported:
+        row = {**row, "epoch": state.epoch}
+    with _lock:
+        state.record(activity_id, row.get("level"))
+        _PENDING[(user_id, activity_id, state.epoch)] = row
+
+
+def _bump_epoch(user_id: int) -> int | None:
+    """
+    Новая эпоха юзера через RPC bump_seen_epoch. None — функции нет (миграция
+    не применена). Прочие ошибки повторяем и, если не вышло, пробрасываем.
+    """
+    global _epochs_supported
+    for attempt in range(1, SEEN_RESET_ATTEMPTS + 1):
+        try:
+            resp = supabase.rpc("bump_seen_epoch", {"p_user_id": user_id}).execute()
+            return int(resp.data)
+        except Exception as e:
+            if is_missing_object_error(e):
+                logger.warning(f"[seen_state] ⚠️ bump_seen_epoch не найдена, работаем без эпох: {e}")
+                _epochs_supported = False
+                return None
+            logger.warning(f"[seen_state] ❌ bump_seen_epoch failed user={user_id} "
+                           f"(attempt {attempt}/{SEEN_RESET_ATTEMPTS}): {e}")
+            if attempt == SEEN_RESET_ATTEMPTS:
+                raise
+
+
+def reset_seen(user_id: int):
+    """
+    Глобальный сброс истории юзера: переводим его в следующую эпоху (один RPC).
+    Строки прошлых эпох остаются в seen_activities для аналитики.
+    Удаляем историю, только если миграции seen_epochs.sql нет; при сбое RPC
+    ошибка уходит наверх, а строки и состояние в памяти не трогаем.
+    """
+    state = _STATES.get(user_id)
+    session_id = state.session_id if state is not None else None
+
+    if _epochs_supported:
+        epoch = _bump_epoch(user_id)
+        if epoch is not None:
+            with _lock:
+                _STATES[user_id] = SeenState(user_id, session_id, {}, epoch)
+            return
+
+    with _lock:
+        for key in [k for k in _PENDING if k[0] == user_id]:
+            del _PENDING[key]
+        _STATES[user_id] = SeenState(user_id, session_id, {})
+    supabase.table("seen_activities").delete().eq("user_id", user_id).execute()
+
+
+def _is_row_error(e: Exception) -> bool:
+    """
+    БД ответила ошибкой на сами данные (constraint, FK, формат) — повтор той же
+    строки не поможет. Сеть, таймауты и недоступность PostgREST сюда не относятся.
+    """
+    code = getattr(e, "code", None)
+    if not code:
+        return False
+    return not str(code).startswith(("PGRST0", "57", "08", "53"))
+
+
+def _upsert_rows(rows: list[dict]):
+    if _epochs_supported:
+        supabase.table("seen_activities").upsert(rows, on_conflict="user_id,activity_id,epoch").execute()
+    else:
+        rows = [{k: v for k, v in r.items() if k != "epoch"} for r in rows]
+        supabase.table("seen_activities").upsert(rows).execute()
+
+
+def _flush_one_by_one(items: list[tuple]) -> tuple[int, list[tuple]]:
+    """
+    Пачка не записалась — пишем её строки по одной, чтобы одна «ядовитая»
+    строка не держала остальные. (записано, что вернуть в очередь).
+    Строка, на которую БД отвечает ошибкой SEEN_FLUSH_MAX_ATTEMPTS раз, выбрасывается.
+    При сбое связи дальше не идём: остаток возвращаем целиком, попытки не считаем.
+    """
+    written = 0
+    for pos, (key, row) in enumerate(items):
+        try:
+            _upsert_rows([row])
+        except Exception as e:
+            if not _is_row_error(e):
+                logger.warning(f"[seen_state] ❌ Flush failed ({len(items) - pos} rows), retry later: {e}")
+                return written, items[pos:]
+            attempts = _ATTEMPTS.get(key, 0) + 1
+            if attempts >= SEEN_FLUSH_MAX_ATTEMPTS:
+                _ATTEMPTS.pop(key, None)
+                logger.error(f"[seen_state] 🗑 Dropping seen row after {attempts} attempts {row}: {e}")
+            else:
+                _ATTEMPTS[key] = attempts
+                logger.warning(f"[seen_state] ⚠️ Seen row rejected ({attempts}/{SEEN_FLUSH_MAX_ATTEMPTS}) {row}: {e}")
+                _requeue([(key, row)])
+            continue
+        _ATTEMPTS.pop(key, None)
+        written += 1
+    return written, []
+
+
+def _requeue(items):
+    with _lock:
+        # возвращаем недописанное, не затирая более свежие просмотры
+        for key, row in items:
+            _PENDING.setdefault(key, row)
+
+
+def flush_seen_writes() -> int:
+    """
+    Сбрасывает накопленные просмотры bulk upsert'ами по SEEN_FLUSH_BATCH строк.
+    Упавшую пачку дописываем построчно (_flush_one_by_one).
+    """
+    with _lock:
+        if not _PENDING:
+            return 0
+        batch = list(_PENDING.items())
+        _PENDING.clear()
+
+    written = 0
+    for i in range(0, len(batch), SEEN_FLUSH_BATCH):
+        chunk = batch[i:i + SEEN_FLUSH_BATCH]
+        try:
+            _upsert_rows([row for _, row in chunk])
+        except Exception as e:
+            if not _is_row_error(e):
+                logger.warning(f"[seen_state] ❌ Flush failed ({len(batch) - i} rows), retry later: {e}")
+                _requeue(batch[i:])
+                return written
+            ok, rest = _flush_one_by_one(chunk)
+            written += ok
+            if rest:
+                _requeue(rest + batch[i + SEEN_FLUSH_BATCH:])
+                return written
+            continue
+        for key, _ in chunk:
+            _ATTEMPTS.pop(key, None)
+        written += len(chunk)
+    return written
+
+
+async def run_seen_writer():
+    """Фоновая задача write-behind для seen_activities."""
+    while True:
+        await asyncio.sleep(SEEN_FLUSH_SECONDS)
+        try:
+            await run_db(flush_seen_writes)
+        except Exception as e:
+            logger.warning(f"[seen_state] ❌ Writer error: {e}")
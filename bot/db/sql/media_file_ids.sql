@@ -0,0 +1,15 @@
+-- media_file_ids: file_id, которые Telegram вернул на первую загрузку картинки по URL.
+-- file_id действителен только для того бота, который его получил, поэтому
+-- ключ — хэш токена (bot_key) + окружение. Используется utils/media_registry.
+--
+-- Применить один раз в Supabase SQL Editor.
+
+create table if not exists media_file_ids (
+    bot_key     text        not null,
+    env         text        not null,
+    url         text        not null,
+    kind        text        not null default 'photo',
+    file_id     text        not null,
+    created_at  timestamptz not null default now(),
+    primary key (bot_key, env, url)
+);
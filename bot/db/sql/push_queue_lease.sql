@@ -0,0 +1,72 @@
+-- push_queue: захват пушей воркером с арендой (lease).
+-- Позволяет запускать несколько воркеров параллельно: каждую строку
+-- забирает ровно один из них, а упавший воркер не оставляет строки «висеть».
+--
+-- Применить в Supabase SQL Editor (идемпотентно — после правок просто
+-- выполнить файл ещё раз).
+
+alter table push_queue
+    add column if not exists lease_owner      text,
+    add column if not exists lease_expires_at timestamptz,
+    add column if not exists attempts         integer not null default 0,
+    -- ставится воркером прямо перед вызовом Telegram (mark_push_sending)
+    add column if not exists sending_at       timestamptz;
+
+create index if not exists push_queue_status_scheduled_idx
+    on push_queue (status, scheduled_at);
+
+-- Забирает до p_limit пушей, которые пора отправлять, и помечает их
+-- status='processing' c владельцем и сроком аренды — одним запросом.
+-- Строки с истёкшей арендой (воркер упал посреди пачки) забираются повторно;
+-- после p_max_attempts попыток строка помечается failed, чтобы не слать её бесконечно.
+-- Строку с sending_at (воркер упал между отметкой и финальным апдейтом) повторно
+-- не отдаём: в Telegram она, скорее всего, ушла — at-most-once, считаем отправленной.
+create or replace function claim_push_batch(
+    p_owner          text,
+    p_limit          integer,
+    p_lease_seconds  integer default 300,
+    p_types          text[]  default null,
+    p_max_attempts   integer default 3
+)
+returns setof push_queue
+language plpgsql
+as $$
+begin
+    update push_queue
+       set status = 'sent',
+           sent_at = sending_at,
+           lease_owner = null,
+           lease_expires_at = null
+     where status = 'processing'
+       and lease_expires_at < now()
+       and sending_at is not null;
+
+    update push_queue
+       set status = 'failed',
+           lease_owner = null,
+           lease_expires_at = null
+     where status = 'processing'
+       and lease_expires_at < now()
+       and attempts >= p_max_attempts;
+
+    return query
+    with due as (
+        select id
+          from push_queue
+         where ((status = 'pending' and scheduled_at <= now())
+             or (status = 'processing' and lease_expires_at < now()))
+           and (p_types is null or type = any(p_types))
+         order by scheduled_at
+         limit p_limit
+         for update skip locked
+    )
+    update push_queue q
+       set status = 'processing',
+           lease_owner = p_owner,
+           lease_expires_at = now() + make_interval(secs => p_lease_seconds),
+           attempts = q.attempts + 1
+      from due
+     where q.id = due.id
+    returning q.*;
+end;
+$$;
@@ -0,0 +1,28 @@
+-- push_queue: перенос всех наступивших пушей на утро одним запросом.
+-- Вызывается воркером в тихие часы вместо поштучных update.
+-- Каждая строка получает своё случайное смещение в пределах окна p_ramp_seconds,
+-- чтобы утренняя волна растянулась, а не ударила в Telegram ровно в p_until.
+--
+-- Применить один раз в Supabase SQL Editor.
+
+create or replace function reschedule_quiet_pushes(
+    p_until          timestamptz,
+    p_ramp_seconds   integer default 3600,
+    p_skip_types     text[]  default array['premium_welcome']
+)
+returns integer
+language plpgsql
+as $$
+declare
+    moved integer;
+begin
+    update push_queue
+       set scheduled_at = p_until + make_interval(secs => floor(random() * greatest(p_ramp_seconds, 0)))
+     where status = 'pending'
+       and scheduled_at <= now()
+       and not (type = any(coalesce(p_skip_types, array[]::text[])));
+
+    get diagnostics moved = row_count;
+    return moved;
+end;
+$$;
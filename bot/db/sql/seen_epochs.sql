@@ -0,0 +1,86 @@
+-- seen_activities: эпохи просмотров вместо удаления истории при глобальном сбросе.
+-- Когда юзер посмотрел всё, бот не удаляет его строки, а увеличивает номер эпохи;
+-- подбор и счётчики пейволла учитывают только строки текущей эпохи, а старые
+-- остаются для аналитики. Используется db/seen_state.
+--
+-- Применить один раз в Supabase SQL Editor.
+
+alter table seen_activities
+    add column if not exists epoch integer not null default 0;
+
+-- одна строка на (юзер, активность) в пределах эпохи.
+--
+-- Предположение о старой схеме: уникальность (user_id, activity_id) давал
+-- первичный ключ (на него опирался upsert без on_conflict) или unique-
+-- ограничение / индекс с любым именем. Ищем их в pg_constraint / pg_index
+-- по набору колонок, а не по имени, и снимаем все.
+do $$
+declare
+    pair int2[];
+    r record;
+begin
+    select array_agg(attnum order by attnum) into pair
+    from pg_attribute
+    where attrelid = 'seen_activities'::regclass
+      and attname in ('user_id', 'activity_id');
+
+    for r in
+        select conname from pg_constraint
+        where conrelid = 'seen_activities'::regclass
+          and contype in ('p', 'u')
+          and (select array_agg(k order by k) from unnest(conkey) k) = pair
+    loop
+        execute format('alter table seen_activities drop constraint %I', r.conname);
+    end loop;
+
+    for r in
+        select indexrelid::regclass as idx from pg_index
+        where indrelid = 'seen_activities'::regclass
+          and indisunique
+          and (select array_agg(k order by k) from unnest(indkey::int2[]) k) = pair
+    loop
+        execute format('drop index %s', r.idx);
+    end loop;
+end $$;
+
+-- дубли (если уникальности по факту не было) мешают создать индекс:
+-- оставляем по одной строке на (user_id, activity_id, epoch)
+delete from seen_activities a
+using seen_activities b
+where a.user_id = b.user_id
+  and a.activity_id = b.activity_id
+  and a.epoch = b.epoch
+  and a.ctid < b.ctid;
+
+create unique index if not exists seen_activities_user_activity_epoch_key
+    on seen_activities (user_id, activity_id, epoch);
+
+-- если первичным ключом была пара (user_id, activity_id) — теперь им станет тройка
+do $$
+begin
+    if not exists (
+        select 1 from pg_constraint
+        where conrelid = 'seen_activities'::regclass and contype = 'p'
+    ) then
+        alter table seen_activities
+            add primary key using index seen_activities_user_activity_epoch_key;
+    end if;
+end $$;
+
+create table if not exists seen_epochs (
+    user_id     bigint      primary key,
+    epoch       integer     not null default 0,
+    updated_at  timestamptz not null default now()
+);
+
+-- Переход юзера в следующую эпоху, одним запросом. Возвращает новый номер.
+create or replace function bump_seen_epoch(p_user_id bigint)
+returns integer
+language sql
+as $$
+    insert into seen_epochs as e (user_id, epoch, updated_at)
+    values (p_user_id, 1, now())
+    on conflict (user_id)
+    do update set epoch = e.epoch + 1, updated_at = now()
+    returning epoch;
+$$;
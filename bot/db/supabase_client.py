@@ -35,8 +35,8 @@ def get_activity(age: int, time_required: str, energy: str, location: str):
         f"Фильтры: возраст={age}, время={time_required}, энергия={energy}, локация={location}"
     )
 
-    response = supabase.table("activities").select("*").execute()
-    activities = response.data
+    from db.activity_catalog import activity_catalog
+    activities = activity_catalog.all()
     logging.info(f"Всего активностей в БД: {len(activities)}")
     location_db = location_MAP.get(location, location)
 
@@ -83,22 +83,19 @@ def get_favorites(user_id: int):
     activity_ids = [f["activity_id"] for f in favs.data]
     if not activity_ids:
         return []
-    # Получаем сами активности
-    activities = supabase.table("activities").select("*").in_(
-        "id", activity_ids).execute()
-    # Сортируем в том порядке, как в избранном
-    activities_map = {a["id"]: a for a in activities.data}
-    return [activities_map[i] for i in activity_ids if i in activities_map]
+    # Сами активности берём из каталога, в том порядке, как в избранном
+    from db.activity_catalog import activity_catalog
+    return activity_catalog.get_many(activity_ids)
 
 def get_all_activities(age: int, time_required: str, energy: str, location: str):
     """Возвращает ВСЕ активности, подходящие под фильтры (учитывает множества значений)."""
     from db.seen import _matches_multivalue
+    from db.activity_catalog import activity_catalog
     logging.info(
         f"[TEST] Проверяем все активности: age={age}, time={time_required}, energy={energy}, location={location}"
     )
 
-    response = supabase.table("activities").select("*").execute()
-    activities = response.data
+    activities = activity_catalog.all()
     logging.info(f"[TEST] Всего активностей в БД: {len(activities)}")
 
     filtered = [
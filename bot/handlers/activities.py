@@ -1,95 +1,56 @@
 from aiogram import Router, types, F
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaVideo, InputMediaPhoto
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaVideo
 from aiogram.filters import Command, CommandObject
 from aiogram.exceptions import TelegramBadRequest
-from db.supabase_client import supabase
+from db.activity_catalog import activity_catalog
+from db.async_repo import run_db, is_favorite as repo_is_favorite
 from utils.amplitude_logger import log_event as amplitude_log_event
 from utils.session import ensure_filters
 from .user_state import user_data
-from db.seen import get_next_activity_with_filters
+from db.seen import get_next_activity_with_filters, SelectionResult
+from db.prefetch import take_prefetched, schedule_prefetch, filters_key
+from db.seen_state import record_seen
 from datetime import datetime
 from utils.paywall_guard import should_block_l1, should_block_l0
 from handlers.paywall import send_universal_paywall
 from utils.session_tracker import get_current_session_id
 from config import ENV
-from db.feature_flags import is_enabled, get_flag
+from db.feature_flags import get_flag
+from utils.card_render import render_card, CHUNK_SIZE
+from utils import media_registry
 
 activities_router = Router()
 
-# === КОНСТАНТЫ ===
-# Экранируем подчеркивания для Markdown
-VIRAL_SIGNATURE = "\n\n🏡 Найдено в @blizkie\_igry\_bot"
-
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
 
 def get_activity_by_id(activity_id: int):
-    response = supabase.table("activities").select("*").eq(
-        "id", activity_id).execute()
-    if response.data and len(response.data) > 0:
-        return response.data[0]
-    return None
+    return activity_catalog.get(activity_id)
 
 
-def check_is_favorite(user_id: int, activity_id: int) -> bool:
+async def check_is_favorite(user_id: int, activity_id: int) -> bool:
     try:
-        fav_response = supabase.table("favorites").select("id") \
-            .eq("user_id", user_id).eq("activity_id", activity_id).execute()
-        return len(fav_response.data) > 0
+        return await repo_is_favorite(user_id, activity_id)
     except:
         return False
 
-def get_community_btn():
-    """Вспомогательная функция для получения кнопки клуба по флагу"""
-    if is_enabled("community_club", default=False):
-        config = get_flag("community_club")
-        return [InlineKeyboardButton(text=config.get("text", "Вступить в клуб родителей 🎁"),                    callback_data="community_join")]
-    return None
-
 async def render_l0_card(message_or_callback,
                          activity,
                          user_id,
                          ctx,
-                         is_edit=False):
+                         is_edit=False,
+                         is_favorite=None):
     """
     Единая функция отрисовки L0 (Витрина).
+    is_favorite можно передать заранее (префетч), иначе спросим БД.
     """
-    is_favorite = check_is_favorite(user_id, activity["id"])
-    fav_text = "В любимые ❤️" if not is_favorite else "Убрать из ❤️"
-    fav_callback = f"favorite_add:{activity['id']}" if not is_favorite else f"remove_fav:{activity['id']}"
-
-    # Текст L0 с виральной ссылкой
-    text = (f"🎲 *{activity['title']}*\n\n"
-            f"{activity['short_description']}\n\n"
-            f"💡 {' • '.join(activity['summary'] or [])}\n\n"
-            f"📦 Материалы: {activity['materials'] or 'Не требуются'}"
-            f"{VIRAL_SIGNATURE}")
-
-    kb_rows = [
-        [
-            InlineKeyboardButton(
-                text="Играем ▶️",
-                callback_data=f"activity_details:{activity['id']}")
-        ], 
-        [InlineKeyboardButton(text=fav_text, callback_data=fav_callback)],
-        [
-            InlineKeyboardButton(text="Следующую ⏩️",
-                                 callback_data="activity_next")
-        ]
-    ]
-
-    # Добавляем кнопку клуба, если она включена
-    club_btn = get_community_btn()
-    if club_btn:
-        kb_rows.append(club_btn)
-
-    # Добавляем кнопку фильтров в конец
-    kb_rows.append([
-        InlineKeyboardButton(text="Поменять фильтры 🎛️",
-                             callback_data="update_filters")
-    ])
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=kb_rows)
+    if is_favorite is None:
+        is_favorite = await check_is_favorite(user_id, activity["id"])
+
+    # Текст L0 с виральной ссылкой и клавиатура — из кэша рендера
+    card = render_card(activity, "l0", is_favorite=is_favorite)
+    text = card.text
+    keyboard = card.keyboard
 
     # === ЛОГИКА ВЫБОРА ВИДЕО ===
     video_file_id = None
@@ -128,15 +89,18 @@ async def render_l0_card(message_or_callback,
 
         elif image_url and image_url.strip():
             if is_edit and message.content_type == 'photo':
-                await message.edit_media(media=InputMediaPhoto(
-                    media=image_url, caption=text, parse_mode="Markdown"),
-                                         reply_markup=keyboard)
+                await media_registry.edit_photo(message,
+                                                image_url,
+                                                caption=text,
+                                                parse_mode="Markdown",
+                                                reply_markup=keyboard)
             else:
                 if is_edit: await message.delete()
-                await message.answer_photo(photo=image_url,
-                                           caption=text,
-                                           parse_mode="Markdown",
-                                           reply_markup=keyboard)
+                await media_registry.send_photo(message.answer_photo,
+                                                image_url,
+                                                caption=text,
+                                                parse_mode="Markdown",
+                                                reply_markup=keyboard)
 
         else:
             if is_edit: await message.delete()
@@ -152,6 +116,27 @@ async def render_l0_card(message_or_callback,
                              reply_markup=keyboard)
 
 
+async def select_next_activity(user_id: int, ctx) -> tuple[SelectionResult | None, bool | None]:
+    """
+    (SelectionResult, is_favorite) для следующей L0-карточки.
+    Следующая идея уже могла быть подобрана в фоне, пока юзер читал прошлую;
+    is_favorite = None — статус неизвестен, render_l0_card спросит сам.
+    """
+    prefetched = await run_db(take_prefetched, user_id, filters_key(ctx))
+    if prefetched is not None:
+        return prefetched
+
+    selection = await run_db(
+        get_next_activity_with_filters,
+        user_id=user_id,
+        age_min=int(ctx["age_min"]),
+        age_max=int(ctx["age_max"]),
+        time_required=ctx["time_required"],
+        energy=ctx["energy"],
+        location=ctx["location"])
+    return selection, None
+
+
 # --- ADMIN: /show_activity <ID>
 @activities_router.message(Command("show_activity"))
 async def show_activity_by_id_command(message: types.Message,
@@ -161,7 +146,7 @@ async def show_activity_by_id_command(message: types.Message,
         return
 
     activity_id = int(command.args)
-    activity = get_activity_by_id(activity_id)
+    activity = await run_db(get_activity_by_id, activity_id)
     if not activity:
         await message.answer(f"❌ Активность {activity_id} не найдена.")
         return
@@ -177,39 +162,30 @@ async def show_activity_by_id_command(message: types.Message,
 @activities_router.callback_query(F.data == "activity_start")
 async def send_activity(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    ctx = ensure_filters(user_id)
+    ctx = await ensure_filters(user_id)
     session_id = ctx.get("session_id") or get_current_session_id(user_id)
 
-    if should_block_l0(user_id):
+    if await run_db(should_block_l0, user_id):
         await send_universal_paywall(callback,
                                      reason="l0_limit",
                                      user_id=user_id,
                                      session_id=session_id)
         return
 
-    activity_id, was_reset = get_next_activity_with_filters(
-        user_id=user_id,
-        age_min=int(ctx["age_min"]),
-        age_max=int(ctx["age_max"]),
-        time_required=ctx["time_required"],
-        energy=ctx["energy"],
-        location=ctx["location"])
+    selection, is_favorite = await select_next_activity(user_id, ctx)
 
-    if not activity_id:
+    if selection is None:
         await callback.message.answer(
             "😔 Нет идей для таких условий. Попробуйте изменить фильтры.",
             disable_web_page_preview=True)
         return
 
-    activity = get_activity_by_id(activity_id)
-    if not activity:
-        await callback.message.answer("😔 Ошибка загрузки идеи.",
-                                      disable_web_page_preview=True)
-        return
+    activity = selection.activity
 
-    await render_l0_card(callback, activity, user_id, ctx, is_edit=True)
+    await render_l0_card(callback, activity, user_id, ctx, is_edit=True,
+                         is_favorite=is_favorite)
 
-    supabase.table("seen_activities").upsert({
+    await run_db(record_seen, {
         "user_id":
         user_id,
         "activity_id":
@@ -228,11 +204,15 @@ async def send_activity(callback: types.CallbackQuery):
         "l0",
         "seen_at":
         datetime.now().isoformat()
-    }).execute()
+    })
+    schedule_prefetch(user_id, ctx)
 
     amplitude_log_event(user_id=user_id,
                         event_name="show_activity_L0",
-                        event_properties={"activity_id": activity["id"]},
+                        event_properties={
+                            "activity_id": activity["id"],
+                            **selection.analytics()
+                        },
                         session_id=session_id)
     await callback.answer()
 
@@ -247,33 +227,27 @@ async def show_next_activity(callback: types.CallbackQuery):
 @activities_router.message(Command("next"))
 async def next_command_handler(message: types.Message):
     user_id = message.from_user.id
-    ctx = ensure_filters(user_id)
+    ctx = await ensure_filters(user_id)
     session_id = ctx.get("session_id") or get_current_session_id(user_id)
 
-    if should_block_l0(user_id):
+    if await run_db(should_block_l0, user_id):
         await send_universal_paywall(message,
                                      reason="l0_limit",
                                      user_id=user_id,
                                      session_id=session_id)
         return
 
-    activity_id, _ = get_next_activity_with_filters(
-        user_id=user_id,
-        age_min=int(ctx["age_min"]),
-        age_max=int(ctx["age_max"]),
-        time_required=ctx["time_required"],
-        energy=ctx["energy"],
-        location=ctx["location"])
+    selection, is_favorite = await select_next_activity(user_id, ctx)
 
-    if not activity_id:
+    if selection is None:
         await message.answer("😔 Нет идей для таких условий.",
                              disable_web_page_preview=True)
         return
 
-    activity = get_activity_by_id(activity_id)
-    if not activity: return
+    activity = selection.activity
 
-    await render_l0_card(message, activity, user_id, ctx, is_edit=False)
+    await render_l0_card(message, activity, user_id, ctx, is_edit=False,
+                         is_favorite=is_favorite)
 
     amplitude_log_event(user_id=user_id,
                         event_name="show_activity_L0_next_command",
@@ -283,11 +257,12 @@ async def next_command_handler(message: types.Message):
                             "age_max": ctx["age_max"],
                             "time_required": ctx["time_required"],
                             "energy": ctx["energy"],
-                            "location": ctx["location"]
+                            "location": ctx["location"],
+                            **selection.analytics()
                         },
                         session_id=session_id)
 
-    supabase.table("seen_activities").upsert({
+    await run_db(record_seen, {
         "user_id":
         user_id,
         "activity_id":
@@ -306,18 +281,19 @@ async def next_command_handler(message: types.Message):
         "l0",
         "seen_at":
         datetime.now().isoformat()
-    }).execute()
+    })
+    schedule_prefetch(user_id, ctx)
 
 
 # --- L1: ПРЕВРАЩЕНИЕ В ПОДРОБНУЮ (UPDATE IN PLACE)
 @activities_router.callback_query(F.data.startswith("activity_details:"))
 async def show_activity_details(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    ctx = ensure_filters(user_id)
+    ctx = await ensure_filters(user_id)
     session_id = ctx.get("session_id") or get_current_session_id(user_id)
     activity_id = int(callback.data.split(":")[1])
 
-    if should_block_l1(user_id):
+    if await run_db(should_block_l1, user_id):
         ctx = user_data.setdefault(user_id, {})
         ctx["last_paywall_reason"] = "l1_limit"
         await send_universal_paywall(callback,
@@ -326,110 +302,55 @@ async def show_activity_details(callback: types.CallbackQuery):
                                      session_id=session_id)
         return
 
-    activity = get_activity_by_id(activity_id)
+    activity = await run_db(get_activity_by_id, activity_id)
     if not activity:
         await callback.answer("Ошибка загрузки", show_alert=True)
         return
 
-    is_favorite = check_is_favorite(user_id, activity_id)
+    is_favorite = await check_is_favorite(user_id, activity_id)
 
-    summary = "\n".join([f"💡 {s}" for s in (activity.get("summary") or [])])
-    caption_title = f"🎲 *{activity['title']}*"
-
-    author = activity.get("author")
-    author_url = activity.get("source_url")
-    author_block = ""
-    if author and author_url:
-        author_block = f"\n\n👤 Автор: [{author}]({author_url})"
-
-    ugc_block = "\n\n💡 Есть идея игры? 👉 /suggest"
-
-    full_text = (
-        f"⏱️ {activity['time_required']} • ⚡️ {activity['energy']} • 📍 {activity['location']}\n\n"
-        f"Материалы: {activity['materials'] or 'Не требуются'}\n\n"
-        f"{activity['full_description']}\n\n"
-        f"{summary}"
-        f"{author_block}"
-        f"{VIRAL_SIGNATURE}"
-        f"{ugc_block}")
+    card = render_card(activity, "l1", is_favorite=is_favorite)
+    keyboard = card.keyboard
 
     user_state = user_data.setdefault(user_id, {})
     user_state["current_activity_text"] = {
-        "caption": caption_title,
-        "text": full_text
+        "caption": card.caption,
+        "text": card.text
     }
 
-    # Динамическая сборка для L1
-    kb_rows = [
-        [
-            InlineKeyboardButton(
-                text="В любимые ❤️" if not is_favorite else "Убрать из ❤️",
-                callback_data=f"{'favorite_add' if not is_favorite else 'remove_fav'}:{activity_id}"
-            )
-        ],
-        [
-            InlineKeyboardButton(text="Следующую ⏩️",
-                                 callback_data="activity_next")
-        ]
-    ]
-
-    # Добавляем клуб
-    club_btn = get_community_btn()
-    if club_btn:
-        kb_rows.append(club_btn)
-
-    # Остальные системные кнопки
-    kb_rows.extend([
-        [InlineKeyboardButton(text="Поменять фильтры 🎛️", callback_data="update_filters")],
-        [InlineKeyboardButton(text="Поделиться ↩️", callback_data=f"share_activity:{activity_id}")],
-        [InlineKeyboardButton(text="💬 Оставить отзыв", callback_data=f"feedback_button:{activity_id}")]
-    ])
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=kb_rows)
-    
     message = callback.message
     has_media = message.content_type in ['video', 'photo']
-    final_caption = f"{caption_title}\n\n{full_text}"
 
     try:
         if has_media:
-            if len(final_caption) <= 1024:
-                await message.edit_caption(caption=final_caption,
+            if card.fits_caption:
+                await message.edit_caption(caption=card.full,
                                            parse_mode="Markdown",
                                            reply_markup=keyboard)
             else:
-                # Если текст длинный
-                if message.content_type == 'video':
-                    # Для видео убираем лишний текст "Инструкция ниже", оставляем только подпись
-                    short_caption = f"{caption_title}{VIRAL_SIGNATURE}"
-
-                await message.edit_caption(caption=short_caption,
+                # Если текст длинный — в подписи только заголовок, инструкция ниже
+                await message.edit_caption(caption=card.short_caption,
                                            parse_mode="Markdown")
 
-                chunk_size = 3500
-                chunks = [
-                    full_text[i:i + chunk_size]
-                    for i in range(0, len(full_text), chunk_size)
-                ]
-                for i, chunk in enumerate(chunks):
-                    markup = keyboard if i == len(chunks) - 1 else None
+                for i, chunk in enumerate(card.chunks):
+                    markup = keyboard if i == len(card.chunks) - 1 else None
                     await message.answer(chunk,
                                          parse_mode="Markdown",
                                          reply_markup=markup,
                                          disable_web_page_preview=True)
         else:
-            await message.edit_text(f"{caption_title}\n\n{full_text}",
+            await message.edit_text(card.full,
                                     parse_mode="Markdown",
                                     reply_markup=keyboard,
                                     disable_web_page_preview=True)
 
     except TelegramBadRequest as e:
         print(f"Edit error (L1): {e}")
-        await message.answer(final_caption[:3500],
+        await message.answer(card.full[:CHUNK_SIZE],
                              parse_mode="Markdown",
                              reply_markup=keyboard)
 
-    supabase.table("seen_activities").upsert({
+    await run_db(record_seen, {
         "user_id":
         user_id,
         "activity_id":
@@ -448,7 +369,7 @@ async def show_activity_details(callback: types.CallbackQuery):
         "l1",
         "seen_at":
         datetime.now().isoformat()
-    }).execute()
+    })
 
     ctx["l1_counter"] = int(ctx.get("l1_counter", 0)) + 1
     from handlers.feedback_activity import maybe_prompt_auto_feedback
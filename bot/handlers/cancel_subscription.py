@@ -2,7 +2,7 @@ from aiogram import Router, types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from utils.amplitude_logger import log_event
-from db.supabase_client import supabase
+from db.async_repo import get_subscription
 from utils.session_tracker import get_current_session_id
 
 cancel_subscription_router = Router()
@@ -29,23 +29,10 @@ async def _get_user_email(user_id: int) -> str:
     Работает даже если нет строки, нет данных, res=None — ничего не падает.
     """
     try:
-        res = (
-            supabase
-            .table("user_subscriptions")
-            .select("payer_email")
-            .eq("user_id", user_id)
-            .maybe_single()
-            .execute()
-        )
+        data = await get_subscription(user_id, "payer_email")
     except Exception:
         return ""
 
-    # res может быть None
-    if not res:
-        return ""
-
-    data = getattr(res, "data", None)
-
     # data может быть None
     if not data:
         return ""
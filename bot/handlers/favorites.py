@@ -2,17 +2,20 @@ from aiogram import Router, types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaVideo, InputMediaPhoto
 
-from db.supabase_client import add_favorite, get_favorites
-from db.supabase_client import supabase
+from db.activity_catalog import activity_catalog
+from db.async_repo import (
+    run_db, add_favorite, remove_favorite as repo_remove_favorite,
+    get_favorite_ids, has_favorites,
+)
 
 from utils.amplitude_logger import log_event
+from utils.card_render import render_card, card_keyboard
+from utils.media_registry import send_photo
+from db.prefetch import drop_prefetched
 from .user_state import user_data
 
 favorites_router = Router()
 
-# Константа для подписи (экранированная)
-VIRAL_SIGNATURE = "\n\n🏡 Найдено в @blizkie\_igry\_bot"
-
 @favorites_router.callback_query(F.data.startswith("favorite_add:"))
 async def favorite_add(callback: types.CallbackQuery):
     """
@@ -22,11 +25,11 @@ async def favorite_add(callback: types.CallbackQuery):
     user_id = callback.from_user.id
 
     # 1. Пишем в базу
-    add_favorite(user_id=user_id, activity_id=activity_id)
+    await add_favorite(user_id=user_id, activity_id=activity_id)
+    drop_prefetched(user_id)  # в слоте префетча мог лежать старый статус «в любимых»
 
     # 2. Логируем
-    response = supabase.table("activities").select("*").eq("id", activity_id).execute()
-    activity = response.data[0] if response.data else None
+    activity = await run_db(activity_catalog.get, activity_id)
 
     try:
         log_event(
@@ -42,15 +45,7 @@ async def favorite_add(callback: types.CallbackQuery):
         print(f"[Amplitude] Failed to log favourites_add: {e}")
 
     # 3. Обновляем клавиатуру
-    new_keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Убрать из любимых ✖️", callback_data=f"remove_fav:{activity_id}")],
-            [InlineKeyboardButton(text="Следующую ⏩️", callback_data="activity_next")],
-            [InlineKeyboardButton(text="Поменять фильтры 🎛️", callback_data="update_filters")],
-            [InlineKeyboardButton(text="Поделитесь этой идеей ↩️", callback_data=f"share_activity:{activity_id}")],
-            [InlineKeyboardButton(text="💬 Оставить отзыв", callback_data=f"feedback_button:{activity_id}")]
-        ]
-    )
+    new_keyboard = card_keyboard(activity_id, "l1_toggle", is_favorite=True)
 
     # 4. Восстанавливаем текст
     state = user_data.get(user_id, {})
@@ -117,33 +112,17 @@ async def list_favorites(message_or_callback: types.Message | types.CallbackQuer
         print(f"[Amplitude] Failed to log favourites_list: {e}")
 
     # Загружаем favorites
-    favorites_response = (
-        supabase.table("favorites")
-        .select("activity_id")
-        .eq("user_id", user_id)
-        .order("created_at", desc=True)
-        .execute()
-    )
-
-    if not favorites_response.data:
-        return await _edit_or_send(message_or_callback, "У вас пока нет любимых активностей 🌱")
+    activity_ids = await get_favorite_ids(user_id)
 
-    activity_ids = [fav["activity_id"] for fav in favorites_response.data]
+    if not activity_ids:
+        return await _edit_or_send(message_or_callback, "У вас пока нет любимых активностей 🌱")
 
-    # Загружаем сами активности
-    activities_response = (
-        supabase.table("activities")
-        .select("*")
-        .in_("id", activity_ids)
-        .execute()
-    )
+    # Сами активности берём из каталога (в порядке избранного)
+    sorted_activities = await run_db(activity_catalog.get_many, activity_ids)
 
-    if not activities_response.data:
+    if not sorted_activities:
         return await _send(message_or_callback, "Не удалось загрузить активности 😔")
 
-    id_to_activity = {a["id"]: a for a in activities_response.data}
-    sorted_activities = [id_to_activity[aid] for aid in activity_ids if aid in id_to_activity]
-
     await _edit_or_send(message_or_callback, "Ваши любимые активности:")
 
     for activity in sorted_activities:
@@ -188,81 +167,54 @@ async def show_favorites_command(message: types.Message):
     await list_favorites(message)
 
 
+async def _send_chunks(message: types.Message, chunks, keyboard):
+    """Длинный текст L1 частями, клавиатура — на последней."""
+    for i, chunk in enumerate(chunks):
+        mk = keyboard if i == len(chunks) - 1 else None
+        await message.answer(chunk, parse_mode="Markdown", reply_markup=mk, disable_web_page_preview=True)
+
+
 # --- НОВЫЙ ХЕНДЛЕР: Открывает L1 НОВЫМ сообщением (Full UI) ---
 @favorites_router.callback_query(F.data.startswith("fav_details:"))
 async def show_favorite_details(callback: types.CallbackQuery):
     activity_id = int(callback.data.split(":")[1])
     user_id = callback.from_user.id
 
-    response = supabase.table("activities").select("*").eq("id", activity_id).execute()
-    if not response.data:
+    activity = await run_db(activity_catalog.get, activity_id)
+    if not activity:
         await callback.answer("Активность не найдена")
         return
 
-    activity = response.data[0]
-
-    # 1. Формируем полный текст (как в activities.py)
-    summary = "\n".join([f"💡 {s}" for s in (activity.get("summary") or [])])
-    caption_title = f"🎲 *{activity['title']}*"
-
-    author = activity.get("author")
-    author_url = activity.get("source_url")
-    author_block = ""
-    if author and author_url:
-        author_block = f"\n\n👤 Автор: [{author}]({author_url})"
-
-    ugc_block = "\n\n💡 Есть идея игры? 👉 /suggest"
-
-    full_text = (
-        f"⏱️ {activity['time_required']} • ⚡️ {activity['energy']} • 📍 {activity['location']}\n\n"
-        f"Материалы: {activity['materials'] or 'Не требуются'}\n\n"
-        f"{activity['full_description']}\n\n"
-        f"{summary}"
-        f"{author_block}"
-        f"{VIRAL_SIGNATURE}"
-        f"{ugc_block}"
-    )
+    # 1. Текст и полная клавиатура L1 (общий рендер с activities.py)
+    card = render_card(activity, "fav_l1")
+    keyboard = card.keyboard
 
     # 2. Сохраняем состояние текста! 
     # (Чтобы если юзер нажмет "Убрать из любимых", сообщение не сломалось)
     user_state = user_data.setdefault(user_id, {})
-    user_state["current_activity_text"] = {"caption": caption_title, "text": full_text}
-
-    # 3. Полная клавиатура L1 (как ты просил)
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Убрать из любимых ✖️", callback_data=f"remove_fav:{activity_id}")],
-        [InlineKeyboardButton(text="Следующую ⏩️", callback_data="activity_next")],
-        [InlineKeyboardButton(text="Поменять фильтры 🎛️", callback_data="update_filters")],
-        [InlineKeyboardButton(text="Поделиться ↩️", callback_data=f"share_activity:{activity_id}")],
-        [InlineKeyboardButton(text="💬 Оставить отзыв", callback_data=f"feedback_button:{activity_id}")]
-    ])
+    user_state["current_activity_text"] = {"caption": card.caption, "text": card.text}
 
     video_file_id = activity.get("video_file_id")
     image_url = activity.get("image_url")
-    final_caption = f"{caption_title}\n\n{full_text}"
 
-    # 4. Отправляем НОВЫМ сообщением (answer)
+    # 3. Отправляем НОВЫМ сообщением (answer)
     try:
         if video_file_id and video_file_id.strip():
-            if len(final_caption) <= 1024:
-                await callback.message.answer_video(video=video_file_id, caption=final_caption, parse_mode="Markdown", reply_markup=keyboard)
+            if card.fits_caption:
+                await callback.message.answer_video(video=video_file_id, caption=card.full, parse_mode="Markdown", reply_markup=keyboard)
             else:
                 # Видео + Текст отдельно
-                await callback.message.answer_video(video=video_file_id, caption=f"{caption_title}\n{VIRAL_SIGNATURE}", parse_mode="Markdown")
-                chunk_size = 3500
-                chunks = [full_text[i:i + chunk_size] for i in range(0, len(full_text), chunk_size)]
-                for i, chunk in enumerate(chunks):
-                    mk = keyboard if i == len(chunks) - 1 else None
-                    await callback.message.answer(chunk, parse_mode="Markdown", reply_markup=mk, disable_web_page_preview=True)
+                await callback.message.answer_video(video=video_file_id, caption=card.short_caption, parse_mode="Markdown")
+                await _send_chunks(callback.message, card.chunks, keyboard)
 
         elif image_url and image_url.strip():
-             if len(final_caption) <= 1024:
-                await callback.message.answer_photo(photo=image_url, caption=final_caption, parse_mode="Markdown", reply_markup=keyboard)
-             else:
-                await callback.message.answer_photo(photo=image_url, caption=caption_title, parse_mode="Markdown")
-                await callback.message.answer(full_text, parse_mode="Markdown", reply_markup=keyboard, disable_web_page_preview=True)
+            if card.fits_caption:
+                await send_photo(callback.message.answer_photo, image_url, caption=card.full, parse_mode="Markdown", reply_markup=keyboard)
+            else:
+                await send_photo(callback.message.answer_photo, image_url, caption=card.short_caption, parse_mode="Markdown")
+                await _send_chunks(callback.message, card.chunks, keyboard)
         else:
-            await callback.message.answer(final_caption, parse_mode="Markdown", reply_markup=keyboard, disable_web_page_preview=True)
+            await callback.message.answer(card.full, parse_mode="Markdown", reply_markup=keyboard, disable_web_page_preview=True)
 
     except Exception as e:
         await callback.message.answer("Ошибка отображения")
@@ -280,7 +232,8 @@ async def remove_favorite(callback: types.CallbackQuery):
     activity_id = int(callback.data.split(":")[1])
 
     # 1. Удаляем из БД
-    supabase.table("favorites").delete().eq("user_id", user_id).eq("activity_id", activity_id).execute()
+    await repo_remove_favorite(user_id, activity_id)
+    drop_prefetched(user_id)
 
     try:
         log_event(
@@ -309,23 +262,14 @@ async def remove_favorite(callback: types.CallbackQuery):
             pass
 
         # Проверяем, остались ли любимые
-        check = supabase.table("favorites").select("id").eq("user_id", user_id).execute()
-        if not check.data:
+        if not await has_favorites(user_id):
             await callback.message.answer("У вас пока нет любимых активностей 🌱")
 
         await callback.answer("Удалено")
         return
 
     # Сценарий КАРТОЧКИ (L1): Меняем кнопку на "Добавить" и сохраняем текст
-    new_keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Добавить в любимые ❤️", callback_data=f"favorite_add:{activity_id}")],
-            [InlineKeyboardButton(text="Следующую ⏩️", callback_data="activity_next")],
-            [InlineKeyboardButton(text="Поменять фильтры 🎛️", callback_data="update_filters")],
-            [InlineKeyboardButton(text="Поделитесь этой идеей ↩️", callback_data=f"share_activity:{activity_id}")],
-            [InlineKeyboardButton(text="💬 Оставить отзыв", callback_data=f"feedback_button:{activity_id}")]
-        ]
-    )
+    new_keyboard = card_keyboard(activity_id, "l1_toggle", is_favorite=False)
 
     # Восстанавливаем текст (БЕЗОПАСНАЯ ЛОГИКА)
     state = user_data.get(user_id, {})
@@ -2,10 +2,10 @@ from aiogram import Router, types, F
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from db.feedback_repository import save_feedback
 from db.feature_flags import is_enabled, get_microfeedback_auto_config
-from db.user_status import is_premium_user
+from utils.paywall_guard import is_premium as premium_active  # кэш прав (utils/entitlements)
 from utils.amplitude_logger import log_event
 from handlers.user_state import user_data
-from db.supabase_client import supabase
+from db.async_repo import run_db, get_user_filters
 
 feedback_router = Router()
 
@@ -43,12 +43,11 @@ async def ask_manual_feedback(callback: types.CallbackQuery):
 
 
 # --- Функция: получаем фильтры и session_id с fallback
-def get_filters_and_session(user_id: int):
+async def get_filters_and_session(user_id: int):
     filters = user_data.get(user_id)
     if not filters:
-        response = supabase.table("user_filters").select("*").eq("user_id", user_id).execute()
-        if response.data:
-            filters = response.data[0]
+        filters = await get_user_filters(user_id)
+        if filters:
             user_data[user_id] = filters
     session_id = filters.get("session_id") if filters else None
     return filters, session_id
@@ -61,11 +60,12 @@ async def handle_feedback(callback: types.CallbackQuery):
         _, activity_id_str, rating, source = callback.data.split(":")
         activity_id = int(activity_id_str)
         user_id = callback.from_user.id
-        is_premium = is_premium_user(user_id)
+        is_premium = await run_db(premium_active, user_id)
 
-        filters, session_id = get_filters_and_session(user_id)
+        filters, session_id = await get_filters_and_session(user_id)
 
-        save_feedback(
+        await run_db(
+            save_feedback,
             user_id=user_id,
             activity_id=activity_id,
             rating=rating,
@@ -137,10 +137,11 @@ async def handle_text_feedback(message: types.Message):
     source = context["source"]
     rating = context.get("rating", "text")
 
-    is_premium = is_premium_user(user_id)
-    filters, session_id = get_filters_and_session(user_id)
+    is_premium = await run_db(premium_active, user_id)
+    filters, session_id = await get_filters_and_session(user_id)
 
-    save_feedback(
+    await run_db(
+        save_feedback,
         user_id=user_id,
         activity_id=activity_id,
         rating=rating,
@@ -165,7 +166,6 @@ async def handle_text_feedback(message: types.Message):
 # --- Авто-микрофидбек после N показов L1
 from datetime import datetime, timedelta
 from db.feature_flags import get_microfeedback_auto_config
-from db.user_status import is_premium_user
 
 # в user_data[user_id] будем хранить:
 #  - "l1_counter": int — счетчик показов L1 в текущей сессии
@@ -188,7 +188,7 @@ async def maybe_prompt_auto_feedback(user_id: int, activity_id: int, ctx: dict,
         l1_counter = int(ctx.get("l1_counter", 0))
 
         # платный/бесплатный
-        paid = is_premium_user(user_id)
+        paid = await run_db(premium_active, user_id)
         trigger_points = cfg.get("premium_intervals", []) if paid else cfg.get("free_intervals", [])
 
         # не наш триггер — выходим
@@ -211,7 +211,7 @@ async def maybe_prompt_auto_feedback(user_id: int, activity_id: int, ctx: dict,
             reply_markup=kb
         )
 
-        filters, session_id = get_filters_and_session(user_id)
+        filters, session_id = await get_filters_and_session(user_id)
         log_event(
             user_id,
             "feedback_ask_shown",
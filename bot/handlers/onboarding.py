@@ -4,7 +4,7 @@ from utils.amplitude_logger import log_event, set_user_properties
 from utils.session import ensure_filters  # ✅ централизовано
 from .user_state import user_data
 from .activities import send_activity, show_next_activity
-from db.supabase_client import supabase
+from db.async_repo import get_user_filters, upsert_user_filters, update_user_filters
 
 onboarding_router = Router()
 
@@ -12,7 +12,7 @@ onboarding_router = Router()
 @onboarding_router.callback_query(F.data == "start_onboarding")
 async def start_onboarding(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    ctx = ensure_filters(user_id)
+    ctx = await ensure_filters(user_id)
     ctx["mode"] = "onboarding"
 
     log_event(user_id, "onboarding_started", session_id=ctx["session_id"])
@@ -27,7 +27,7 @@ async def start_onboarding(callback: types.CallbackQuery):
 @onboarding_router.callback_query(F.data.startswith("age_"))
 async def process_age(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    ctx = ensure_filters(user_id)
+    ctx = await ensure_filters(user_id)
     username = callback.from_user.username
     age_data = callback.data.replace("age_", "")
 
@@ -58,11 +58,11 @@ async def process_age(callback: types.CallbackQuery):
     elif mode == "update":
         await callback.message.answer("Возраст обновлён. Вот идея для вас 👇")
         await show_next_activity(callback)
-        supabase.table("user_filters").update({
+        await update_user_filters(user_id, {
             "username": username,
             "age_min": age_min,
             "age_max": age_max
-        }).eq("user_id", user_id).execute()
+        })
 
     await callback.answer()
 
@@ -70,7 +70,7 @@ async def process_age(callback: types.CallbackQuery):
 @onboarding_router.callback_query(F.data.startswith("time_"))
 async def process_time(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    ctx = ensure_filters(user_id)
+    ctx = await ensure_filters(user_id)
     username = callback.from_user.username
     time_choice = callback.data.split("_")[1]
 
@@ -89,10 +89,10 @@ async def process_time(callback: types.CallbackQuery):
     elif mode == "update":
         await callback.message.answer("Время обновлено. Вот идея для вас 👇")
         await show_next_activity(callback)
-        supabase.table("user_filters").update({
+        await update_user_filters(user_id, {
             "username": username,
             "time_required": time_choice
-        }).eq("user_id", user_id).execute()
+        })
 
     await callback.answer()
 
@@ -100,7 +100,7 @@ async def process_time(callback: types.CallbackQuery):
 @onboarding_router.callback_query(F.data.startswith("energy_"))
 async def process_energy(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    ctx = ensure_filters(user_id)
+    ctx = await ensure_filters(user_id)
     username = callback.from_user.username
     energy_choice = callback.data.split("_")[1]
 
@@ -118,10 +118,10 @@ async def process_energy(callback: types.CallbackQuery):
     elif mode == "update":
         await callback.message.answer("Энергия обновлена. Вот идея для вас 👇")
         await show_next_activity(callback)
-        supabase.table("user_filters").update({
+        await update_user_filters(user_id, {
             "username": username,
             "energy": energy_choice
-        }).eq("user_id", user_id).execute()
+        })
 
     await callback.answer()
 
@@ -129,7 +129,7 @@ async def process_energy(callback: types.CallbackQuery):
 @onboarding_router.callback_query(F.data.startswith("location_"))
 async def process_location(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    ctx = ensure_filters(user_id)
+    ctx = await ensure_filters(user_id)
     username = callback.from_user.username
     location_choice = callback.data.split("_")[1]
 
@@ -142,7 +142,7 @@ async def process_location(callback: types.CallbackQuery):
     if mode == "onboarding":
         log_event(user_id, "onboarding_completed", session_id=ctx["session_id"])
 
-        supabase.table("user_filters").upsert({
+        await upsert_user_filters({
             "user_id": user_id,
             "username": username,
             "age_min": ctx["age_min"],
@@ -150,7 +150,7 @@ async def process_location(callback: types.CallbackQuery):
             "time_required": ctx["time_required"],
             "energy": ctx["energy"],
             "location": ctx["location"]
-        }).execute()
+        })
 
         await callback.message.answer(
             "Класс! Всё настроили 🎉\n\n"
@@ -161,10 +161,10 @@ async def process_location(callback: types.CallbackQuery):
     elif mode == "update":
         await callback.message.answer("Место обновлено. Вот идея для вас 👇")
         await show_next_activity(callback)
-        supabase.table("user_filters").update({
+        await update_user_filters(user_id, {
             "username": username,
             "location": location_choice
-        }).eq("user_id", user_id).execute()
+        })
 
     await callback.answer()
 
@@ -172,10 +172,9 @@ async def process_location(callback: types.CallbackQuery):
 @onboarding_router.callback_query(F.data == "continue_with_filters")
 async def continue_with_saved_filters(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    ctx = ensure_filters(user_id)
+    ctx = await ensure_filters(user_id)
 
-    response = supabase.table("user_filters").select("*").eq("user_id", user_id).execute()
-    filters = response.data[0] if response.data else None
+    filters = await get_user_filters(user_id)
 
     if not filters:
         await callback.message.answer("Не удалось найти сохранённые фильтры 😔 Попробуйте начать заново.")
@@ -6,39 +6,19 @@ from utils.push_scheduler import schedule_paywall_followup
 from utils.paywall_guard import l0_views_count, _rules, _get_trial_config
 from config import SUPPORT_USERNAME
 from handlers.user_state import user_data
-from db.supabase_client import supabase
+from db.feature_flags import require_flag
+from db.async_repo import run_db
 from utils.robokassa import make_payment_link
 
 paywall_router = Router()
 
 # ============================================================
-#   КЭШ + ЗАГРУЗКА ДАННЫХ PAYWALL ИЗ feature_flags
+#   ДАННЫЕ PAYWALL ИЗ feature_flags
 # ============================================================
 
-_PAYWALL_CACHE = None
-
 def get_paywall_settings():
-    """
-    Загружает данные из feature_flags.key = 'paywall_requisites'.
-    Кэширует, чтобы не дергать Supabase каждый раз.
-    """
-    global _PAYWALL_CACHE
-    if _PAYWALL_CACHE:
-        return _PAYWALL_CACHE
-
-    row = (
-        supabase.table("feature_flags")
-        .select("value_json")
-        .eq("key", "paywall_requisites")
-        .maybe_single()
-        .execute()
-    )
-
-    if not row or not row.data:
-        raise RuntimeError("feature_flags: key 'paywall_requisites' not found")
-
-    _PAYWALL_CACHE = row.data["value_json"]
-    return _PAYWALL_CACHE
+    """Данные из feature_flags.key = 'paywall_requisites' (через общий кэш флагов)."""
+    return require_flag("paywall_requisites")
 
 
 # ============================================================
@@ -165,7 +145,7 @@ async def send_universal_paywall(msg_or_cb, reason: str, user_id: int, session_i
     ctx["last_paywall_reason"] = reason
 
     rules = _rules() or {"l0": 15}
-    can_continue = l0_views_count(user_id) < rules["l0"]
+    can_continue = await run_db(l0_views_count, user_id) < rules["l0"]
 
     kb = paywall_kb(settings, can_continue)
 
@@ -230,7 +210,8 @@ async def on_subscribe(cb: types.CallbackQuery):
         session_id=session_id
     )
 
-    pay_url, inv_id = make_payment_link(
+    pay_url, inv_id = await run_db(
+        make_payment_link,
         user_id=user_id,
         amount_rub=price,
         description="Подписка «Близкие игры», ежемесячно"
@@ -266,7 +247,8 @@ async def open_paywall_direct(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     session_id = user_data.get(user_id, {}).get("session_id")
 
-    link, inv_id = make_payment_link(
+    link, inv_id = await run_db(
+        make_payment_link,
         user_id=user_id,
         amount_rub=490,
         description="Подписка «Близкие Игры», ежемесячно"
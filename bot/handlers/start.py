@@ -2,10 +2,12 @@ from aiogram import Router, types
 from aiogram.filters import CommandStart
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 from keyboards.common import start_inline_keyboard
-from db.supabase_client import supabase, ENERGY_MAP, TIME_MAP, location_MAP
+from db.supabase_client import ENERGY_MAP, TIME_MAP, location_MAP
+from db.async_repo import get_user_filters
 from utils.session import ensure_filters
 from utils.amplitude_logger import log_event
 from handlers.user_state import user_data
+from utils.media_registry import send_photo
 
 router = Router()
 
@@ -17,7 +19,7 @@ async def cmd_start(message: types.Message):
     user_id = message.from_user.id
 
     # создаём/обновляем контекст
-    ctx = ensure_filters(user_id)
+    ctx = await ensure_filters(user_id)
 
     # новая сессия
     from uuid import uuid4
@@ -42,8 +44,7 @@ async def cmd_start(message: types.Message):
     )
 
     # проверяем фильтры
-    response = supabase.table("user_filters").select("*").eq("user_id", user_id).execute()
-    filters = response.data[0] if response.data else None
+    filters = await get_user_filters(user_id)
 
     # ============================================================
     # 1) Если есть сохранённые фильтры
@@ -74,8 +75,9 @@ async def cmd_start(message: types.Message):
         await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
         return
         
-    await message.answer_photo(
-        photo=PHOTO_URL,
+    await send_photo(
+        message.answer_photo,
+        PHOTO_URL,
         caption=(
             "Привет! Я Саша, папа двойняшек и автор этого бота 👋\n\n"
             "Я создал «Близкие Игры», когда понял: самое сложное в родительстве — это не играть с детьми, а придумать, во что играть, когда сил осталось только на то, чтобы доползти до кровати.\n\n"
@@ -5,6 +5,7 @@ from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from db.supabase_client import supabase
+from db.async_repo import aexecute
 from utils.amplitude_logger import log_event
 from handlers.user_state import user_data
 
@@ -179,14 +180,14 @@ async def process_attribution(message: types.Message, state: FSMContext):
     final_data = await state.get_data()
 
     try:
-        supabase.table("activity_suggestions").insert({
+        await aexecute(supabase.table("activity_suggestions").insert({
             "user_id": user_id,
             "username": message.from_user.username,
             "content": final_data.get('content'), # Тут теперь точно будет текст
             "media_id": final_data.get('media_id'),
             "attribution_info": attribution_info,
             "status": "pending"
-        }).execute()
+        }))
 
     except Exception as e:
         print(f"[Suggest] Error saving: {e}")
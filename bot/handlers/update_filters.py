@@ -15,7 +15,7 @@ update_filters_router = Router()
 @update_filters_router.callback_query(F.data == "update_filters")
 async def show_update_options(event: types.Message | types.CallbackQuery):
     user_id = event.from_user.id
-    ctx = ensure_filters(user_id)  # ✅ централизовано
+    ctx = await ensure_filters(user_id)  # ✅ централизовано
 
     # ✅ Поддержка старого ключа "time"
     time_value = ctx.get("time_required") or ctx.get("time")
@@ -67,7 +67,7 @@ async def show_update_options(event: types.Message | types.CallbackQuery):
 
 @update_filters_router.callback_query(F.data == "update_age")
 async def update_age(callback: types.CallbackQuery):
-    ctx = ensure_filters(callback.from_user.id)
+    ctx = await ensure_filters(callback.from_user.id)
     ctx["mode"] = "update"
     await callback.message.answer("Выберите новый возраст:", reply_markup=age_keyboard, disable_web_page_preview=True)
     await callback.answer()
@@ -75,7 +75,7 @@ async def update_age(callback: types.CallbackQuery):
 
 @update_filters_router.callback_query(F.data == "update_time")
 async def update_time(callback: types.CallbackQuery):
-    ctx = ensure_filters(callback.from_user.id)
+    ctx = await ensure_filters(callback.from_user.id)
     ctx["mode"] = "update"
     await callback.message.answer("Сколько у вас есть времени на игру?", reply_markup=time_keyboard, disable_web_page_preview=True)
     await callback.answer()
@@ -83,7 +83,7 @@ async def update_time(callback: types.CallbackQuery):
 
 @update_filters_router.callback_query(F.data == "update_energy")
 async def update_energy(callback: types.CallbackQuery):
-    ctx = ensure_filters(callback.from_user.id)
+    ctx = await ensure_filters(callback.from_user.id)
     ctx["mode"] = "update"
     await callback.message.answer("Сколько у вас энергии на игру?", reply_markup=energy_keyboard, disable_web_page_preview=True)
     await callback.answer()
@@ -91,7 +91,7 @@ async def update_energy(callback: types.CallbackQuery):
 
 @update_filters_router.callback_query(F.data == "update_location")
 async def update_location(callback: types.CallbackQuery):
-    ctx = ensure_filters(callback.from_user.id)
+    ctx = await ensure_filters(callback.from_user.id)
     ctx["mode"] = "update"
     await callback.message.answer("Где будете играть?", reply_markup=location_keyboard, disable_web_page_preview=True)
     await callback.answer()
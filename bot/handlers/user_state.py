@@ -1 +1,340 @@
-user_data = {}
\ No newline at end of file
+# handlers/user_state.py
+"""
+Контекст юзеров в памяти процесса (сессия, фильтры, служебные флаги).
+
+user_data ведёт себя как dict[user_id, dict], но:
+- значения — UserContext со __slots__ под известные ключи (остальное — в extra);
+- размер ограничен: закрытые и уже синкнутые сессии выселяются по TTL / LRU
+  (evict_idle вызывается из sync_sessions_to_db);
+- опционально контексты переживают рестарт: USER_STATE_BACKEND=sqlite:path
+  или redis://host:port/db. Выселенный контекст уходит в backend (JSON), а
+  поднимает его restore() — middleware зовёт его через run_db в начале
+  апдейта. Сами dict-методы в backend не ходят: только память. Вставка сверх
+  лимита лишь ставит needs_eviction, а evict_idle (с записью в backend)
+  гоняет sync_sessions_to_db через run_db.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from array import array
+from collections.abc import MutableMapping
+from datetime import datetime
+
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+# Контекст закрытой сессии живёт в памяти столько после последнего обращения
+USER_STATE_TTL_SECONDS = int(os.getenv("USER_STATE_TTL_SECONDS", str(6 * 3600)))
+# Жёсткий потолок: сверх него выселяем самые давние закрытые контексты
+USER_STATE_MAX_USERS = int(os.getenv("USER_STATE_MAX_USERS", "50000"))
+USER_STATE_BACKEND = os.getenv("USER_STATE_BACKEND", "")
+# Переполнение выселяем до этой доли max_users, чтобы не сортировать на каждой вставке
+USER_STATE_LOW_WATER = 0.9
+
+_MISSING = object()
+
+
+class UserContext(MutableMapping):
+    """dict-подобный контекст юзера: известные ключи в слотах, прочие — в extra."""
+
+    KEYS = (
+        "session_id", "created_at", "last_seen", "first_event", "last_event",
+        "actions_count", "marked_ended", "source", "device_info", "username",
+        "age_min", "age_max", "time_required", "energy", "location",
+        "mode", "current_activity_text", "last_paywall_reason",
+        "l1_counter", "last_auto_feedback_at", "awaiting_feedback_text",
+    )
+    __slots__ = KEYS + ("extra", "touched_at")
+
+    def __init__(self, data=None):
+        for key in self.KEYS:
+            object.__setattr__(self, key, _MISSING)
+        self.extra = {}
+        self.touched_at = time.monotonic()
+        if data:
+            self.update(data)
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            value = getattr(self, key)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.KEYS:
+            setattr(self, key, value)
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.KEYS:
+            if getattr(self, key) is _MISSING:
+                raise KeyError(key)
+            setattr(self, key, _MISSING)
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        for key in self.KEYS:
+            if getattr(self, key) is not _MISSING:
+                yield key
+        yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"UserContext({dict(self)!r})"
+
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+
+# ============================================================
+#   BACKEND'Ы (опционально)
+# ============================================================
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, (set, frozenset, tuple, array)):
+        return list(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _json_hook(obj):
+    if len(obj) == 1 and "$dt" in obj:
+        return datetime.fromisoformat(obj["$dt"])
+    return obj
+
+
+def _dumps(ctx) -> str:
+    """Контекст -> JSON (datetime сохраняем с типом). Не pickle: backend — внешнее хранилище."""
+    return json.dumps(dict(ctx), default=_json_default, ensure_ascii=False)
+
+
+def _loads(raw):
+    if not raw:
+        return None
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8")
+    return json.loads(raw, object_hook=_json_hook)
+
+
+class _SQLiteBackend:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "create table if not exists user_state (user_id integer primary key, data blob)"
+            )
+            self._conn.commit()
+
+    def load(self, user_id: int):
+        with self._lock:
+            row = self._conn.execute(
+                "select data from user_state where user_id = ?", (user_id,)
+            ).fetchone()
+        return _loads(row[0]) if row else None
+
+    def save_many(self, items: dict):
+        with self._lock:
+            self._conn.executemany(
+                "insert or replace into user_state (user_id, data) values (?, ?)",
+                [(uid, _dumps(ctx)) for uid, ctx in items.items()],
+            )
+            self._conn.commit()
+
+
+class _RedisBackend:
+    def __init__(self, url: str):
+        import redis  # опциональная зависимость, нужна только с redis:// backend'ом
+        self._r = redis.Redis.from_url(url)
+        self._ttl = max(USER_STATE_TTL_SECONDS * 4, 86400)
+
+    def load(self, user_id: int):
+        raw = self._r.get(f"user_state:{user_id}")
+        return _loads(raw)
+
+    def save_many(self, items: dict):
+        pipe = self._r.pipeline()
+        for uid, ctx in items.items():
+            pipe.set(f"user_state:{uid}", _dumps(ctx), ex=self._ttl)
+        pipe.execute()
+
+
+def _make_backend(spec: str):
+    if not spec:
+        return None
+    if spec.startswith("sqlite:"):
+        return _SQLiteBackend(spec[len("sqlite:"):] or "logs/user_state.sqlite")
+    if spec.startswith(("redis://", "rediss://")):
+        return _RedisBackend(spec)
+    raise ValueError(f"Unknown USER_STATE_BACKEND: {spec}")
+
+
+# ============================================================
+#   ХРАНИЛИЩЕ
+# ============================================================
+
+class UserStore(MutableMapping):
+    def __init__(self, backend=None, ttl_seconds=USER_STATE_TTL_SECONDS,
+                 max_users=USER_STATE_MAX_USERS):
+        self._data: dict[int, UserContext] = {}
+        self._lock = threading.RLock()
+        self._backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max_users
+        self._low_water = int(max_users * USER_STATE_LOW_WATER)
+        # размер, при котором вставка запросит выселение (сдвигается, если выселять нечего)
+        self._evict_at = max_users
+        self.needs_eviction = False
+        self._evict_listeners = []
+
+    def needs_restore(self, user_id) -> bool:
+        return self._backend is not None and user_id not in self._data
+
+    def restore(self, user_id):
+        """
+        Поднимает выселенный контекст из backend (синхронный I/O — звать через run_db).
+        Возвращает контекст из памяти или None, если сохранённого нет.
+        """
+        ctx = self._data.get(user_id)
+        if ctx is not None or self._backend is None:
+            return ctx
+        try:
+            state = self._backend.load(user_id)
+        except Exception as e:
+            logger.warning(f"[user_state] backend load error user={user_id}: {e}")
+            return None
+        if state is None:
+            return None
+        ctx = UserContext(state)
+        with self._lock:
+            return self._data.setdefault(user_id, ctx)
+
+    def __getitem__(self, user_id):
+        ctx = self._data[user_id]
+        ctx.touched_at = time.monotonic()
+        return ctx
+
+    def __setitem__(self, user_id, value):
+        ctx = value if isinstance(value, UserContext) else UserContext(value)
+        ctx.touched_at = time.monotonic()
+        with self._lock:
+            self._data[user_id] = ctx
+            if len(self._data) > self._evict_at:
+                # само выселение пишет в backend — его делает sync_sessions_to_db через run_db
+                self.needs_eviction = True
+
+    def __delitem__(self, user_id):
+        with self._lock:
+            del self._data[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def items(self):
+        """Снимок (user_id, ctx) того, что сейчас в памяти."""
+        with self._lock:
+            return list(self._data.items())
+
+    def setdefault(self, user_id, default=None):
+        # как у dict: возвращаем именно лежащий в хранилище объект
+        try:
+            return self[user_id]
+        except KeyError:
+            self[user_id] = default if default is not None else {}
+            return self._data[user_id]
+
+    # ---------- выселение ----------
+
+    def _evictable(self, user_id, ctx) -> bool:
+        """Выселять можно только закрытую сессию, уже записанную в user_sessions."""
+        if user_id in dirty_users:
+            return False
+        return bool(ctx.get("marked_ended")) or not ctx.get("session_id")
+
+    def add_evict_listener(self, fn):
+        """fn(user_ids) после каждого выселения — чтобы сбросить свои per-user кэши."""
+        self._evict_listeners.append(fn)
+
+    def evict_idle(self) -> int:
+        """
+        Выселяет закрытые контексты, к которым не обращались дольше TTL,
+        и — если всё ещё больше max_users — самые давние из закрытых,
+        до USER_STATE_LOW_WATER. Если выселять нечего (все сессии открыты),
+        следующая попытка — только после ещё (max_users - low water) вставок.
+        Пишет в backend синхронно — звать через run_db.
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [(ctx.touched_at, uid) for uid, ctx in self._data.items()
+                          if self._evictable(uid, ctx)]
+            victims = {uid for touched, uid in candidates if now - touched > self.ttl_seconds}
+
+            over = len(self._data) - len(victims) - self._low_water
+            if over > 0:
+                rest = sorted((c for c in candidates if c[1] not in victims))
+                victims.update(uid for _, uid in rest[:over])
+
+            evicted = {uid: self._data.pop(uid) for uid in victims}
+            self.needs_eviction = False
+            self._evict_at = max(self.max_users,
+                                 len(self._data) + self.max_users - self._low_water)
+
+        if evicted and self._backend is not None:
+            try:
+                self._backend.save_many(evicted)
+            except Exception as e:
+                logger.warning(f"[user_state] backend save error: {e}")
+        if evicted:
+            for fn in self._evict_listeners:
+                try:
+                    fn(evicted.keys())
+                except Exception as e:
+                    logger.warning(f"[user_state] evict listener error: {e}")
+        return len(evicted)
+
+    def persist_all(self):
+        """Сохраняет все контексты в backend (при остановке процесса)."""
+        if self._backend is None:
+            return
+        with self._lock:
+            snapshot = dict(self._data)
+        if snapshot:
+            self._backend.save_many(snapshot)
+
+
+user_data = UserStore(_make_backend(USER_STATE_BACKEND))
+
+# Юзеры, чей контекст менялся с последнего синка в user_sessions
+# (отмечают touch_user_activity и log_event, забирает sync_sessions_to_db)
+dirty_users: set[int] = set()
+
+
+def mark_dirty(user_id: int):
+    dirty_users.add(user_id)
+
+
+def pop_dirty() -> set[int]:
+    """Забирает накопленные id (без подмены объекта — на него могут ссылаться)."""
+    ids = set(dirty_users)
+    dirty_users.difference_update(ids)
+    return ids
@@ -15,14 +15,19 @@ from handlers.subscribe import subscribe_router
 from handlers.donate import donate_router
 from handlers.cancel_subscription import cancel_subscription_router
 from handlers.paywall import paywall_router
-from utils.session_tracker import sync_sessions_to_db
+from utils.session_tracker import sync_sessions_to_db, run_session_open_cleanup, flush_session_open_cleanup
 from workers.worker_pushes import run_worker
 from middleware.activity_middleware import ActivityMiddleware
 from handlers.suggest_game import suggest_router
+from db.activity_catalog import activity_catalog
+from db.seen_state import run_seen_writer, flush_seen_writes
+from utils.amplitude_logger import run_amplitude_flusher
+from handlers.user_state import user_data
+from db.feature_flags import run_flag_refresher
 
 # === ДОБАВЛЕНО: импорт для восстановления weekly пушей ===
 from utils.push_scheduler import schedule_premium_ritual
-from db.supabase_client import supabase
+from db.async_repo import run_db, get_active_subscriber_ids
 
 logger = setup_logger()
 
@@ -49,17 +54,9 @@ async def restore_all_premium_rituals():
     schedule_premium_ritual сам удаляет старые pending и ставит новые.
     """
     try:
-        rows = (
-            supabase.table("user_subscriptions")
-            .select("user_id, is_active")
-            .eq("is_active", True)
-            .execute()
-        ).data or []
-
-        for row in rows:
-            uid = row["user_id"]
+        for uid in await get_active_subscriber_ids():
             try:
-                schedule_premium_ritual(uid)
+                await run_db(schedule_premium_ritual, uid)
                 logger.info(f"🔁 Restored weekly ritual for user={uid}")
             except Exception as e:
                 logger.warning(f"❌ Failed restoring ritual for user={uid}: {e}")
@@ -99,11 +96,29 @@ async def main():
     # === ДОБАВЛЕНО: восстановление weekly-пушей ===
     asyncio.create_task(restore_all_premium_rituals())
 
+    asyncio.create_task(run_flag_refresher())  # фоновое обновление feature_flags
+    asyncio.create_task(activity_catalog.run_refresher())  # кэш каталога активностей
+    asyncio.create_task(run_seen_writer())  # write-behind для seen_activities
+    amplitude_task = asyncio.create_task(run_amplitude_flusher())  # батчи событий в Amplitude
     asyncio.create_task(sync_sessions_to_db())
+    asyncio.create_task(run_session_open_cleanup())  # чистка push_queue для новых сессий
     asyncio.create_task(run_worker(bot))  # фоновый push-воркер
 
     await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # дописываем просмотры, которые ещё не ушли в БД
+        flush_seen_writes()
+        flush_session_open_cleanup()
+        # контексты юзеров — в USER_STATE_BACKEND (если задан), чтобы пережить рестарт
+        try:
+            user_data.persist_all()
+        except Exception as e:
+            logger.warning(f"❌ Failed to persist user_data: {e}")
+        # флашер Amplitude на отмене дошлёт хвост и сохранит остаток на диск
+        amplitude_task.cancel()
+        await asyncio.gather(amplitude_task, return_exceptions=True)
 
 
 if __name__ == "__main__":
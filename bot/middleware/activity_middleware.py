@@ -1,6 +1,8 @@
 from aiogram import BaseMiddleware
 from aiogram.types import Update
-from utils.session_tracker import mark_seen, new_session_if_needed
+from db.async_repo import run_db
+from handlers.user_state import user_data
+from utils.session_tracker import touch_user_activity, begin_update_touch, end_update_touch
 
 
 class ActivityMiddleware(BaseMiddleware):
@@ -31,8 +33,19 @@ class ActivityMiddleware(BaseMiddleware):
         if from_user.is_bot:
             return await handler(event, data)
 
-        # Только обычные пользователи попадают сюда
-        mark_seen(user_id, source="tg", username=username)
-        new_session_if_needed(user_id, source="tg", username=username)
+        # Выселенный контекст поднимаем из backend здесь, вне event loop:
+        # дальше хэндлеры читают user_data только из памяти.
+        if user_data.needs_restore(user_id):
+            await run_db(user_data.restore, user_id)
 
-        return await handler(event, data)
+        # Только обычные пользователи попадают сюда.
+        # Один touch на апдейт: результат доступен хэндлерам как data["session_touch"],
+        # а ensure_user_context внутри этого апдейта сессию повторно не трогает.
+        touch = touch_user_activity(user_id, source="tg", username=username)
+        data["session_touch"] = touch
+
+        token = begin_update_touch(touch)
+        try:
+            return await handler(event, data)
+        finally:
+            end_update_touch(token)
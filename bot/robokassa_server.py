@@ -2,14 +2,37 @@ from fastapi import FastAPI, Request, Response
 from fastapi.responses import HTMLResponse
 from db.supabase_client import supabase
 from utils.robokassa import get_rk_settings
-from utils.amplitude_logger import log_event
+from utils.amplitude_logger import log_event, run_amplitude_flusher
 from datetime import datetime, timedelta, timezone
 import hashlib
 from utils.push_scheduler import schedule_premium_ritual
+from utils.entitlements import bump_entitlements_stamp
+from db.feature_flags import run_flag_refresher
+import asyncio
 
 app = FastAPI()
 BOT_USERNAME = "blizkie_igry_bot"
 
+_amplitude_task: asyncio.Task | None = None
+
+
+# -------------------------------
+# BACKGROUND TASKS (amplitude, feature_flags)
+# -------------------------------
+@app.on_event("startup")
+async def start_background_tasks():
+    global _amplitude_task
+    _amplitude_task = asyncio.create_task(run_amplitude_flusher("robokassa"))
+    asyncio.create_task(run_flag_refresher())
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    # на отмене флашер дошлёт хвост и сохранит остаток на диск
+    if _amplitude_task:
+        _amplitude_task.cancel()
+        await asyncio.gather(_amplitude_task, return_exceptions=True)
+
 
 # -------------------------------
 # SIGNATURE VERIFICATION
@@ -262,6 +285,12 @@ async def robokassa_result(request: Request):
         on_conflict="user_id",
     ).execute()
 
+    # кэш прав живёт в процессах бота / воркеров: сбрасываем его во всех сразу
+    try:
+        bump_entitlements_stamp()
+    except Exception as e:
+        print(f"⚠️ Failed to bump entitlements stamp for {user_id}: {e}")
+
     # ------------------------------
     # CLEAR OLD PUSHES (CLEAN SLATE)
     # ------------------------------
@@ -9,6 +9,8 @@ from datetime import datetime
 from config import ENV
 from db.supabase_client import supabase, TIME_MAP, ENERGY_MAP, location_MAP
 from db.seen import _matches_multivalue
+from db.catalog_index import CatalogIndex
+from db.candidate_table import CandidateTable
 
 print(f"✅ Загружено окружение: {ENV}")
 
@@ -54,7 +56,7 @@ def color_for_bucket(bucket: str) -> str:
 # =========================
 
 print("📥 Тянем активности из Supabase...")
-activities = supabase.table("activities").select("*").execute().data or []
+activities = supabase.table("activities").select("*").order("id").execute().data or []
 print(f"Всего активностей в базе: {len(activities)}\n")
 
 print("📥 Тянем реальные фильтры пользователей из user_filters...")
@@ -97,29 +99,14 @@ print(f"🔍 Уникальных комбинаций фильтров: {len(co
 
 results = []
 
+# Та же таблица кандидатов, по которой подбирает бот (db/candidate_table):
+# уровень 0 = строгое совпадение по всем фильтрам
+table = CandidateTable(activities, CatalogIndex(activities))
+by_id = {a["id"]: a for a in activities}
+
 for (age_min, age_max, time_h, energy_h, place_h), users_count in combo_counts.items():
-    found_activities = []
-
-    for a in activities:
-        try:
-            a_age_min = int(a.get("age_min") or 0)
-            a_age_max = int(a.get("age_max") or 0)
-        except ValueError:
-            continue
-
-        # Пересечение возрастных диапазонов
-        if a_age_max < age_min or a_age_min > age_max:
-            continue
-
-        # Сравниваем человекочитаемые значения через _matches_multivalue
-        if not _matches_multivalue(time_h, a.get("time_required", "")):
-            continue
-        if not _matches_multivalue(energy_h, a.get("energy", "")):
-            continue
-        if not _matches_multivalue(place_h, a.get("location", "")):
-            continue
-
-        found_activities.append(a)
+    video_ids, text_ids = table.get(age_min, age_max, time_h, energy_h, place_h)[0]
+    found_activities = [by_id[aid] for aid in sorted(video_ids + text_ids)]
 
     count = len(found_activities)
     b = bucket(count)
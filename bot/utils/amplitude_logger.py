@@ -1,16 +1,47 @@
 import os
+import json
 import time
 import uuid
+import asyncio
 import requests
+from collections import deque
 from datetime import datetime
 from utils.logger import setup_logger
-from handlers.user_state import user_data
+from handlers.user_state import user_data, mark_dirty
 
 logger = setup_logger()
 
 AMPLITUDE_API_KEY = os.getenv("AMPLITUDE_API_KEY")
 AMPLITUDE_URL_EVENT = "https://api2.amplitude.com/2/httpapi"
 
+# ============================================================
+#   ОЧЕРЕДЬ + ФОНОВЫЙ ФЛАШЕР
+#   log_event только кладёт событие в очередь, а run_amplitude_flusher()
+#   раз в FLUSH_INTERVAL_SECONDS отправляет всё накопленное пачками.
+# ============================================================
+FLUSH_INTERVAL_SECONDS = 2
+# лимиты HTTP V2 API: до 2000 событий и ~1 МБ на запрос
+MAX_BATCH_EVENTS = 1000
+MAX_BATCH_BYTES = 900_000
+# потолок очереди, чтобы при долгой недоступности Amplitude не съесть всю память:
+# сверх него самые старые события уходят в дисковый спул (см. _trim_queue)
+MAX_QUEUE_EVENTS = 50_000
+MAX_RETRIES = 4
+RETRY_BASE_SECONDS = 0.5
+
+# сюда при остановке сохраняем то, что не успели отправить
+# (у бота и robokassa_server — свои файлы, см. run_amplitude_flusher)
+SPOOL_DIR = os.getenv("AMPLITUDE_SPOOL_DIR", "logs")
+
+# без maxlen: deque с maxlen молча выкидывает события с другого конца
+_queue: deque = deque()
+_flusher_running = False
+# файл спула текущего процесса (задаёт run_amplitude_flusher)
+_spool_path: str | None = None
+# события, которые не удалось ни отправить, ни сохранить на диск
+_dropped = 0
+_dropped_logged = 0
+
 
 def log_event(
     user_id: int,
@@ -21,6 +52,7 @@ def log_event(
 ):
     """
     Отправляет событие в Amplitude и обновляет контекст сессии.
+    Если запущен фоновый флашер — событие уходит в очередь, без сетевого вызова.
     """
     try:
         if mutate_session:
@@ -31,6 +63,7 @@ def log_event(
             if not ctx.get("first_event"):
                 ctx["first_event"] = event_name
             ctx["last_event"] = event_name
+            mark_dirty(user_id)
 
         # локальная среда (Replit) без API-ключа
         if not AMPLITUDE_API_KEY:
@@ -49,6 +82,13 @@ def log_event(
             "insert_id": str(uuid.uuid4()),
         }
 
+        if _flusher_running:
+            _queue.append(event)
+            if len(_queue) > MAX_QUEUE_EVENTS:
+                _trim_queue()
+            return
+
+        # флашер не запущен (скрипты из tools/) — шлём как раньше, синхронно
         resp = requests.post(
             AMPLITUDE_URL_EVENT,
             json={"api_key": AMPLITUDE_API_KEY, "events": [event]},
@@ -68,3 +108,178 @@ def set_user_properties(user_id: int, properties: dict):
     """Заглушка под Identify API."""
     logger.info(f"[amplitude:IDENTIFY_STUB] user={user_id} props={properties}")
     return
+
+
+# ============================================================
+#   ОТПРАВКА ПАЧЕК
+# ============================================================
+
+def _take_batch() -> list[dict]:
+    """Забирает из очереди пачку в пределах лимитов по количеству и размеру."""
+    batch, size = [], 0
+    while _queue and len(batch) < MAX_BATCH_EVENTS:
+        event = _queue[0]
+        event_size = len(json.dumps(event, ensure_ascii=False))
+        if batch and size + event_size > MAX_BATCH_BYTES:
+            break
+        batch.append(_queue.popleft())
+        size += event_size
+    return batch
+
+
+def _requeue(batch: list[dict]):
+    """Возвращает пачку в начало очереди (порядок сохраняется)."""
+    _queue.extendleft(reversed(batch))
+    _trim_queue()
+
+
+def _trim_queue():
+    """
+    Сверх MAX_QUEUE_EVENTS выносит самые старые события в дисковый спул
+    (дошлются при следующем старте). Свежие события не трогаем; если спул
+    не задан или запись упала — события теряются, но попадают в счётчик _dropped.
+    """
+    global _dropped
+    over = len(_queue) - MAX_QUEUE_EVENTS
+    if over <= 0:
+        return
+    overflow = [_queue.popleft() for _ in range(over)]
+    if _spool_path and _append_spool(_spool_path, overflow):
+        logger.warning(f"[amplitude] 💾 Queue full, spooled {len(overflow)} oldest events to {_spool_path}")
+        return
+    _dropped += len(overflow)
+
+
+def _report_dropped():
+    """Логирует потерянные события (раз за цикл флашера, а не на каждое событие)."""
+    global _dropped_logged
+    if _dropped != _dropped_logged:
+        logger.error(f"[amplitude] ❌ Dropped {_dropped - _dropped_logged} events "
+                     f"(total {_dropped}): queue full and spool unavailable")
+        _dropped_logged = _dropped
+
+
+async def _send_batch(session, batch: list[dict]) -> bool:
+    """
+    True — пачка доставлена (или отброшена как невалидная),
+    False — Amplitude недоступен, пачку надо повторить позже.
+    """
+    payload = {"api_key": AMPLITUDE_API_KEY, "events": batch}
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with session.post(AMPLITUDE_URL_EVENT, json=payload) as resp:
+                if resp.status == 200:
+                    logger.info(f"[amplitude:OK] batch={len(batch)}")
+                    return True
+
+                body = await resp.text()
+
+                if resp.status == 413 and len(batch) > 1:
+                    # слишком большая пачка — режем пополам
+                    half = len(batch) // 2
+                    return (await _send_batch(session, batch[:half])
+                            and await _send_batch(session, batch[half:]))
+
+                if resp.status == 400:
+                    # повтор не поможет — логируем и отбрасываем
+                    logger.error(f"[amplitude:ERROR] status=400 dropped batch={len(batch)} body={body[:500]}")
+                    return True
+
+                logger.warning(f"[amplitude:RETRY] status={resp.status} attempt={attempt + 1} body={body[:200]}")
+
+        except Exception as e:
+            logger.warning(f"[amplitude:RETRY] attempt={attempt + 1} error={e}")
+
+        await asyncio.sleep(RETRY_BASE_SECONDS * (2 ** attempt))
+
+    return False
+
+
+async def _flush(session) -> bool:
+    """Отправляет всё, что накопилось. False — если упёрлись в недоступность Amplitude."""
+    while _queue:
+        batch = _take_batch()
+        if not await _send_batch(session, batch):
+            _requeue(batch)
+            return False
+    return True
+
+
+# ============================================================
+#   ДИСКОВЫЙ СПУЛ (переживаем рестарт)
+# ============================================================
+
+def _load_spool(path: str):
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        os.remove(path)
+        _queue.extendleft(reversed(events))
+        logger.info(f"[amplitude] ♻️ Restored {len(events)} unsent events from {path}")
+        # спул больше потолка — лишнее (самое старое) обратно на диск
+        _trim_queue()
+    except Exception as e:
+        logger.warning(f"[amplitude] ⚠️ Failed to restore spool: {e}")
+
+
+def _append_spool(path: str, events) -> bool:
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        return True
+    except Exception as e:
+        logger.warning(f"[amplitude] ⚠️ Failed to save spool: {e}")
+        return False
+
+
+def _save_spool(path: str):
+    global _dropped
+    if not _queue:
+        return
+    count = len(_queue)
+    if _append_spool(path, _queue):
+        logger.info(f"[amplitude] 💾 Saved {count} unsent events to {path}")
+    else:
+        _dropped += count
+        _report_dropped()
+    _queue.clear()
+
+
+async def run_amplitude_flusher(process_name: str = "bot"):
+    """
+    Фоновая задача: раз в FLUSH_INTERVAL_SECONDS шлёт накопленные события.
+    При отмене (остановка процесса) делает последнюю попытку и сохраняет остаток
+    на диск; при следующем старте этот файл дочитывается и отправляется.
+    """
+    global _flusher_running, _spool_path
+    if not AMPLITUDE_API_KEY:
+        return
+
+    import aiohttp
+
+    spool_path = os.path.join(SPOOL_DIR, f"amplitude_spool_{process_name}.jsonl")
+    _spool_path = spool_path
+    _load_spool(spool_path)
+    _flusher_running = True
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        try:
+            while True:
+                await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+                try:
+                    await _flush(session)
+                except Exception as e:
+                    logger.warning(f"[amplitude] ❌ Flush error: {e}")
+                _report_dropped()
+        finally:
+            _flusher_running = False
+            try:
+                await asyncio.wait_for(_flush(session), timeout=5)
+            except BaseException:
+                pass
+            _save_spool(spool_path)
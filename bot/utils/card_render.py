@@ -0,0 +1,243 @@
+# utils/card_render.py
+"""
+Единый рендер карточек активностей (L0, L1, избранное, «поделиться»).
+
+Готовый текст, нарезка на куски и клавиатура кэшируются (LRU) по ключу
+(activity_id, версия каталога, вариант, is_favorite, кнопка клуба) —
+повторные показы одной идеи больше не собирают строки и разметку заново.
+
+Варианты:
+    "l0"        — витрина
+    "l1"        — подробная карточка из ленты
+    "fav_l1"    — подробная карточка, открытая из избранного
+    "l1_toggle" — клавиатура L1 после добавления/удаления из избранного
+    "share"     — текст для пересылки
+"""
+from collections import OrderedDict
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from db.activity_catalog import activity_catalog
+from db.feature_flags import is_enabled, get_flag
+
+# Экранируем подчеркивания для Markdown
+VIRAL_SIGNATURE = "\n\n🏡 Найдено в @blizkie\\_igry\\_bot"
+UGC_BLOCK = "\n\n💡 Есть идея игры? 👉 /suggest"
+
+CAPTION_LIMIT = 1024   # лимит подписи к медиа в Telegram
+CHUNK_SIZE = 3500      # режем длинный текст на сообщения с запасом до 4096
+
+RENDER_CACHE_SIZE = 2048
+
+_cache: OrderedDict = OrderedDict()
+
+
+class RenderedCard:
+    """Готовая к отправке карточка. Объекты общие для всех юзеров — не мутировать."""
+
+    __slots__ = ("caption", "text", "full", "short_caption", "chunks", "keyboard", "rest_chunks")
+
+    def __init__(self, caption, text, full, short_caption, chunks, keyboard, rest_chunks=()):
+        self.caption = caption              # заголовок (L1) / заголовок share
+        self.text = text                    # тело без заголовка
+        self.full = full                    # заголовок + тело, одним сообщением
+        self.short_caption = short_caption  # подпись к медиа, если full не влезает
+        self.chunks = chunks                # тело (для share — full), нарезанное по CHUNK_SIZE
+        self.keyboard = keyboard
+        self.rest_chunks = rest_chunks      # хвост full после short_caption (share с фото)
+
+    @property
+    def fits_caption(self) -> bool:
+        return len(self.full) <= CAPTION_LIMIT
+
+
+def _chunks(text: str) -> tuple[str, ...]:
+    return tuple(text[i:i + CHUNK_SIZE] for i in range(0, len(text), CHUNK_SIZE)) or ("",)
+
+
+def _club_text() -> str | None:
+    """Текст кнопки клуба, если клуб включён (входит в ключ кэша)."""
+    if is_enabled("community_club", default=False):
+        return get_flag("community_club").get("text", "Вступить в клуб родителей 🎁")
+    return None
+
+
+# ============================================================
+#   КЛАВИАТУРЫ
+# ============================================================
+
+def _fav_button(activity_id: int, is_favorite: bool) -> list:
+    return [InlineKeyboardButton(
+        text="В любимые ❤️" if not is_favorite else "Убрать из ❤️",
+        callback_data=f"{'favorite_add' if not is_favorite else 'remove_fav'}:{activity_id}",
+    )]
+
+
+def _build_keyboard(activity_id: int, variant: str, is_favorite: bool,
+                    club: str | None) -> InlineKeyboardMarkup | None:
+    next_row = [InlineKeyboardButton(text="Следующую ⏩️", callback_data="activity_next")]
+    filters_row = [InlineKeyboardButton(text="Поменять фильтры 🎛️", callback_data="update_filters")]
+    feedback_row = [InlineKeyboardButton(text="💬 Оставить отзыв", callback_data=f"feedback_button:{activity_id}")]
+    club_rows = [[InlineKeyboardButton(text=club, callback_data="community_join")]] if club else []
+
+    if variant == "l0":
+        rows = [
+            [InlineKeyboardButton(text="Играем ▶️", callback_data=f"activity_details:{activity_id}")],
+            _fav_button(activity_id, is_favorite),
+            next_row,
+            *club_rows,
+            filters_row,
+        ]
+    elif variant == "l1":
+        rows = [
+            _fav_button(activity_id, is_favorite),
+            next_row,
+            *club_rows,
+            filters_row,
+            [InlineKeyboardButton(text="Поделиться ↩️", callback_data=f"share_activity:{activity_id}")],
+            feedback_row,
+        ]
+    elif variant == "fav_l1":
+        rows = [
+            [InlineKeyboardButton(text="Убрать из любимых ✖️", callback_data=f"remove_fav:{activity_id}")],
+            next_row,
+            filters_row,
+            [InlineKeyboardButton(text="Поделиться ↩️", callback_data=f"share_activity:{activity_id}")],
+            feedback_row,
+        ]
+    elif variant == "l1_toggle":
+        fav_row = (
+            [InlineKeyboardButton(text="Убрать из любимых ✖️", callback_data=f"remove_fav:{activity_id}")]
+            if is_favorite else
+            [InlineKeyboardButton(text="Добавить в любимые ❤️", callback_data=f"favorite_add:{activity_id}")]
+        )
+        rows = [
+            fav_row,
+            next_row,
+            filters_row,
+            [InlineKeyboardButton(text="Поделитесь этой идеей ↩️", callback_data=f"share_activity:{activity_id}")],
+            feedback_row,
+        ]
+    else:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+# ============================================================
+#   ТЕКСТЫ
+# ============================================================
+
+def _render_l0(activity: dict, keyboard) -> RenderedCard:
+    text = (f"🎲 *{activity['title']}*\n\n"
+            f"{activity['short_description']}\n\n"
+            f"💡 {' • '.join(activity['summary'] or [])}\n\n"
+            f"📦 Материалы: {activity['materials'] or 'Не требуются'}"
+            f"{VIRAL_SIGNATURE}")
+    return RenderedCard(None, text, text, text, _chunks(text), keyboard)
+
+
+def _render_l1(activity: dict, keyboard) -> RenderedCard:
+    summary = "\n".join([f"💡 {s}" for s in (activity.get("summary") or [])])
+    caption_title = f"🎲 *{activity['title']}*"
+
+    author = activity.get("author")
+    author_url = activity.get("source_url")
+    author_block = ""
+    if author and author_url:
+        author_block = f"\n\n👤 Автор: [{author}]({author_url})"
+
+    full_text = (
+        f"⏱️ {activity['time_required']} • ⚡️ {activity['energy']} • 📍 {activity['location']}\n\n"
+        f"Материалы: {activity['materials'] or 'Не требуются'}\n\n"
+        f"{activity['full_description']}\n\n"
+        f"{summary}"
+        f"{author_block}"
+        f"{VIRAL_SIGNATURE}"
+        f"{UGC_BLOCK}")
+
+    return RenderedCard(
+        caption_title,
+        full_text,
+        f"{caption_title}\n\n{full_text}",
+        f"{caption_title}{VIRAL_SIGNATURE}",
+        _chunks(full_text),
+        keyboard,
+    )
+
+
+def _render_share(activity: dict) -> RenderedCard:
+    age_str = f"{activity['age_min']}-{activity['age_max']} лет" if activity.get("age_min") else "не указан"
+    materials = activity.get("materials", None)
+    summary_lines = "\n".join([f"💡 {s}" for s in (activity.get("summary") or [])])
+
+    author = activity.get("author")
+    url = activity.get("source_url")
+    author_block = (f"[{author}]({url})" if url else author) if author else ""
+
+    caption = f"🎲 Идея для родителя: *{activity['title']}*"
+    text_parts = [
+        f"🧒 {age_str}",
+        f"⏳ {activity.get('time_required', 'не указано')}",
+        f"⚡️ {activity.get('energy', 'не указана')}",
+        f"📍 {activity.get('location', 'не указано')}",
+        "",
+        f"📦 Материалы: {materials}" if materials else "",
+        "",
+        activity.get("full_description", ""),
+        "",
+        summary_lines,
+        "",
+    ]
+    if author_block:
+        text_parts.append(author_block)
+        text_parts.append("")
+    text_parts.append(VIRAL_SIGNATURE.strip())
+    text = "\n".join(text_parts)
+
+    full = f"{caption}\n\n{text}"
+    rest = _chunks(full[CAPTION_LIMIT:]) if len(full) > CAPTION_LIMIT else ()
+    return RenderedCard(caption, text, full, full[:CAPTION_LIMIT], _chunks(full), None, rest)
+
+
+# ============================================================
+#   ПУБЛИЧНОЕ API
+# ============================================================
+
+def render_card(activity: dict, variant: str, *, is_favorite: bool = False) -> RenderedCard:
+    """Готовая карточка активности в нужном варианте (из LRU-кэша, если уже собиралась)."""
+    club = _club_text() if variant in ("l0", "l1") else None
+    key = (activity["id"], activity_catalog.version, variant, is_favorite, club)
+
+    card = _cache.get(key)
+    if card is not None:
+        _cache.move_to_end(key)
+        return card
+
+    keyboard = _build_keyboard(activity["id"], variant, is_favorite, club)
+    if variant == "l0":
+        card = _render_l0(activity, keyboard)
+    elif variant == "share":
+        card = _render_share(activity)
+    else:
+        card = _render_l1(activity, keyboard)
+
+    _cache[key] = card
+    if len(_cache) > RENDER_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return card
+
+
+def card_keyboard(activity_id: int, variant: str, *, is_favorite: bool = False) -> InlineKeyboardMarkup:
+    """Только клавиатура (когда текст карточки уже в сообщении)."""
+    club = _club_text() if variant in ("l0", "l1") else None
+    key = (activity_id, None, f"kb:{variant}", is_favorite, club)
+
+    keyboard = _cache.get(key)
+    if keyboard is None:
+        keyboard = _build_keyboard(activity_id, variant, is_favorite, club)
+        _cache[key] = keyboard
+        if len(_cache) > RENDER_CACHE_SIZE:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(key)
+    return keyboard
@@ -0,0 +1,238 @@
+# utils/entitlements.py
+"""
+Кэш прав доступа юзера (премиум / триал / лимиты пейволла).
+
+Раньше каждый guard (should_block_l0/l1) заново ходил в premium_overrides,
+user_subscriptions и user_sessions — до восьми запросов на один тап по L1.
+Теперь всё это считается один раз в get_entitlement() и живёт ENTITLEMENT_TTL_SECONDS.
+Счётчики просмотров не кэшируются — они всегда берутся из db/seen_state (в памяти).
+
+Кэш свой в каждом процессе бота / воркера. При изменении подписки:
+- invalidate_entitlement — сброс в текущем процессе (воркер пушей на
+  premium_welcome);
+- bump_entitlements_stamp — сброс во всех процессах: robokassa_server после
+  оплаты меняет флаг entitlements_stamp, и каждая запись кэша, посчитанная
+  при другом stamp, пересчитывается. Процессы видят новый stamp с
+  обновлением фич-флагов (не дольше feature_flags.CACHE_TTL_SECONDS).
+"""
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from db.supabase_client import supabase
+from db.seen_state import get_seen_state
+from db.feature_flags import get_flag
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+# Сколько живёт посчитанное право доступа
+ENTITLEMENT_TTL_SECONDS = 300
+# Если при расчёте что-то упало — держим результат недолго и пересчитываем
+ENTITLEMENT_ERROR_TTL_SECONDS = 30
+# Флаг, которым платёжный сервер сбрасывает кэш прав во всех процессах
+ENTITLEMENTS_STAMP_FLAG = "entitlements_stamp"
+# Потолок числа закэшированных юзеров (давно не спрошенные вытесняются первыми)
+ENTITLEMENT_MAX_ENTRIES = 20000
+
+
+def _parse_ts(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        # Fallback для форматов без таймзоны
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+class Entitlement:
+    """
+    Что юзеру можно. premium_until / trial_until = None означает «без срока»
+    (для премиума) и «триала нет» (для триала).
+    l0_limit / l1_limit = None — лимиты выключены глобально.
+    """
+
+    __slots__ = ("user_id", "is_premium", "premium_until", "trial_until",
+                 "l0_limit", "l1_limit", "expires_at", "stamp")
+
+    def __init__(self, user_id, is_premium, premium_until, trial_until,
+                 l0_limit, l1_limit, ttl, stamp=None):
+        self.user_id = user_id
+        self.is_premium = is_premium
+        self.premium_until = premium_until
+        self.trial_until = trial_until
+        self.l0_limit = l0_limit
+        self.l1_limit = l1_limit
+        self.expires_at = time.time() + ttl
+        self.stamp = stamp
+
+    def premium_active(self, now: datetime | None = None) -> bool:
+        if not self.is_premium:
+            return False
+        if self.premium_until is None:
+            return True
+        return (now or datetime.now(timezone.utc)) < self.premium_until
+
+    def in_trial(self, now: datetime | None = None) -> bool:
+        if self.trial_until is None:
+            return False
+        return (now or datetime.now(timezone.utc)) < self.trial_until
+
+    def is_gated(self) -> bool:
+        """Распространяются ли на юзера лимиты пейволла."""
+        now = datetime.now(timezone.utc)
+        if self.premium_active(now) or self.in_trial(now):
+            return False
+        return self.l0_limit is not None
+
+    @property
+    def l0_count(self) -> int:
+        return get_seen_state(self.user_id).l0_count
+
+    @property
+    def l1_count(self) -> int:
+        return get_seen_state(self.user_id).l1_count
+
+    def blocks_l0(self) -> bool:
+        return self.is_gated() and self.l0_count >= self.l0_limit
+
+    def blocks_l1(self) -> bool:
+        return self.is_gated() and self.l1_count >= self.l1_limit
+
+
+_lock = threading.Lock()
+_CACHE: OrderedDict = OrderedDict()
+
+
+# ============================================================
+#   РАСЧЁТ
+# ============================================================
+
+def _resolve_premium(user_id: int) -> tuple[bool, datetime | None]:
+    """(премиум?, до какого момента). Логика та же, что в db/user_status.is_premium_user."""
+    r = (
+        supabase.table("premium_overrides")
+        .select("is_premium")
+        .eq("user_id", user_id)
+        .limit(1)
+        .execute()
+    )
+    if r.data and r.data[0].get("is_premium"):
+        return True, None
+
+    r2 = (
+        supabase.table("user_subscriptions")
+        .select("is_active, expires_at")
+        .eq("user_id", user_id)
+        .limit(1)
+        .execute()
+    )
+    row = (r2.data or [None])[0]
+    if not row or not row.get("is_active"):
+        return False, None
+    try:
+        # нет expires_at или странный формат — считаем активным (лучше доступ, чем блок)
+        return True, _parse_ts(row.get("expires_at"))
+    except Exception:
+        return True, None
+
+
+def _resolve_trial_until(user_id: int, trial_days: int | None) -> datetime | None:
+    """Конец триала: первая сессия из user_sessions + trial_days."""
+    if not trial_days:
+        return None  # Триал выключен
+
+    res = (
+        supabase.table("user_sessions")
+        .select("created_at")
+        .eq("user_id", user_id)
+        .order("created_at", desc=False)
+        .limit(1)
+        .execute()
+    )
+    created_at = _parse_ts(res.data[0].get("created_at")) if res.data else None
+    if created_at is None:
+        # сессий ещё нет — юзер новенький, триал отсчитываем от сейчас
+        created_at = datetime.now(timezone.utc)
+    return created_at + timedelta(days=trial_days)
+
+
+def _current_stamp():
+    return get_flag(ENTITLEMENTS_STAMP_FLAG).get("stamp")
+
+
+def _compute(user_id: int) -> Entitlement:
+    from utils.paywall_guard import _get_paywall_config, _get_trial_config
+
+    # stamp берём до запросов: сброс, пришедший во время расчёта, его обесценит
+    stamp = _current_stamp()
+    ttl = ENTITLEMENT_TTL_SECONDS
+    rules = _get_paywall_config()
+
+    try:
+        is_premium, premium_until = _resolve_premium(user_id)
+    except Exception as e:
+        logger.warning(f"[entitlements] premium error for {user_id}: {e}")
+        is_premium, premium_until, ttl = False, None, ENTITLEMENT_ERROR_TTL_SECONDS
+
+    trial_until = None
+    premium_now = is_premium and (premium_until is None or premium_until > datetime.now(timezone.utc))
+    if not premium_now:
+        trial_days = _get_trial_config()
+        try:
+            trial_until = _resolve_trial_until(user_id, trial_days)
+        except Exception as e:
+            logger.warning(f"[entitlements] trial check error for {user_id}: {e}")
+            # Fail Open: при ошибке не блокируем, но и не держим это долго
+            if trial_days:
+                trial_until = datetime.now(timezone.utc) + timedelta(seconds=ENTITLEMENT_ERROR_TTL_SECONDS)
+            ttl = ENTITLEMENT_ERROR_TTL_SECONDS
+
+    return Entitlement(
+        user_id,
+        is_premium,
+        premium_until,
+        trial_until,
+        rules["l0"] if rules else None,
+        rules["l1"] if rules else None,
+        ttl,
+        stamp,
+    )
+
+
+# ============================================================
+#   ПУБЛИЧНОЕ API
+# ============================================================
+
+def get_entitlement(user_id: int) -> Entitlement:
+    """Права юзера из кэша; пересчитывает, если запись протухла или её нет."""
+    ent = _CACHE.get(user_id)
+    if ent is not None and ent.expires_at > time.time() and ent.stamp == _current_stamp():
+        return ent
+
+    ent = _compute(user_id)
+    with _lock:
+        _CACHE[user_id] = ent
+        _CACHE.move_to_end(user_id)
+        while len(_CACHE) > ENTITLEMENT_MAX_ENTRIES:
+            _CACHE.popitem(last=False)
+    return ent
+
+
+def invalidate_entitlement(user_id: int):
+    """Сбрасывает кэш прав — вызывать после оплаты / отмены / ручного оверрайда."""
+    with _lock:
+        _CACHE.pop(user_id, None)
+
+
+def bump_entitlements_stamp():
+    """
+    Сбрасывает кэш прав во всех процессах (после оплаты в robokassa_server).
+    Синхронный запрос в feature_flags.
+    """
+    supabase.table("feature_flags").upsert(
+        {"key": ENTITLEMENTS_STAMP_FLAG, "value_json": {"stamp": time.time_ns()}},
+        on_conflict="key",
+    ).execute()
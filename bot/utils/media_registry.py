@@ -0,0 +1,138 @@
+# utils/media_registry.py
+"""
+Реестр file_id для картинок, которые бот шлёт по URL.
+
+Telegram при отправке фото по URL каждый раз заново качает его из Supabase Storage.
+Отправка по file_id быстрее и не тратит трафик storage, поэтому первый ответ
+Telegram на каждый URL запоминаем (в памяти + таблица media_file_ids,
+см. db/sql/media_file_ids.sql) и дальше шлём уже file_id.
+
+file_id привязан к боту, так что ключ — хэш токена + ENV: dev и prod
+(и любой перевыпуск токена) ведут свои записи.
+
+    msg = await send_photo(message.answer_photo, PHOTO_URL, caption=...)
+    msg = await edit_photo(message, PHOTO_URL, caption=..., reply_markup=...)
+
+Видео здесь не нужны — в activities уже лежат готовые video_file_id(_prod).
+"""
+import asyncio
+import hashlib
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InputMediaPhoto
+
+from config import BOT_TOKEN, ENV
+from db.async_repo import load_media_file_ids, save_media_file_id, delete_media_file_id
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+BOT_KEY = hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:16]
+
+# Ответы Bot API на file_id, который бот больше не может использовать.
+# Проверяем их только когда слали именно file_id, поэтому «wrong file
+# identifier/HTTP URL» здесь всегда про него. Прочие ошибки про файл
+# («file is too big» и т.п.) file_id не забывают.
+FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "wrong padding",
+    "wrong string length",
+    "file reference expired",
+    "file_reference_expired",
+)
+
+_FILE_IDS: dict[str, str] = {}
+_loaded = False
+_load_lock = asyncio.Lock()
+
+
+async def _ensure_loaded():
+    """Один раз за процесс подтягивает уже известные file_id из БД."""
+    global _loaded
+    if _loaded:
+        return
+    async with _load_lock:
+        if _loaded:
+            return
+        try:
+            for row in await load_media_file_ids(BOT_KEY, ENV):
+                _FILE_IDS[row["url"]] = row["file_id"]
+            logger.info(f"[media_registry] ✅ Loaded {len(_FILE_IDS)} file_ids")
+        except Exception as e:
+            # таблицы нет / БД недоступна — работаем по URL, запоминаем только в памяти
+            logger.warning(f"[media_registry] ⚠️ Failed to load file_ids: {e}")
+        _loaded = True
+
+
+async def photo_ref(url: str) -> str:
+    """Что передать в photo=/media=: file_id, если он уже известен, иначе сам URL."""
+    await _ensure_loaded()
+    return _FILE_IDS.get(url, url)
+
+
+async def remember(url: str, message) -> None:
+    """Запоминает file_id из ответа Telegram на отправку фото по URL."""
+    if url in _FILE_IDS or not getattr(message, "photo", None):
+        return
+    file_id = message.photo[-1].file_id  # самый крупный размер
+    _FILE_IDS[url] = file_id
+    try:
+        await save_media_file_id({
+            "bot_key": BOT_KEY,
+            "env": ENV,
+            "url": url,
+            "kind": "photo",
+            "file_id": file_id,
+        })
+    except Exception as e:
+        logger.warning(f"[media_registry] ⚠️ Failed to save file_id for {url}: {e}")
+
+
+async def forget(url: str) -> None:
+    """Убирает file_id, который Telegram перестал принимать."""
+    if _FILE_IDS.pop(url, None) is None:
+        return
+    try:
+        await delete_media_file_id(BOT_KEY, ENV, url)
+    except Exception as e:
+        logger.warning(f"[media_registry] ⚠️ Failed to delete file_id for {url}: {e}")
+
+
+def _is_file_id_error(e: TelegramBadRequest) -> bool:
+    text = str(e).lower()
+    return any(marker in text for marker in FILE_ID_ERRORS)
+
+
+async def send_photo(send, url: str, **kwargs):
+    """
+    Отправка фото через реестр. send — любой вызов, принимающий photo=
+    (message.answer_photo, bot.send_photo с chat_id и т.п.).
+    Если сохранённый file_id отвергнут — забываем его и шлём по URL.
+    """
+    ref = await photo_ref(url)
+    try:
+        message = await send(photo=ref, **kwargs)
+    except TelegramBadRequest as e:
+        if ref == url or not _is_file_id_error(e):
+            raise
+        logger.warning(f"[media_registry] ♻️ file_id rejected for {url}: {e}")
+        await forget(url)
+        ref = url
+        message = await send(photo=url, **kwargs)
+
+    if ref == url:
+        await remember(url, message)
+    return message
+
+
+async def edit_photo(message, url: str, *, reply_markup=None, **media_kwargs):
+    """
+    message.edit_media(InputMediaPhoto(...)) через реестр — с тем же откатом
+    на URL, если сохранённый file_id отвергнут. media_kwargs — поля
+    InputMediaPhoto (caption, parse_mode, ...).
+    """
+    async def _edit(photo):
+        return await message.edit_media(media=InputMediaPhoto(media=photo, **media_kwargs),
+                                        reply_markup=reply_markup)
+    return await send_photo(_edit, url)
@@ -2,33 +2,15 @@ import hashlib
 import urllib.parse
 import json
 from datetime import datetime
-from db.supabase_client import supabase
+from db.feature_flags import require_flag
 
 # ====== SETTINGS LOADER ======
 def get_rk_settings() -> dict:
-    row = (
-        supabase.table("feature_flags")
-        .select("value_json")
-        .eq("key", "robokassa_keys")
-        .maybe_single()
-        .execute()
-    )
-    if not row or not row.data:
-        raise RuntimeError("feature_flags: robokassa_keys not found")
-    return row.data["value_json"]
+    return require_flag("robokassa_keys")
 
 
 def get_paywall_settings() -> dict:
-    row = (
-        supabase.table("feature_flags")
-        .select("value_json")
-        .eq("key", "paywall_requisites")
-        .maybe_single()
-        .execute()
-    )
-    if not row or not row.data:
-        raise RuntimeError("feature_flags: paywall_requisites not found")
-    return row.data["value_json"]
+    return require_flag("paywall_requisites")
 
 
 # ====== FISCAL RECEIPT (Robokassa docs) ======
@@ -1,8 +1,12 @@
 # utils/session_tracker.py
 import asyncio
+import threading
+from contextvars import ContextVar
+from types import MappingProxyType
 from datetime import datetime, timedelta, timezone
 from db.supabase_client import supabase
-from handlers.user_state import user_data
+from db.async_repo import run_db, upsert_sessions, count_favorites
+from handlers.user_state import user_data, mark_dirty, pop_dirty
 from utils.logger import setup_logger
 from utils.push_scheduler import (
     schedule_retention_nudges,
@@ -11,7 +15,7 @@ from utils.push_scheduler import (
     schedule_interview_invite,
 )
 from utils.paywall_guard import is_user_limited, is_premium
-from db.feature_flags import get_flag  # 👈 добавили импорт
+from db.feature_flags import get_flag, flags_version  # 👈 добавили импорт
 
 logger = setup_logger()
 
@@ -67,37 +71,74 @@ def _get_session_config() -> dict:
         return {}
 
 
-def _get_session_timeout_for_user(user_id: int | None) -> int:
+def _to_int(value, default: int) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class SessionTrackerConfig:
     """
-    Возвращает таймаут сессии в минутах.
-    1) Берём общий SESSION_TIMEOUT_MINUTES из config или дефолта.
-    2) Если есть per_user-override для этого user_id — используем его.
+    Скомпилированный конфиг трекинга сессий — один объект на версию feature_flags.
+    Неизменяемый: при обновлении флагов собирается новый и подменяется целиком.
+    per_user уже разобран в {int user_id: timedelta}, поиск таймаута — O(1).
     """
-    cfg = _get_session_config()
-    default_timeout = cfg.get("SESSION_TIMEOUT_MINUTES", SESSION_TIMEOUT_MINUTES)
 
-    try:
-        default_timeout = int(default_timeout)
-    except (TypeError, ValueError):
-        default_timeout = SESSION_TIMEOUT_MINUTES
+    __slots__ = ("flags_version", "timeout", "timeout_minutes", "sync_interval", "_per_user")
 
-    if user_id is None:
-        return default_timeout
+    def __init__(self, cfg: dict, version: int):
+        default_timeout = _to_int(cfg.get("SESSION_TIMEOUT_MINUTES", SESSION_TIMEOUT_MINUTES),
+                                  SESSION_TIMEOUT_MINUTES)
 
-    per_user = cfg.get("per_user") or {}
-    # user_id может быть строкой или числом в JSON, подстрахуемся
-    user_cfg = (
-        per_user.get(str(user_id))
-        or per_user.get(user_id)
-    )
+        per_user: dict[int, timedelta] = {}
+        for raw_id, user_cfg in (cfg.get("per_user") or {}).items():
+            # user_id может быть строкой или числом в JSON
+            if not isinstance(user_cfg, dict) or "SESSION_TIMEOUT_MINUTES" not in user_cfg:
+                continue
+            try:
+                per_user[int(raw_id)] = timedelta(minutes=int(user_cfg["SESSION_TIMEOUT_MINUTES"]))
+            except (TypeError, ValueError):
+                continue
+
+        object.__setattr__(self, "flags_version", version)
+        object.__setattr__(self, "timeout_minutes", default_timeout)
+        object.__setattr__(self, "timeout", timedelta(minutes=default_timeout))
+        object.__setattr__(self, "sync_interval",
+                           _to_int(cfg.get("SYNC_INTERVAL_SECONDS", SYNC_INTERVAL_SECONDS),
+                                   SYNC_INTERVAL_SECONDS))
+        object.__setattr__(self, "_per_user", MappingProxyType(per_user))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SessionTrackerConfig is immutable")
+
+    def timeout_for(self, user_id: int | None) -> timedelta:
+        if user_id is None:
+            return self.timeout
+        return self._per_user.get(user_id, self.timeout)
+
+
+_compiled_cfg: SessionTrackerConfig | None = None
 
-    if isinstance(user_cfg, dict) and "SESSION_TIMEOUT_MINUTES" in user_cfg:
-        try:
-            return int(user_cfg["SESSION_TIMEOUT_MINUTES"])
-        except (TypeError, ValueError):
-            pass
 
-    return default_timeout
+def get_session_tracker_config() -> SessionTrackerConfig:
+    """Текущий скомпилированный конфиг; пересобирается, только если поменялись флаги."""
+    global _compiled_cfg
+    version = flags_version()
+    cfg = _compiled_cfg
+    if cfg is None or cfg.flags_version != version:
+        cfg = SessionTrackerConfig(_get_session_config(), version)
+        _compiled_cfg = cfg  # атомарная подмена ссылки
+    return cfg
+
+
+def _get_session_timeout_for_user(user_id: int | None) -> int:
+    """
+    Возвращает таймаут сессии в минутах.
+    1) Берём общий SESSION_TIMEOUT_MINUTES из config или дефолта.
+    2) Если есть per_user-override для этого user_id — используем его.
+    """
+    return int(get_session_tracker_config().timeout_for(user_id).total_seconds() // 60)
 
 
 def _get_sync_interval() -> int:
@@ -105,12 +146,63 @@ def _get_sync_interval() -> int:
     Интервал синка в секундах.
     Общий (глобальный), но берётся через feature_flags.
     """
-    cfg = _get_session_config()
-    value = cfg.get("SYNC_INTERVAL_SECONDS", SYNC_INTERVAL_SECONDS)
+    return get_session_tracker_config().sync_interval
+
+
+# ============================================================
+#   ОЧИСТКА PENDING-ПУШЕЙ ПРИ НОВОЙ СЕССИИ
+#   touch_user_activity только кладёт user_id в _opened_sessions (повторы схлопываются),
+#   а run_session_open_cleanup раз в тик удаляет pending-пуши всех этих юзеров
+#   одним delete ... in_("user_id", [...]).
+# ============================================================
+SESSION_OPEN_CLEANUP_SECONDS = 1
+SESSION_OPEN_CLEANUP_CHUNK = 200
+
+_opened_sessions: set[int] = set()
+_opened_lock = threading.Lock()
+
+
+def flush_session_open_cleanup() -> int:
+    """Удаляет pending-пуши (кроме premium_ritual) у юзеров, открывших новую сессию."""
+    with _opened_lock:
+        user_ids = list(_opened_sessions)
+        _opened_sessions.clear()
+    if not user_ids:
+        return 0
+
+    done = 0
     try:
-        return int(value)
-    except (TypeError, ValueError):
-        return SYNC_INTERVAL_SECONDS
+        for i in range(0, len(user_ids), SESSION_OPEN_CLEANUP_CHUNK):
+            chunk = user_ids[i:i + SESSION_OPEN_CLEANUP_CHUNK]
+            (
+                supabase.table("push_queue")
+                .delete()
+                .in_("user_id", chunk)
+                .eq("status", "pending")
+                .neq("type", "premium_ritual")
+                .execute()
+            )
+            done += len(chunk)
+    except Exception as e:
+        logger.warning(f"[session] ⚠️ Clear pending pushes failed ({len(user_ids) - done} users), retry later: {e}")
+        with _opened_lock:
+            _opened_sessions.update(user_ids[done:])
+
+    if done:
+        logger.info(f"[session] 🧹 Cleared pending pushes except premium_ritual for {done} users")
+    return done
+
+
+async def run_session_open_cleanup():
+    """Фоновая задача: пачкой чистит push_queue для только что открытых сессий."""
+    while True:
+        await asyncio.sleep(SESSION_OPEN_CLEANUP_SECONDS)
+        if not _opened_sessions:
+            continue
+        try:
+            await run_db(flush_session_open_cleanup)
+        except Exception as e:
+            logger.warning(f"[session] ❌ Cleanup error: {e}")
 
 
 def get_current_session_id(user_id: int) -> str | None:
@@ -118,15 +210,60 @@ def get_current_session_id(user_id: int) -> str | None:
     return ctx.get("session_id") if ctx else None
 
 
+class SessionTouch:
+    """Результат touch_user_activity: какая сессия у юзера и открыта ли она только что."""
+
+    __slots__ = ("user_id", "session_id", "is_new_session")
+
+    def __init__(self, user_id: int, session_id: str, is_new_session: bool):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.is_new_session = is_new_session
+
+    def __repr__(self):
+        return f"SessionTouch(user_id={self.user_id}, session_id={self.session_id!r}, new={self.is_new_session})"
+
+
+# touch текущего апдейта: ActivityMiddleware выставляет, повторные вызовы в том же апдейте — no-op
+_current_touch: ContextVar[SessionTouch | None] = ContextVar("session_touch", default=None)
+
+
+def touch_once(
+    user_id: int,
+    *,
+    source: str | None = None,
+    device_info: dict | None = None,
+    username: str | None = None,
+) -> SessionTouch:
+    """
+    touch_user_activity не чаще одного раза на апдейт.
+    Вне апдейта (воркеры, скрипты) — обычный touch.
+    """
+    touch = _current_touch.get()
+    if touch is not None and touch.user_id == user_id:
+        return touch
+    return touch_user_activity(user_id, source=source, device_info=device_info, username=username)
+
+
+def begin_update_touch(touch: SessionTouch):
+    """Запоминает touch для текущего апдейта; вернуть токен в end_update_touch()."""
+    return _current_touch.set(touch)
+
+
+def end_update_touch(token):
+    _current_touch.reset(token)
+
+
 def touch_user_activity(
     user_id: int,
     *,
     source: str | None = None,
     device_info: dict | None = None,
     username: str | None = None,
-):
+) -> SessionTouch:
     now = _utcnow()
     ctx = user_data.setdefault(user_id, {})
+    mark_dirty(user_id)
 
     # 👇 сохраняем последний известный username, если он есть
     if username is not None:
@@ -147,8 +284,7 @@ def touch_user_activity(
         if last_seen.tzinfo is None:
             last_seen = last_seen.replace(tzinfo=timezone.utc)
 
-        timeout_minutes = _get_session_timeout_for_user(user_id)
-        if (now - last_seen) <= timedelta(minutes=timeout_minutes):
+        if (now - last_seen) <= get_session_tracker_config().timeout_for(user_id):
             ctx["last_seen"] = now
             ctx["last_event"] = "activity"
             ctx["actions_count"] = int(ctx.get("actions_count", 0)) + 1
@@ -156,7 +292,7 @@ def touch_user_activity(
                 ctx["source"] = source
             if device_info is not None:
                 ctx["device_info"] = device_info
-            return  # ✅ НИКАКОГО создания новой сессии
+            return SessionTouch(user_id, sid, False)  # ✅ НИКАКОГО создания новой сессии
 
     # ✅ 2. Если тут — старая сессия закрыта ИЛИ её не было → создаём новую
     sid = f"{user_id}_{now.strftime('%Y%m%d_%H%M%S')}"
@@ -173,21 +309,12 @@ def touch_user_activity(
     if device_info is not None:
         ctx["device_info"] = device_info
 
-    try:
-        (
-            supabase.table("push_queue")
-            .delete()
-            .eq("user_id", user_id)
-            .eq("status", "pending")
-            .neq("type", "premium_ritual")
-            .execute()
-        )
-
-        logger.info(f"[session] 🧹 Cleared pending pushes except premium_ritual user={user_id}")
-    except Exception as e:
-        logger.warning(f"[session] ⚠️ Clear pending pushes failed user={user_id}: {e}")
+    # pending-пуши (кроме premium_ritual) чистим фоном, пачкой — см. run_session_open_cleanup
+    with _opened_lock:
+        _opened_sessions.add(user_id)
 
     logger.info(f"[session] 🆕 New session created for user={user_id}")
+    return SessionTouch(user_id, sid, True)
 
 
 def mark_seen(
@@ -196,8 +323,8 @@ def mark_seen(
     source: str | None = None,
     device_info: dict | None = None,
     username: str | None = None,
-):
-    return touch_user_activity(
+) -> SessionTouch:
+    return touch_once(
         user_id,
         source=source,
         device_info=device_info,
@@ -205,143 +332,160 @@ def mark_seen(
     )
 
 
-def new_session_if_needed(
-    user_id: int,
-    *,
-    source: str | None = None,
-    device_info: dict | None = None,
-    username: str | None = None,
-):
-    return touch_user_activity(
-        user_id,
-        source=source,
-        device_info=device_info,
-        username=username,
-    )
+# старое имя: touch_user_activity и так открывает новую сессию, если нужно
+new_session_if_needed = mark_seen
+
+
+def _session_row(user_id: int, ctx: dict, now: datetime,
+                 cfg: SessionTrackerConfig) -> tuple[dict, bool]:
+    """Строка для user_sessions (без favorites_count) + истёк ли таймаут сессии."""
+    created_at = ctx.get("created_at") or now
+    last_seen = ctx.get("last_seen") or created_at
+
+    # safety: приводим к aware
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    if last_seen.tzinfo is None:
+        last_seen = last_seen.replace(tzinfo=timezone.utc)
+
+    inactive = (now - last_seen) > cfg.timeout_for(user_id)
+    ended_at = last_seen if inactive else None
+
+    filters = {
+        k: ctx.get(k)
+        for k in ("age_min", "age_max", "time_required", "energy", "location")
+    } or {}
+
+    duration = int((last_seen - created_at).total_seconds())
+    if duration < 0:
+        duration = 0
+
+    return {
+        "session_id": ctx.get("session_id"),
+        "user_id": user_id,
+        "username": ctx.get("username"),
+        "started_at": _iso(created_at),
+        "last_seen": _iso(last_seen),
+        "ended_at": _iso(ended_at),
+        "duration_seconds": duration,
+        "filters": filters,
+        "actions_count": int(ctx.get("actions_count", 0)),
+        "favorites_count": 0,
+        "first_event": ctx.get("first_event"),
+        "last_event": ctx.get("last_event"),
+        "source": ctx.get("source"),
+        "device_info": ctx.get("device_info") or {},
+    }, inactive
+
+
+async def _schedule_session_end_pushes(user_id: int, ctx: dict):
+    """Сессия только что закрылась по таймауту — ставим подходящую цепочку пушей."""
+    try:
+        # 1) Бесплатный, который УПЁРСЯ в лимит → paywall follow-up
+        if await run_db(is_user_limited, user_id):
+            reason = ctx.get("last_paywall_reason") or "session_end"
+            await run_db(schedule_paywall_followup, user_id, reason=reason)
+            logger.info(f"[session_tracker] 📬 Paywall-followup scheduled for user={user_id}")
+
+        else:
+            # 2) Лимит НЕ достигнут — различаем премиум / не премиум
+            if await run_db(is_premium, user_id):
+                # Новая редкая цепочка для подписчиков
+                await run_db(schedule_retention_nudges_subscribers, user_id)
+                logger.info(
+                    f"[session_tracker] 📬 Retention-nudges SUBSCRIBERS scheduled for user={user_id}"
+                )
+                try:
+                    await run_db(schedule_interview_invite, user_id)
+                except Exception as e:
+                    logger.error(
+                        f"[session_tracker] interview_invite error for user={user_id}: {e}"
+                    )
+            else:
+                # Бесплатный, который не достиг лимита
+                await run_db(schedule_retention_nudges, user_id)
+                logger.info(
+                    f"[session_tracker] 📬 Retention-nudges scheduled for user={user_id}"
+                )
+
+    except Exception as e:
+        logger.warning(f"[session_tracker] ❌ Push schedule error user={user_id}: {e}")
 
 
 async def sync_sessions_to_db():
+    """
+    Раз в SYNC_INTERVAL_SECONDS пишем в user_sessions только то, что изменилось:
+    сессии, тронутые с прошлого синка (dirty_users), и те, что только что
+    закрылись по таймауту. Всё — одним bulk upsert, favorites_count — одним запросом.
+    """
     while True:
         try:
             now = _utcnow()
+            cfg = get_session_tracker_config()
+            dirty = pop_dirty()
             active_count = 0
             closed_count = 0
+            rows: list[dict] = []
+            ended_now: list[int] = []
 
             for user_id, ctx in list(user_data.items()):
-                sid = ctx.get("session_id")
-                if not sid:
+                if not ctx.get("session_id"):
+                    continue
+                # уже закрыта и с тех пор не менялась — писать нечего
+                if ctx.get("marked_ended") and user_id not in dirty:
                     continue
 
-                created_at = ctx.get("created_at") or now
-                last_seen = ctx.get("last_seen") or created_at
-
-                # safety: приводим к aware
-                if created_at.tzinfo is None:
-                    created_at = created_at.replace(tzinfo=timezone.utc)
-                if last_seen.tzinfo is None:
-                    last_seen = last_seen.replace(tzinfo=timezone.utc)
-
-                timeout_minutes = _get_session_timeout_for_user(user_id)
-                inactive = (now - last_seen) > timedelta(minutes=timeout_minutes)
-                ended_at = last_seen if inactive else None
+                row, inactive = _session_row(user_id, ctx, now, cfg)
 
                 if inactive:
                     closed_count += 1
                 else:
                     active_count += 1
 
-                filters = {
-                    k: ctx.get(k)
-                    for k in ("age_min", "age_max", "time_required", "energy", "location")
-                } or {}
+                newly_ended = inactive and not ctx.get("marked_ended")
+                if user_id in dirty or newly_ended:
+                    rows.append(row)
+                if newly_ended:
+                    ended_now.append(user_id)
 
+            if rows:
                 # favorites_count без тяжёлых агрегаций
                 try:
-                    fav_resp = (
-                        supabase.table("favorites")
-                        .select("activity_id")
-                        .eq("user_id", user_id)
-                        .execute()
-                    )
-                    unique_ids = {
-                        row.get("activity_id")
-                        for row in (fav_resp.data or [])
-                        if row.get("activity_id")
-                    }
-                    favorites_count = len(unique_ids)
+                    fav_counts = await count_favorites([row["user_id"] for row in rows])
                 except Exception as e:
-                    logger.warning(f"[session_tracker] ⚠️ Favorites count error user={user_id}: {e}")
-                    favorites_count = 0
-
-                duration = int((last_seen - created_at).total_seconds())
-                if duration < 0:
-                    duration = 0
-
-                session_data = {
-                    "session_id": sid,
-                    "user_id": user_id,
-                    "username": ctx.get("username"),
-                    "started_at": _iso(created_at),
-                    "last_seen": _iso(last_seen),
-                    "ended_at": _iso(ended_at),
-                    "duration_seconds": duration,
-                    "filters": filters,
-                    "actions_count": int(ctx.get("actions_count", 0)),
-                    "favorites_count": favorites_count,
-                    "first_event": ctx.get("first_event"),
-                    "last_event": ctx.get("last_event"),
-                    "source": ctx.get("source"),
-                    "device_info": ctx.get("device_info") or {},
-                }
-
-                # Если уже пометили закрытой — не триггерим повторно
-                if inactive and ctx.get("marked_ended"):
-                    supabase.table("user_sessions").upsert(session_data).execute()
-                    continue
+                    logger.warning(f"[session_tracker] ⚠️ Favorites count error: {e}")
+                    fav_counts = {}
+                for row in rows:
+                    row["favorites_count"] = fav_counts.get(row["user_id"], 0)
 
-                # Апсерт в БД
-                supabase.table("user_sessions").upsert(session_data).execute()
+                try:
+                    await upsert_sessions(rows)
+                except Exception:
+                    # не потеряли: допишем в следующий цикл
+                    for row in rows:
+                        mark_dirty(row["user_id"])
+                    raise
+
+            for user_id in ended_now:
+                ctx = user_data.get(user_id)
+                if ctx is None:
+                    continue
+                await _schedule_session_end_pushes(user_id, ctx)
+                ctx["marked_ended"] = True
 
-                if inactive:
-                    try:
-                        # 1) Бесплатный, который УПЁРСЯ в лимит → paywall follow-up
-                        if is_user_limited(user_id):
-                            reason = ctx.get("last_paywall_reason") or "session_end"
-                            schedule_paywall_followup(user_id, reason=reason)
-                            logger.info(f"[session_tracker] 📬 Paywall-followup scheduled for user={user_id}")
-
-                        else:
-                            # 2) Лимит НЕ достигнут — различаем премиум / не премиум
-                            if is_premium(user_id):
-                                # Новая редкая цепочка для подписчиков
-                                schedule_retention_nudges_subscribers(user_id)
-                                logger.info(
-                                    f"[session_tracker] 📬 Retention-nudges SUBSCRIBERS scheduled for user={user_id}"
-                                )
-                                try:
-                                    schedule_interview_invite(user_id)
-                                except Exception as e:
-                                    logger.error(
-                                        f"[session_tracker] interview_invite error for user={user_id}: {e}"
-                                    )
-                            else:
-                                # Бесплатный, который не достиг лимита
-                                schedule_retention_nudges(user_id)
-                                logger.info(
-                                    f"[session_tracker] 📬 Retention-nudges scheduled for user={user_id}"
-                                )
-
-                    except Exception as e:
-                        logger.warning(f"[session_tracker] ❌ Push schedule error user={user_id}: {e}")
-
-                    ctx["marked_ended"] = True
+            # закрытые и уже записанные сессии больше не держим в памяти
+            # (выселенное пишется в USER_STATE_BACKEND — не на event loop)
+            evicted = await run_db(user_data.evict_idle)
 
             logger.info(
-                f"[session_tracker] ✅ Synced sessions (active={active_count}, closed={closed_count})"
+                f"[session_tracker] ✅ Synced sessions (written={len(rows)}, "
+                f"active={active_count}, closed={closed_count}, evicted={evicted})"
             )
 
         except Exception as e:
             logger.warning(f"[session_tracker] ❌ Sync error: {e}")
 
-        interval = _get_sync_interval()
-        await asyncio.sleep(interval)
+        # ждём интервал, но переполненный user_data выселяем, не дожидаясь его
+        deadline = asyncio.get_running_loop().time() + _get_sync_interval()
+        while asyncio.get_running_loop().time() < deadline and not user_data.needs_eviction:
+            await asyncio.sleep(1)
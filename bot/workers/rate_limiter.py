@@ -0,0 +1,82 @@
+# workers/rate_limiter.py
+"""
+Лимитер отправки под ограничения Telegram:
+- глобально не больше ~30 сообщений в секунду на бота (берём с запасом);
+- в один чат — не чаще раза в секунду.
+
+    await limiter.acquire(chat_id)   # ждём, пока можно слать в этот чат
+    limiter.pause(e.retry_after)     # 429 от Telegram — тормозим всех
+"""
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Классический token bucket. Ожидающие обслуживаются по очереди (FIFO)."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def set_rate(self, rate: float):
+        self.rate = float(rate)
+        self.capacity = float(rate)
+        self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds: float):
+        """Никому не выдаём токены ближайшие seconds секунд."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PushRateLimiter:
+    """Глобальный token bucket + минимальный интервал между сообщениями в один чат."""
+
+    # чистим память о чатах, когда их накопится столько
+    _CHAT_PRUNE_AT = 50_000
+
+    def __init__(self, global_per_second: float = 25, per_chat_interval: float = 1.0):
+        self.bucket = TokenBucket(global_per_second)
+        self.per_chat_interval = float(per_chat_interval)
+        self._chat_next: dict[int, float] = {}
+
+    def configure(self, global_per_second: float, per_chat_interval: float):
+        if float(global_per_second) != self.bucket.rate:
+            self.bucket.set_rate(global_per_second)
+        self.per_chat_interval = float(per_chat_interval)
+
+    def pause(self, seconds: float):
+        self.bucket.pause(seconds)
+
+    async def acquire(self, chat_id: int):
+        now = time.monotonic()
+
+        if len(self._chat_next) > self._CHAT_PRUNE_AT:
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+
+        # резервируем слот в чате сразу, чтобы параллельные отправки в тот же чат встали в очередь
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+        await self.bucket.acquire()
@@ -1,14 +1,28 @@
 import asyncio
+import functools
+import os
+import socket
 import time
+import uuid
+from collections import deque
 import random
 from datetime import datetime, timedelta, timezone
 
-from db.supabase_client import supabase
+from db.async_repo import (
+    run_db, fetch_due_pushes, insert_pushes,
+    count_sent_pushes, get_subscription,
+    claim_pushes, finish_push, reschedule_quiet_pushes,
+    mark_push_sending, is_missing_object_error,
+)
 from utils.logger import setup_logger
-from db.feature_flags import get_flag
+from db.feature_flags import get_flag, int_value
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton
+from aiogram.exceptions import TelegramRetryAfter
 from utils.amplitude_logger import log_event
+from utils.entitlements import invalidate_entitlement
+from utils.media_registry import send_photo
+from workers.rate_limiter import PushRateLimiter
 
 logger = setup_logger()
 
@@ -16,6 +30,48 @@ logger = setup_logger()
 _QUIET_LOG_EVERY_SECONDS = 30
 _last_empty_log_ts: datetime | None = None
 
+# Параметры доставки по умолчанию; переопределяются в retention_policy.delivery
+DELIVERY_DEFAULTS = {
+    "workers": 8,                 # сколько пушей отправляем параллельно
+    "batch_size": 200,            # сколько строк забираем из push_queue за раз
+    "global_per_second": 25,      # Telegram: ~30 msg/s на бота, держим запас
+    "per_chat_interval_sec": 1,   # Telegram: не чаще 1 msg/s в один чат
+    "lease_seconds": 300,         # на сколько воркер арендует забранную пачку
+}
+POLL_INTERVAL_SECONDS = 5
+# как часто сверяем дневной счётчик отправленных с БД
+CAP_RECONCILE_SECONDS = 300
+# Тихие часы: как часто переносим накопившееся на утро и что шлём несмотря ни на что
+QUIET_SWEEP_SECONDS = 60
+QUIET_RAMP_MINUTES = 60
+QUIET_BYPASS_TYPES = ["premium_welcome"]
+_quiet_rpc_supported = True
+_last_quiet_sweep_ts = 0.0
+# сколько раз повторяем отправку после 429
+TG_MAX_RETRIES = 3
+
+# Уникальный владелец аренды: воркеров может быть несколько (разные процессы/хосты)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+# RPC claim_push_batch ещё не накатили — работаем по-старому (только один процесс!).
+# Выключается только ошибкой «функции нет», сетевые сбои флаг не трогают.
+_lease_supported = True
+
+# Отметка sending_at в push_queue перед отправкой (см. _begin_send); выключается,
+# только если колонки ещё нет
+_send_marker_supported = True
+
+# push_id, которые этот процесс уже отправил: если финальный апдейт не прошёл
+# и строку забрали повторно, второй раз в Telegram не шлём. Между процессами
+# от повтора защищает sending_at.
+_SENT_IDS: set[int] = set()
+_SENT_ORDER: deque = deque()
+_SENT_REMEMBER = 20_000
+
+_limiter = PushRateLimiter(
+    DELIVERY_DEFAULTS["global_per_second"],
+    DELIVERY_DEFAULTS["per_chat_interval_sec"],
+)
+
 
 # ==============================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
@@ -29,11 +85,11 @@ def _iso(dt: datetime) -> str:
 
 
 def _in_quiet_hours(now_utc: datetime, cfg: dict) -> bool:
-    tz_offset = int(cfg.get("tz_offset_hours", 3))
+    tz_offset = int_value(cfg, "tz_offset_hours", 3)
     local = (now_utc + timedelta(hours=tz_offset)).time()
 
-    start = int(cfg.get("quiet_hours", {}).get("start", 22))
-    end = int(cfg.get("quiet_hours", {}).get("end", 9))
+    start = int_value(cfg, "quiet_hours.start", 22)
+    end = int_value(cfg, "quiet_hours.end", 9)
 
     if start <= end:
         return start <= local.hour < end
@@ -41,10 +97,10 @@ def _in_quiet_hours(now_utc: datetime, cfg: dict) -> bool:
 
 
 def _next_quiet_end(now_utc: datetime, cfg: dict) -> datetime:
-    tz_offset = int(cfg.get("tz_offset_hours", 3))
+    tz_offset = int_value(cfg, "tz_offset_hours", 3)
     local = now_utc + timedelta(hours=tz_offset)
 
-    end_h = int(cfg.get("quiet_hours", {}).get("end", 9))
+    end_h = int_value(cfg, "quiet_hours.end", 9)
     target_local = local.replace(hour=end_h, minute=0, second=0, microsecond=0)
 
     if local.hour >= end_h:
@@ -53,21 +109,208 @@ def _next_quiet_end(now_utc: datetime, cfg: dict) -> datetime:
     return target_local - timedelta(hours=tz_offset)
 
 
-def _global_cap_reached(now_utc: datetime, cap: int) -> bool:
-    start = now_utc.replace(hour=0, minute=0, second=0, microsecond=0)
-    end = start + timedelta(days=1)
+class _DailySentCounter:
+    """
+    Сколько пушей отправлено за текущие сутки (UTC) — для global_daily_cap.
+
+    count — отправленное, что уже видно в БД (status=sent): сидируется
+    count-запросом и раз в CAP_RECONCILE_SECONDS сверяется с БД — там видны
+    и отправки других воркеров. in_flight — место, занятое reserve(), пока
+    пуш не записан как sent: release(), если отправка не удалась, commit()
+    после записи. Сверка заменяет только count, in_flight сверху остаётся,
+    так что лимит не «забывает» уже идущие отправки. add() — пуши в обход
+    лимита. В полночь count обнуляется.
+    """
+
+    def __init__(self):
+        self.day = None
+        self.count = 0
+        self.in_flight = 0
+        self._reconciled_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _sync(self, now_utc: datetime):
+        day = now_utc.date()
+        if day == self.day and time.time() - self._reconciled_at < CAP_RECONCILE_SECONDS:
+            return
+        async with self._lock:
+            if day == self.day and time.time() - self._reconciled_at < CAP_RECONCILE_SECONDS:
+                return
+            start = now_utc.replace(hour=0, minute=0, second=0, microsecond=0)
+            end = start + timedelta(days=1)
+            try:
+                total = await count_sent_pushes(_iso(start), _iso(end))
+            except Exception as e:
+                logger.warning(f"[push_worker] Failed to reconcile daily cap counter: {e}")
+                if day != self.day:
+                    self.day, self.count = day, 0
+                self._reconciled_at = time.time()
+                return
+            if day != self.day:
+                logger.info(f"[push_worker] 📅 Daily cap counter rollover: {day} sent={total}")
+            self.day, self.count = day, total
+            self._reconciled_at = time.time()
+
+    async def reserve(self, now_utc: datetime, cap: int) -> bool:
+        """Занимает место под отправку; False — дневной лимит исчерпан."""
+        await self._sync(now_utc)
+        if self.count + self.in_flight >= cap:
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def commit(self):
+        """Зарезервированный пуш записан как sent: теперь его посчитает и сверка с БД."""
+        self.in_flight = max(0, self.in_flight - 1)
+        self.count += 1
+
+    def add(self):
+        self.count += 1
+
+
+_daily_sent = _DailySentCounter()
+
+
+def _delivery_cfg(cfg: dict) -> dict:
+    out = {key: int_value(cfg, f"delivery.{key}", default) for key, default in DELIVERY_DEFAULTS.items()}
+    out["workers"] = max(1, out["workers"])
+    out["batch_size"] = max(1, out["batch_size"])
+    return out
+
+
+def _lease_lost(row: dict) -> bool:
+    """Аренда истекла, пока пуш ждал очереди, — строку мог забрать другой воркер."""
+    expires = row.get("lease_expires_at")
+    if not row.get("lease_owner") or not expires:
+        return False
+    try:
+        return datetime.fromisoformat(expires.replace("Z", "+00:00")) <= _utcnow()
+    except ValueError:
+        return False
+
+
+def _mark_sent(push_id: int, reserved: bool):
+    """Пуш ушёл в Telegram: запоминаем для идемпотентности и учитываем в дневном лимите."""
+    _SENT_IDS.add(push_id)
+    _SENT_ORDER.append(push_id)
+    while len(_SENT_ORDER) > _SENT_REMEMBER:
+        _SENT_IDS.discard(_SENT_ORDER.popleft())
+    if not reserved:
+        _daily_sent.add()
+
+
+async def _finish_sent(row: dict, now: datetime, reserved: bool):
+    """
+    Пуш ушёл: помечаем sent в push_queue и переводим резерв лимита в count.
+    Ошибку записи не пробрасываем — пуш доставлен и failed стать не должен:
+    строку с sending_at claim_push_batch сам закроет как sent.
+    """
+    _mark_sent(row["id"], reserved)
+    try:
+        await finish_push(row, {
+            "status": "sent",
+            "sent_at": _iso(now)
+        })
+    except Exception as e:
+        logger.warning(f"[push_worker] ⚠️ Sent push_id={row['id']}, but failed to record it: {e}")
+    finally:
+        if reserved:
+            _daily_sent.commit()
+
+
+async def _begin_send(row: dict) -> bool:
+    """
+    Ставит в БД отметку «отправляю» прямо перед Telegram. Если она уже стоит
+    (другой процесс упал посреди отправки) или аренда потеряна — не шлём.
+    Сбой запроса — тоже не шлём: строка вернётся в работу по истечении аренды.
+    """
+    global _send_marker_supported
+    if not _send_marker_supported:
+        return True
+    try:
+        if await mark_push_sending(row, _iso(_utcnow())):
+            return True
+        logger.info(f"[push_worker] push_id={row['id']}: уже отправляется / аренда потеряна, пропускаем")
+        return False
+    except Exception as e:
+        if is_missing_object_error(e):
+            logger.warning(f"[push_worker] ⚠️ push_queue.sending_at не найдена, шлём без отметки: {e}")
+            _send_marker_supported = False
+            return True
+        logger.warning(f"[push_worker] ❌ mark sending failed push_id={row['id']}, retry later: {e}")
+        return False
+
+
+async def _fetch_batch(delivery: dict, types: list[str] | None = None) -> list[dict]:
+    """
+    Забирает пачку: через аренду (RPC), а если функции ещё нет в БД — обычным select.
+    Сбой RPC (сеть, таймаут) — пропускаем тик: без аренды несколько воркеров
+    разошлют одно и то же.
+    """
+    global _lease_supported
+    if _lease_supported:
+        try:
+            return await claim_pushes(WORKER_ID, delivery["batch_size"], delivery["lease_seconds"], types)
+        except Exception as e:
+            if not is_missing_object_error(e):
+                logger.warning(f"[push_worker] ❌ claim_push_batch failed, retry next tick: {e}")
+                return []
+            logger.warning(f"[push_worker] ⚠️ claim_push_batch не найден, без аренды (один процесс!): {e}")
+            _lease_supported = False
+    return await fetch_due_pushes(datetime.utcnow().isoformat() + "Z", delivery["batch_size"], types)
 
-    res = (
-        supabase.table("push_queue")
-        .select("id", count="exact")
-        .eq("status", "sent")
-        .gte("sent_at", _iso(start))
-        .lt("sent_at", _iso(end))
-        .execute()
-    )
 
-    total = int(res.count or 0)
-    return total >= cap
+def _quiet_ramp_seconds(cfg: dict) -> int:
+    """Окно, на которое растягиваем утреннюю волну (quiet_hours.ramp_minutes)."""
+    return max(0, int_value(cfg, "quiet_hours.ramp_minutes", QUIET_RAMP_MINUTES)) * 60
+
+
+async def _sweep_quiet_hours(cfg: dict) -> bool:
+    """
+    Тихие часы: одним RPC переносим на утро всё, что уже наступило (кроме QUIET_BYPASS_TYPES).
+    True — перенос сделан на стороне БД и поштучно ничего забирать не нужно.
+    """
+    global _quiet_rpc_supported, _last_quiet_sweep_ts
+    if not _quiet_rpc_supported:
+        return False
+    if time.time() - _last_quiet_sweep_ts < QUIET_SWEEP_SECONDS:
+        return True
+
+    until = _next_quiet_end(_utcnow(), cfg)
+    try:
+        moved = await reschedule_quiet_pushes(_iso(until), _quiet_ramp_seconds(cfg), QUIET_BYPASS_TYPES)
+    except Exception as e:
+        if not is_missing_object_error(e):
+            # сбой сети / таймаут: в этот тик переносим поштучно, RPC повторим в следующий
+            logger.warning(f"[push_worker] ❌ reschedule_quiet_pushes failed, переносим поштучно: {e}")
+            return False
+        logger.warning(f"[push_worker] ⚠️ reschedule_quiet_pushes не найден, переносим поштучно: {e}")
+        _quiet_rpc_supported = False
+        return False
+
+    _last_quiet_sweep_ts = time.time()
+    if moved:
+        logger.info(f"[push_worker] 🌙 Quiet hours: moved {moved} pushes to {_iso(until)} (+ramp)")
+    return True
+
+
+async def _tg_send(method, chat_id: int, **kwargs):
+    """
+    Вызов bot.send_* через лимитер.
+    На 429 ставим на паузу всю отправку на retry_after и повторяем.
+    """
+    for attempt in range(TG_MAX_RETRIES + 1):
+        await _limiter.acquire(chat_id)
+        try:
+            return await method(chat_id=chat_id, **kwargs)
+        except TelegramRetryAfter as e:
+            if attempt >= TG_MAX_RETRIES:
+                raise
+            logger.warning(f"[push_worker] ⏳ Flood control: retry_after={e.retry_after}s chat={chat_id}")
+            _limiter.pause(e.retry_after)
 
 
 # ==============================
@@ -86,6 +329,15 @@ async def _process_push(row: dict, cfg: dict, bot):
 
     now = _utcnow()
 
+    # ===== ИДЕМПОТЕНТНОСТЬ =====
+    if push_id in _SENT_IDS:
+        logger.info(f"[push_worker] push_id={push_id} уже отправлен этим процессом, закрываем")
+        await finish_push(row, {"status": "sent", "sent_at": _iso(now)})
+        return
+    if _lease_lost(row):
+        logger.info(f"[push_worker] push_id={push_id}: аренда истекла, отдаём другому воркеру")
+        return
+
     # ===== TEST MODE FOR PREMIUM RITUAL =====
     test_cfg = get_flag("premium_ritual_test", {}) or {}
     test_user = int(test_cfg.get("user_id", 0))
@@ -95,13 +347,13 @@ async def _process_push(row: dict, cfg: dict, bot):
         logger.info(f"[push_worker] TEST premium_ritual bypass for user={user_id}")
 
         next_when = now + timedelta(seconds=interval)
-        supabase.table("push_queue").insert({
+        await insert_pushes({
             "user_id": user_id,
             "type": "premium_ritual",
             "status": "pending",
             "scheduled_at": _iso(next_when),
             "payload": {"weekly": False, "test": True},
-        }).execute()
+        })
 
         log_event(
             user_id,
@@ -113,41 +365,54 @@ async def _process_push(row: dict, cfg: dict, bot):
             }
         )
 
+    # обычные пуши занимают место в дневном лимите, premium_welcome — нет
+    reserved = push_type != "premium_welcome"
+
     # ----- Premium welcome bypass -----
     if push_type == "premium_welcome":
         logger.info(f"[push_worker] premium_welcome — bypass all limits for push_id={push_id}")
+        # оплата прошла в robokassa_server (другой процесс) — сбрасываем закэшированные права
+        invalidate_entitlement(user_id)
     else:
         # 1. Проверка Quiet Hours (FIX: ПЕРЕНОС В БУДУЩЕЕ ВМЕСТО ПРОПУСКА)
         if _in_quiet_hours(now, cfg):
             next_start = _next_quiet_end(now, cfg)
 
-            # Добавляем случайные 1-10 минут (jitter), чтобы не было лавины сообщений ровно в 09:00
-            import random
-            jitter = random.randint(60, 600)
+            # Случайный сдвиг в пределах утреннего окна, чтобы не было лавины сообщений ровно в 09:00
+            # (обычно сюда попадаем, только если RPC reschedule_quiet_pushes ещё не накатили)
+            jitter = random.randint(0, _quiet_ramp_seconds(cfg))
             new_scheduled = next_start + timedelta(seconds=jitter)
 
             logger.info(f"[push_worker] 🌙 Quiet hours hit. Rescheduling push_id={push_id} to {_iso(new_scheduled)}")
 
             # Обновляем время в базе, чтобы воркер перешел к следующему пушу
-            supabase.table("push_queue").update({
+            await finish_push(row, {
+                "status": "pending",
                 "scheduled_at": _iso(new_scheduled)
-            }).eq("id", push_id).execute()
+            })
             return  # Теперь выходим, но пуш уже не "pending на сейчас", а "pending на утро"
 
         # 2. Проверка Global Cap (FIX: ПЕРЕНОС НА ЗАВТРА ВМЕСТО ПРОПУСКА)
         # Поднимаем дефолтный лимит до 5000, чтобы не блокировать отправку днем
-        cap = int(cfg.get("global_daily_cap", 5000)) 
-        if _global_cap_reached(now, cap):
+        cap = int_value(cfg, "global_daily_cap", 5000)
+        if not await _daily_sent.reserve(now, cap):
             tomorrow = now + timedelta(days=1)
 
             logger.warning(f"[push_worker] 🛑 Daily cap reached ({cap}). Rescheduling push_id={push_id} to {_iso(tomorrow)}")
 
             # Переносим пуш на завтра
-            supabase.table("push_queue").update({
+            await finish_push(row, {
+                "status": "pending",
                 "scheduled_at": _iso(tomorrow)
-            }).eq("id", push_id).execute()
+            })
             return
 
+    # ===== ОТМЕТКА «ОТПРАВЛЯЮ» (идемпотентность между процессами) =====
+    if not await _begin_send(row):
+        if reserved:
+            _daily_sent.release()
+        return
+
     markup = None
 
     # Формируем текст
@@ -202,13 +467,7 @@ async def _process_push(row: dict, cfg: dict, bot):
     elif push_type == "premium_welcome":
         amount = payload.get("amount_rub")
 
-        sub = (
-            supabase.table("user_subscriptions")
-            .select("expires_at")
-            .eq("user_id", user_id)
-            .maybe_single()
-            .execute()
-        ).data
+        sub = await get_subscription(user_id, "expires_at")
 
         expires_at_iso = sub.get("expires_at") if sub else None
 
@@ -272,25 +531,22 @@ async def _process_push(row: dict, cfg: dict, bot):
             markup = kb.as_markup()
 
             if photo_url:
-                await bot.send_photo(
-                    chat_id=user_id,
-                    photo=photo_url,
+                await send_photo(
+                    functools.partial(_tg_send, bot.send_photo, user_id),
+                    photo_url,
                     caption=text,
                     reply_markup=markup,
                     parse_mode="HTML"
                 )
             else:
-                await bot.send_message(
-                    chat_id=user_id,
+                await _tg_send(
+                    bot.send_message,
+                    user_id,
                     text=text,
                     reply_markup=markup,
                     parse_mode="HTML"
                 )
-
-            supabase.table("push_queue").update({
-                "status": "sent",
-                "sent_at": _iso(now)
-            }).eq("id", push_id).execute()
+            await _finish_sent(row, now, reserved)
 
             logger.info(f"[push_worker] ✅ Sent interview_invite push_id={push_id} user={user_id}")
 
@@ -310,12 +566,18 @@ async def _process_push(row: dict, cfg: dict, bot):
             return
 
         except Exception as e:
+            if push_id in _SENT_IDS:
+                # Telegram пуш принял — упал учёт после отправки, failed не ставим
+                logger.warning(f"[push_worker] ⚠️ Post-send error interview_invite push_id={push_id}: {e}")
+                return
             logger.warning(f"[push_worker] ❌ Failed interview_invite push_id={push_id}: {e}")
+            if reserved:
+                _daily_sent.release()
 
-            supabase.table("push_queue").update({
+            await finish_push(row, {
                 "status": "failed",
                 "sent_at": _iso(now)
-            }).eq("id", push_id).execute()
+            })
 
             return
 
@@ -325,14 +587,10 @@ async def _process_push(row: dict, cfg: dict, bot):
     # ----- ОТПРАВКА (ДЛЯ ВСЕХ ОСТАЛЬНЫХ ПУШЕЙ) -----
     try:
         if markup:
-            await bot.send_message(user_id, text, reply_markup=markup)
+            await _tg_send(bot.send_message, user_id, text=text, reply_markup=markup)
         else:
-            await bot.send_message(user_id, text)
-
-        supabase.table("push_queue").update({
-            "status": "sent",
-            "sent_at": _iso(now)
-        }).eq("id", push_id).execute()
+            await _tg_send(bot.send_message, user_id, text=text)
+        await _finish_sent(row, now, reserved)
 
         log_event(
             user_id,
@@ -349,24 +607,50 @@ async def _process_push(row: dict, cfg: dict, bot):
         if push_type == "premium_ritual":
             try:
                 from utils.push_scheduler import schedule_premium_ritual
-                schedule_premium_ritual(user_id)
+                await run_db(schedule_premium_ritual, user_id)
                 logger.info(f"[push_worker] ⏭ Planned next premium_ritual for user={user_id}")
             except Exception as e:
                 logger.warning(f"[push_worker] Failed to schedule next premium_ritual user={user_id}: {e}")
 
     except Exception as e:
+        if push_id in _SENT_IDS:
+            # Telegram пуш принял — упал учёт после отправки, failed не ставим
+            logger.warning(f"[push_worker] ⚠️ Post-send error push_id={push_id}: {e}")
+            return
         logger.warning(f"[push_worker] ❌ Failed push_id={push_id}: {e}")
+        if reserved:
+            _daily_sent.release()
 
-        supabase.table("push_queue").update({
+        await finish_push(row, {
             "status": "failed",
             "sent_at": _iso(now)
-        }).eq("id", push_id).execute()
+        })
 
 
 # ==============================
 # ФОНОВЫЙ ВОРКЕР
 # ==============================
 
+async def _deliver_batch(rows: list[dict], cfg: dict, bot, workers: int):
+    """Раздаёт пачку нескольким параллельным отправщикам; скорость держит _limiter."""
+    queue: asyncio.Queue = asyncio.Queue()
+    for row in rows:
+        queue.put_nowait(row)
+
+    async def _consumer():
+        while True:
+            try:
+                row = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await _process_push(row, cfg, bot)
+            except Exception as e:
+                logger.warning(f"[push_worker] Process error push_id={row.get('id')}: {e}")
+
+    await asyncio.gather(*(_consumer() for _ in range(min(workers, len(rows)))))
+
+
 async def run_worker(bot):
     last_flags_load = 0
     cfg_cache = None
@@ -381,26 +665,25 @@ async def run_worker(bot):
             except Exception as e:
                 logger.warning(f"[push_worker] Failed to load retention_policy: {e}")
 
+        delivery = _delivery_cfg(cfg_cache)
+        _limiter.configure(delivery["global_per_second"], delivery["per_chat_interval_sec"])
+
+        rows = []
         try:
-            pending = (
-                supabase.table("push_queue")
-                .select("*")
-                .eq("status", "pending")
-                .lte("scheduled_at", datetime.utcnow().isoformat() + "Z")
-                .order("scheduled_at", desc=False)
-                .limit(10)
-                .execute()
-            )
+            # в тихие часы обычные пуши переносим пачкой, а забираем только premium_welcome
+            types = None
+            if _in_quiet_hours(_utcnow(), cfg_cache) and await _sweep_quiet_hours(cfg_cache):
+                types = QUIET_BYPASS_TYPES
 
-            rows = pending.data or []
+            rows = await _fetch_batch(delivery, types)
 
             if rows:
                 logger.info(f"[push_worker] Found {len(rows)} pending pushes")
-
-            for row in rows:
-                await _process_push(row, cfg_cache, bot)
+                await _deliver_batch(rows, cfg_cache, bot, delivery["workers"])
 
         except Exception as e:
             logger.warning(f"[push_worker] Process error: {e}")
 
-        await asyncio.sleep(5)
+        # полная пачка — значит, есть хвост: забираем следующую сразу
+        if len(rows) < delivery["batch_size"]:
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)